@@ -0,0 +1,239 @@
+"""Audit trail of access decisions kept in a capped Redis stream.
+
+Each decision is one ``XADD ... MAXLEN ~ N`` (a single round trip, trimmed
+approximately so Redis can drop whole macro-nodes).  Because stream IDs are
+millisecond timestamps, time-range queries are plain ``XRANGE``/``XREVRANGE``
+reads, and paging continues from the last ID returned.
+
+Stream fields are strings, so values that are not (scores, ``via_ziti``,
+``None``) are stored JSON-encoded and named in a ``_typed`` field; reads
+decode them, and entries come back with the types they were logged with.
+
+Downstream exporters read through a consumer group at their own pace,
+starting with whatever they received but did not ack before a restart:
+
+    python access_log.py export --group siem --consumer exporter-1 > decisions.jsonl
+"""
+import os
+import re
+import sys
+import json
+import argparse
+from datetime import datetime
+
+import redis
+
+import redis_layout
+
+ACCESS_LOG_STREAM = os.getenv("ACCESS_LOG_STREAM", "access_logs:stream")
+ACCESS_LOG_MAXLEN = int(os.getenv("ACCESS_LOG_MAXLEN", "100000"))
+MAX_PAGE_SIZE = 500
+TYPED_FIELD = "_typed"
+_STREAM_ID = re.compile(r"\d+(-\d+)?\Z")
+
+
+def to_stream_id(value, default):
+    """Accept an epoch-ms integer, an ISO-8601 timestamp or a stream ID."""
+    if value in (None, ""):
+        return default
+    value = str(value)
+    if _STREAM_ID.match(value):
+        return value
+    return str(int(datetime.fromisoformat(value).timestamp() * 1000))
+
+
+def _exclusive(stream_id):
+    return "(" + stream_id
+
+
+def encode(entry):
+    """Stream fields for ``entry``: strings as they are, anything else as JSON."""
+    fields, typed = {}, []
+    for k, v in entry.items():
+        if isinstance(v, str):
+            fields[k] = v
+        else:
+            fields[k] = json.dumps(v, default=str)
+            typed.append(k)
+    if typed:
+        fields[TYPED_FIELD] = ",".join(typed)
+    return fields
+
+
+def decode(fields):
+    """The entry ``encode`` stored (entries written before typing stay all strings)."""
+    typed = fields.get(TYPED_FIELD)
+    if not typed:
+        return dict(fields)
+    entry = {k: v for k, v in fields.items() if k != TYPED_FIELD}
+    for k in typed.split(","):
+        if k in entry:
+            try:
+                entry[k] = json.loads(entry[k])
+            except ValueError:
+                pass
+    return entry
+
+
+class _Page:
+    """Range, cursor and filter state of one ``query``; the caller does the reads.
+
+    ``read`` returns the client's reply (awaitable on an asyncio client) and
+    ``feed`` consumes it, so the sync and async logs share one paging loop.
+    """
+
+    def __init__(self, stream, since, until, user, action, reason, cursor, limit, order, max_scan):
+        self.stream = stream
+        self.user, self.action, self.reason = user, action, reason
+        self.limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        self.order = order
+        self.max_scan = max_scan
+        self.chunk = max(self.limit, 100)
+        self.start = to_stream_id(since, "-")
+        self.end = to_stream_id(until, "+")
+        if cursor:
+            if not _STREAM_ID.match(cursor):
+                raise ValueError(f"cursor is not a stream ID: {cursor!r}")
+            if order == "asc":
+                self.start = _exclusive(cursor)
+            else:
+                self.end = _exclusive(cursor)
+        self.entries, self.scanned, self.last_id = [], 0, None
+        self.done = False
+
+    def _matches(self, fields):
+        return ((not self.user or fields.get("user_id") == self.user)
+                and (not self.action or fields.get("decision") == self.action)
+                and (not self.reason or fields.get("reason") == self.reason))
+
+    def wanted(self):
+        return not self.done and len(self.entries) < self.limit and self.scanned < self.max_scan
+
+    def read(self, client):
+        if self.order == "asc":
+            return client.xrange(self.stream, min=self.start, max=self.end, count=self.chunk)
+        return client.xrevrange(self.stream, max=self.end, min=self.start, count=self.chunk)
+
+    def feed(self, batch):
+        if not batch:
+            self.last_id, self.done = None, True
+            return
+        for entry_id, fields in batch:
+            self.scanned += 1
+            self.last_id = entry_id
+            if self._matches(fields):
+                self.entries.append(dict(decode(fields), id=entry_id))
+                if len(self.entries) >= self.limit:
+                    break
+        if len(batch) < self.chunk and len(self.entries) < self.limit:
+            self.last_id, self.done = None, True
+        elif self.order == "asc":
+            self.start = _exclusive(self.last_id)
+        else:
+            self.end = _exclusive(self.last_id)
+
+    def result(self):
+        return {"entries": self.entries, "next_cursor": self.last_id}
+
+
+class AccessLog:
+    def __init__(self, client, stream=ACCESS_LOG_STREAM, maxlen=ACCESS_LOG_MAXLEN):
+        self.client = client
+        self.stream = stream
+        self.maxlen = maxlen
+
+    def append(self, entry, pipe=None):
+        """XADD one decision; pass ``pipe`` to queue it on an existing pipeline."""
+        return (pipe or self.client).xadd(self.stream, encode(entry), maxlen=self.maxlen, approximate=True)
+
+    def _page(self, since, until, user, action, reason, cursor, limit, order, max_scan):
+        return _Page(self.stream, since, until, user, action, reason, cursor, limit, order, max_scan)
+
+    def query(self, since=None, until=None, user=None, action=None, reason=None,
+              cursor=None, limit=50, order="desc", max_scan=5000):
+        """One page of decisions, newest first by default.
+
+        Returns ``{"entries": [...], "next_cursor": id-or-None}``.  At most
+        ``max_scan`` stream entries are examined per call, so a selective
+        filter over a long range returns a short page plus a cursor rather
+        than walking the whole stream.
+        """
+        page = self._page(since, until, user, action, reason, cursor, limit, order, max_scan)
+        while page.wanted():
+            page.feed(page.read(self.client))
+        return page.result()
+
+    # ---------- consumer groups ----------
+    def ensure_group(self, group, start_id="$"):
+        try:
+            self.client.xgroup_create(self.stream, group, id=start_id, mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read_group(self, group, consumer, count=100, block_ms=5000, pending=False):
+        """New entries for ``consumer``, or with ``pending`` the ones delivered to it but never acked."""
+        resp = self.client.xreadgroup(group, consumer, {self.stream: "0" if pending else ">"}, count=count,
+                                      block=None if pending else block_ms)
+        return resp[0][1] if resp else []
+
+    def ack(self, group, *ids):
+        return self.client.xack(self.stream, group, *ids) if ids else 0
+
+
+class AsyncAccessLog(AccessLog):
+    """``AccessLog`` over a ``redis.asyncio`` client; ``query`` is a coroutine."""
+
+    async def query(self, since=None, until=None, user=None, action=None, reason=None,
+                    cursor=None, limit=50, order="desc", max_scan=5000):
+        page = self._page(since, until, user, action, reason, cursor, limit, order, max_scan)
+        while page.wanted():
+            page.feed(await page.read(self.client))
+        return page.result()
+
+
+def query_args(args):
+    """Map request query parameters onto ``AccessLog.query`` keyword arguments."""
+    order = args.get("order", "desc")
+    return {
+        "since": args.get("since"),
+        "until": args.get("until"),
+        "user": args.get("user"),
+        "action": args.get("action"),
+        "reason": args.get("reason"),
+        "cursor": args.get("cursor"),
+        "limit": int(args.get("limit", 50)),
+        "order": order if order in ("asc", "desc") else "desc",
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Access-decision stream exporter")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    e = sub.add_parser("export", help="stream new decisions as JSONL through a consumer group")
+    e.add_argument("--group", default="exporter")
+    e.add_argument("--consumer", default=os.getenv("HOSTNAME", "exporter-1"))
+    e.add_argument("--from-start", action="store_true", help="create the group at the start of the stream")
+    e.add_argument("--batch", type=int, default=500)
+    args = ap.parse_args()
+
+    client = redis_layout.connect()
+    log = AccessLog(client)
+    log.ensure_group(args.group, "0" if args.from_start else "$")
+    # Entries this consumer received but did not ack before it stopped come first
+    pending = True
+    while True:
+        batch = log.read_group(args.group, args.consumer, count=args.batch, pending=pending)
+        if pending and not batch:
+            pending = False
+            continue
+        for entry_id, fields in batch:
+            if not fields:  # trimmed from the stream while pending
+                continue
+            sys.stdout.write(json.dumps(dict(decode(fields), id=entry_id), ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+        log.ack(args.group, *[entry_id for entry_id, _ in batch])
+
+
+if __name__ == "__main__":
+    main()
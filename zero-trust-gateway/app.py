@@ -1,44 +1,101 @@
 import os
-import csv
 import time
-import json
 import hashlib
 from datetime import datetime
 from functools import wraps
 
-from flask import Flask, request, jsonify, render_template
-import jwt
-import redis
+from flask import Flask, request, jsonify
+
+import ip_reputation
+import jwt_verify
+import policy_table
+import redis_layout
+import retention
+import server
+from access_log import AccessLog, query_args
+from behavior_baseline import BehaviorBaseline
+from degraded_mode import UNAVAILABLE, RedisGuard, ResilientTrustStore, background_options, scored_locally
+from decision_sink import DecisionSink
+from risk_sketch import RiskTracker
+from stage_timing import StageTimer
+from step_up import DENY, REQUIRE_MFA, StepUpStore
+from traffic_capture import TrafficCapture
+from trust_state import TrustStateStore
+from user_cache import UserStateCache
 
 # ========== Environment Variables ==========
 KEYCLOAK_URL = os.getenv("KEYCLOAK_URL", "http://localhost:8080")
 REALM = os.getenv("REALM", "my-company")
 CLIENT_ID = os.getenv("CLIENT_ID", "my-app")
-REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
-REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 CSV_PATH = os.getenv("CSV_PATH", "out/decisions.csv")
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+TRUST_SCRIPT = os.getenv("TRUST_SCRIPT", "true").lower() == "true"
 
 # ========== Prometheus Metrics ==========
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import Counter, Histogram, CONTENT_TYPE_LATEST
 DECISIONS = Counter("zt_decisions_total", "Zero Trust decisions", ["action", "reason"])
 LATENCY = Histogram("zt_decision_latency_seconds", "Decision latency seconds")
+# Per-stage histograms and Redis round trips per request (STAGE_TIMING=true)
+stage_timer = StageTimer("standard")
 
 # ========== Flask & Redis ==========
 app = Flask(__name__)
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
-
-# ========== Optional: Strict JWT Verification for Production ==========
-# from jwt import PyJWKClient
-# OIDC_ISSUER = f"{KEYCLOAK_URL}/realms/{REALM}"
-# JWKS_URL = f"{OIDC_ISSUER}/protocol/openid-connect/certs"
-# _jwk_client = PyJWKClient(JWKS_URL)
-# def decode_and_verify(token: str):
-#     key = _jwk_client.get_signing_key_from_jwt(token).key
-#     return jwt.decode(
-#         token, key, algorithms=["RS256"],
-#         audience=CLIENT_ID, issuer=OIDC_ISSUER,
-#         options={"require": ["exp", "iat", "nbf"], "verify_signature": True}
-#     )
+# Standalone, Sentinel or Cluster per REDIS_MODE; per-user keys are hash-tagged (see redis_layout.py)
+# Every call is bounded by REDIS_BUDGET_MS and a circuit breaker; while Redis does
+# not answer, decisions are scored in process under FAILURE_MODE (see degraded_mode.py).
+redis_guard = RedisGuard("standard")
+redis_client = redis_guard.wrap(stage_timer.count_round_trips(redis_layout.connect(**redis_guard.client_options())))
+# Background work and admin reports (write-back, compaction, risk sketch, pub/sub listeners,
+# memory report) use their own client with longer timeouts, outside the budget.
+background_client = redis_layout.connect(**background_options())
+# Optional near-cache of per-user IP/device state (USER_CACHE=true); other
+# replicas' changes arrive as invalidations over Redis pub/sub.
+user_cache = UserStateCache.from_env(redis_client, listener=background_client)
+access_log = AccessLog(redis_client)
+trust_store = ResilientTrustStore(TrustStateStore(redis_client, use_script=TRUST_SCRIPT, cache=user_cache),
+                                  redis_guard, access_log, client=background_client)
+trust_store.start()
+if user_cache is not None:
+    user_cache.start(warm_from=access_log, warm_users=int(os.getenv("USER_CACHE_WARM", "0")))
+
+# Optional background compactor for state written before idle TTLs existed (RETENTION_COMPACT=true)
+compactor = retention.Compactor.from_env(background_client)
+if compactor is not None:
+    compactor.start()
+
+# Lowest trust scores and most active users/IPs as top-K series (see risk_sketch.py)
+risk_tracker = RiskTracker.from_env(background_client)
+if risk_tracker is not None:
+    risk_tracker.start()
+
+# Per-user behavioral baseline, scored in memory and merged into Redis in the background
+user_baseline = BehaviorBaseline.from_env()
+if user_baseline is not None:
+    user_baseline.start()
+
+# ========== Policy Table ==========
+# Score bands and resource rules come from policy.json (POLICY_FILE); the file
+# is re-read on change or on a message to POLICY_CHANNEL.
+policy_store = policy_table.from_env("policy.json", background_client)
+policy_store.start()
+
+# ========== IP Reputation ==========
+# Block/allow lists and per-range risk weights named by ip_reputation.json
+# (IP_REPUTATION_FILE), compiled to a memory-mapped file and swapped on change.
+reputation_store = ip_reputation.from_env("ip_reputation.json", background_client)
+if reputation_store is not None:
+    reputation_store.start()
+
+# ========== JWT Verification ==========
+# RS256 against Keycloak's JWKS (cached in memory, refreshed in the background).
+# JWT_VERIFY=false restores the old claims-only decode for local demos.
+token_verifier = jwt_verify.from_env(KEYCLOAK_URL, REALM, CLIENT_ID)
+
+# ========== Step-up Grants ==========
+# A require_mfa decision for a device whose token proves a fresh step-up
+# (acr/amr; auth_time after the challenge only with STEP_UP_REAUTH=true) is re-decided at STEP_UP_TRUST
+# until the grant expires or the score drops sharply (see step_up.py).
+step_up_store = StepUpStore.from_env(redis_client)
 
 # ========== Utility Functions ==========
 def read_bearer_token(req, body_token=None):
@@ -48,60 +105,61 @@ def read_bearer_token(req, body_token=None):
     return (body_token or "").strip()
 
 def get_client_ip(req):
-    xff = req.headers.get("X-Forwarded-For", "")
-    if xff:
-        return xff.split(",")[0].strip()
+    # Any client can send X-Forwarded-For; only the entries appended by our own
+    # TRUSTED_PROXIES reverse proxies count, else the peer address is the client
+    hops = [h.strip() for h in req.headers.get("X-Forwarded-For", "").split(",") if h.strip()]
+    if TRUSTED_PROXIES and len(hops) >= TRUSTED_PROXIES:
+        return hops[-TRUSTED_PROXIES]
     return req.remote_addr or "0.0.0.0"
 
-def ensure_csv_header(path: str):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    if not os.path.exists(path):
-        with open(path, "w", newline="", encoding="utf-8") as f:
-            w = csv.writer(f)
-            w.writerow(["ts", "user_id", "trust_score", "resource", "action", "reason"])
+# ========== Decision Log ==========
+# Rows are queued and written in batches by a background thread (see decision_sink.py)
+CSV_FIELDS = ["ts", "user_id", "trust_score", "resource", "action", "reason"]
+decision_sink = DecisionSink.from_env(CSV_PATH, CSV_FIELDS)
+
+# ========== Traffic Capture ==========
+# Sampled, anonymised request inputs for traffic_replay.py (TRAFFIC_CAPTURE=true, see traffic_capture.py)
+traffic_capture = TrafficCapture.from_env()
 
 # ========== Core Class ==========
 class ZeroTrustGateway:
-    def __init__(self):
-        self.suspicious_ips = set()
-        self.user_behavior = {}
-
     def calculate_trust_score(self, user_id, request_context):
         score = 100
 
-        # IP change
-        last_ip = redis_client.get(f"user:{user_id}:last_ip")
-        current_ip = request_context.get("ip")
-        if last_ip and last_ip != current_ip:
-            score -= 20
-
-        # Time range
-        current_hour = datetime.now().hour
-        if current_hour < 6 or current_hour > 23:
-            score -= 15
-
-        # Access frequency
-        key_ac = f"user:{user_id}:access_count"
-        access_count = redis_client.incr(key_ac)
-        redis_client.expire(key_ac, 60)
-        if access_count > 30:
-            score -= 30
+        # Deviation from the user's usual hours, resources, networks and rate;
+        # a fixed night-time rule until the user has a baseline
+        baseline = None
+        if user_baseline is not None:
+            with stage_timer.stage("signal_baseline"):
+                baseline = user_baseline.update(user_id, request_context.get("resource", "/"),
+                                                request_context.get("ip"))
+        if baseline is not None and baseline.warm:
+            score -= baseline.penalty
+        else:
+            current_hour = datetime.now().hour
+            if current_hour < 6 or current_hour > 23:
+                score -= 15
 
         # Sensitive operation
         if request_context.get("sensitive_operation"):
             score -= 10
 
-        # Device fingerprint
-        device_fingerprint = self._get_device_fingerprint(request_context)
-        known_device = redis_client.sismember(f"user:{user_id}:devices", device_fingerprint)
-        if not known_device:
-            score -= 25
-            redis_client.sadd(f"user:{user_id}:devices", device_fingerprint)
+        # Source network reputation (blocklisted, allowlisted or risky range)
+        if reputation_store is not None:
+            with stage_timer.stage("signal_ip_reputation"):
+                score -= reputation_store.penalty(request_context.get("ip"))
 
-        redis_client.set(f"user:{user_id}:last_ip", current_ip)
-        redis_client.set(f"user:{user_id}:trust_score", score)
+        # IP change, access rate (rate_limits.json) and device fingerprint are checked
+        # and recorded atomically in Redis (one round trip), which also stores the score.
+        with stage_timer.stage("signal_fingerprint"):
+            device_fingerprint = self._get_device_fingerprint(request_context)
+        request_context["fingerprint"] = device_fingerprint
+        with stage_timer.stage("signal_state"):
+            signals = trust_store.touch(user_id, request_context.get("ip"), device_fingerprint, base_score=score,
+                                        resource=request_context.get("resource", "/"))
+        request_context["degraded"] = scored_locally(signals)
 
-        return max(0, min(100, score))
+        return signals.score
 
     def _get_device_fingerprint(self, context):
         raw = "|".join([
@@ -112,37 +170,22 @@ class ZeroTrustGateway:
         ])
         return hashlib.sha256(raw.encode()).hexdigest()
 
-    def enforce_zero_trust_policy(self, user_id, trust_score, resource):
-        if trust_score >= 80:
-            policy = {
-                "action": "allow",
-                "restrictions": None,
-                "monitoring_level": "normal",
-                "reason": "low_risk",
-            }
-        elif trust_score >= 60:
-            policy = {
-                "action": "allow_restricted",
-                "restrictions": ["read_only"],
-                "monitoring_level": "enhanced",
-                "reason": "mid_risk_readonly",
-            }
-        elif trust_score >= 40:
-            policy = {
-                "action": "require_mfa",
-                "restrictions": ["minimal_access"],
-                "monitoring_level": "strict",
-                "reason": "high_risk_stepup",
-            }
-        else:
-            policy = {
-                "action": "deny",
-                "restrictions": ["blocked"],
-                "monitoring_level": "alert",
-                "reason": "very_high_risk",
-            }
-
-        self._log_access_decision(user_id, trust_score, resource, policy)
+    def enforce_zero_trust_policy(self, user_id, trust_score, resource, degraded=False, claims=None,
+                                  fingerprint=None):
+        with stage_timer.stage("policy"):
+            policy = policy_store.decide(resource, trust_score)
+            if degraded:
+                policy = trust_store.restrict(policy)
+
+        # Skip the challenge for a device that has already stepped up; a deny may revoke its grant
+        if policy["action"] in (REQUIRE_MFA, DENY) and not degraded and step_up_store is not None and claims is not None:
+            with stage_timer.stage("step_up"):
+                grant = step_up_store.check(user_id, fingerprint, trust_score, claims, policy["action"])
+            if grant is not None and policy["action"] == REQUIRE_MFA:
+                policy = step_up_store.elevated(policy_store.decide(resource, grant.score))
+
+        with stage_timer.stage("access_log"):
+            self._log_access_decision(user_id, trust_score, resource, policy)
         return policy
 
     def _log_access_decision(self, user_id, trust_score, resource, decision):
@@ -154,8 +197,10 @@ class ZeroTrustGateway:
             "decision": decision.get("action", ""),
             "reason": decision.get("reason", ""),
         }
-        redis_client.lpush("access_logs", json.dumps(entry))
-        redis_client.ltrim("access_logs", 0, 999)
+        try:
+            access_log.append(entry)
+        except UNAVAILABLE:
+            trust_store.keep(log=[entry])
 
 gateway = ZeroTrustGateway()
 
@@ -167,7 +212,7 @@ def verify_token(f):
         if not token:
             return jsonify({"error": "Missing authentication token"}), 401
         try:
-            payload = jwt.decode(token, options={"verify_signature": False})
+            payload = token_verifier.decode(token)
             request.user = payload
             return f(*args, **kwargs)
         except Exception as e:
@@ -181,20 +226,21 @@ def index():
 
 @app.route("/metrics")
 def metrics():
-    return generate_latest(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+    return server.metrics_payload(risk_tracker), 200, {"Content-Type": CONTENT_TYPE_LATEST}
 
 @app.route("/healthz")
 def healthz():
     try:
         redis_client.ping()
-        return jsonify({"status": "ok"}), 200
+        return jsonify({"status": "ok", "redis_breaker": redis_guard.breaker.state_name}), 200
     except Exception as e:
-        return jsonify({"status": "error", "error": str(e)}), 500
+        return jsonify({"status": "error", "error": str(e), "redis_breaker": redis_guard.breaker.state_name}), 500
 
 @app.route("/api/access-request", methods=["POST"])
+@stage_timer.request
+@redis_guard.request
 def access_request():
     started = time.time()
-    ensure_csv_header(CSV_PATH)
 
     data = request.get_json(force=True, silent=True) or {}
     token = read_bearer_token(request, data.get("token"))
@@ -203,7 +249,8 @@ def access_request():
         return jsonify({"error": "Authentication token required"}), 401
 
     try:
-        user_info = jwt.decode(token, options={"verify_signature": False})
+        with stage_timer.stage("token_decode"):
+            user_info = token_verifier.decode(token)
         user_id = user_info.get("preferred_username", "unknown")
         roles = user_info.get("realm_access", {}).get("roles", [])
     except Exception as e:
@@ -213,24 +260,31 @@ def access_request():
         "ip": get_client_ip(request),
         "user_agent": request.headers.get("User-Agent", ""),
         "accept_language": request.headers.get("Accept-Language", ""),
-        "sensitive_operation": (data.get("resource", "") or "/").startswith("/admin"),
+        "resource": data.get("resource", "/"),
+        "sensitive_operation": policy_store.is_sensitive(data.get("resource", "") or "/"),
         "platform": data.get("platform", ""),
         "timezone": data.get("timezone", ""),
     }
 
     trust_score = gateway.calculate_trust_score(user_id, request_context)
     resource = data.get("resource", "/")
-    policy = gateway.enforce_zero_trust_policy(user_id, trust_score, resource)
+    policy = gateway.enforce_zero_trust_policy(user_id, trust_score, resource, degraded=request_context["degraded"],
+                                               claims=user_info, fingerprint=request_context["fingerprint"])
 
     LATENCY.observe(time.time() - started)
     DECISIONS.labels(policy["action"], policy.get("reason", "unknown")).inc()
+    if risk_tracker is not None:
+        risk_tracker.observe(user_id, request_context["ip"], trust_score)
 
-    try:
-        with open(CSV_PATH, "a", newline="", encoding="utf-8") as f:
-            w = csv.writer(f)
-            w.writerow([datetime.now().isoformat(), user_id, trust_score, resource, policy["action"], policy.get("reason", "")])
-    except Exception:
-        pass
+    with stage_timer.stage("decision_log"):
+        decision_sink.submit({
+            "ts": datetime.now().isoformat(),
+            "user_id": user_id,
+            "trust_score": trust_score,
+            "resource": resource,
+            "action": policy["action"],
+            "reason": policy.get("reason", ""),
+        })
 
     response = {
         "user_id": user_id,
@@ -251,23 +305,49 @@ def access_request():
     else:
         code = 200
 
-    return jsonify(response), code
+    if traffic_capture is not None:
+        traffic_capture.record(request.headers, request_context["ip"], data, user_info, action, trust_score, code,
+                               time.time() - started, started)
+
+    with stage_timer.stage("serialize"):
+        body = jsonify(response)
+    return body, code
 
 @app.route("/api/user-behavior/<user_id>", methods=["GET"])
 @verify_token
 def get_user_behavior(user_id):
-    trust_score = redis_client.get(f"user:{user_id}:trust_score") or 100
-    last_ip = redis_client.get(f"user:{user_id}:last_ip") or "unknown"
-    access_count = redis_client.get(f"user:{user_id}:access_count") or 0
+    state = trust_store.read(user_id)
+    trust_score = state.trust_score
 
     return jsonify({
         "user_id": user_id,
-        "current_trust_score": int(trust_score),
-        "last_known_ip": last_ip,
-        "recent_access_count": int(access_count),
-        "risk_level": "high" if int(trust_score) < 60 else "medium" if int(trust_score) < 80 else "low"
+        "current_trust_score": trust_score,
+        "last_known_ip": state.last_ip or "unknown",
+        "recent_access_count": state.access_count,
+        "risk_level": "high" if trust_score < 60 else "medium" if trust_score < 80 else "low"
     })
 
+@app.route("/api/access-logs", methods=["GET"])
+@verify_token
+def get_access_logs():
+    try:
+        page = access_log.query(**query_args(request.args))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query: {str(e)}"}), 400
+    return jsonify(page)
+
+@app.route("/api/admin/redis-memory", methods=["GET"])
+@verify_token
+def redis_memory():
+    """Keys and estimated bytes per category, and the users holding the most memory."""
+    try:
+        report = retention.memory_report(background_client, sample=float(request.args.get("sample", 0.1)),
+                                         top=int(request.args.get("top", 10)),
+                                         max_keys=int(request.args.get("max_keys", 100000)))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query: {str(e)}"}), 400
+    return jsonify(report)
+
 @app.route("/api/simulate-attack", methods=["POST"])
 def simulate_attack():
     attack_type = (request.json or {}).get("type", "brute_force")
@@ -285,4 +365,5 @@ if __name__ == "__main__":
     print("🚀 Zero-Trust Gateway started: http://localhost:5000")
     print("   Health check:      /healthz")
     print("   Prometheus metrics: /metrics")
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # Preforked production server unless SERVER_MODE=dev (see server.py)
+    server.run("app", app, 5000)
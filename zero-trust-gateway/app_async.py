@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""ASGI serving mode for the enhanced gateway.
+
+Same routes, JSON contract and status codes as app_ziti.py, but every Redis
+call goes through a pooled ``redis.asyncio`` client so an in-flight request
+no longer pins a thread while it waits on the network.
+
+    python app_async.py
+    uvicorn app_async:app --host 0.0.0.0 --port 5001 --loop uvloop
+"""
+import os
+import time
+import asyncio
+
+from starlette.applications import Starlette
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from prometheus_client import CONTENT_TYPE_LATEST
+
+import ip_reputation
+import jwt_verify
+import policy_table
+import redis_layout
+import retention
+import server
+from access_log import AccessLog, AsyncAccessLog, query_args
+from behavior_baseline import BehaviorBaseline
+from decision_sink import DecisionSink
+from degraded_mode import UNAVAILABLE, AsyncResilientTrustStore, RedisGuard, background_options, scored_locally
+from redis_layout import FIELD_TRUST_SCORE, state_key
+from risk_sketch import RiskTracker
+from step_up import AsyncStepUpStore
+from traffic_capture import TrafficCapture
+from trust_state import AsyncTrustStateStore
+# Scoring, policy and responses shared with app_ziti.py (see ziti_gateway.py)
+from ziti_gateway import (
+    BATCH_MAX_ITEMS, CLIENT_ID, CSV_FIELDS, CSV_PATH, KEYCLOAK_URL, LATENCY, REALM, TRUST_SCRIPT,
+    EnhancedZeroTrustGateway, read_bearer_token, ziti_available,
+)
+
+ziti_enabled = ziti_available()
+USE_ZITI = ziti_enabled
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "64"))
+PORT = int(os.getenv("PORT", "5001" if USE_ZITI else "5000"))
+
+# Same budget, breaker and FAILURE_MODE as app_ziti.py (see degraded_mode.py)
+redis_guard = RedisGuard("ziti_async")
+redis_client = redis_guard.wrap(redis_layout.connect(asyncio=True, max_connections=REDIS_POOL_SIZE,
+                                                     **redis_guard.client_options()))
+# Background threads (write-back of updates scored locally, policy and reputation
+# reloads, risk sketch, compactor) use a synchronous client outside the request
+# budget; they start with the application, not on import.
+background_client = redis_layout.connect(**background_options())
+trust_store = AsyncResilientTrustStore(AsyncTrustStateStore(redis_client, use_script=TRUST_SCRIPT), redis_guard,
+                                       AccessLog(background_client), client=background_client)
+access_log = AsyncAccessLog(redis_client)
+# Step-up grants shared with app_ziti.py through Redis (see step_up.py)
+step_up_store = AsyncStepUpStore.from_env(redis_client)
+compactor = retention.Compactor.from_env(background_client)
+risk_tracker = RiskTracker.from_env(background_client)
+user_baseline = BehaviorBaseline.from_env()
+policy_store = policy_table.from_env("policy_ziti.json", background_client)
+reputation_store = ip_reputation.from_env("ip_reputation.json", background_client)
+token_verifier = jwt_verify.from_env(KEYCLOAK_URL, REALM, CLIENT_ID)
+decision_sink = DecisionSink.from_env(CSV_PATH, CSV_FIELDS)
+traffic_capture = TrafficCapture.from_env("out/captures/requests_ziti.jsonl")
+workers = [w for w in (trust_store, compactor, risk_tracker, user_baseline, policy_store, reputation_store)
+           if w is not None]
+
+
+def remote_addr(req):
+    return req.client.host if req.client else None
+
+
+async def verify(token):
+    # Cache hits are pure CPU; a miss may fetch JWKS, so it runs off the loop
+    return token_verifier.cached(token) or await asyncio.to_thread(token_verifier.decode, token)
+
+
+class AsyncZeroTrustGateway(EnhancedZeroTrustGateway):
+    """Async scoring on top of the synchronous gateway's pure-Python pieces.
+
+    Policy evaluation is inherited unchanged; its audit log entry is queued
+    on the same pipeline as the score update, so a decision costs two Redis
+    round trips (scoring script, then writes) however many items it covers.
+    A single decision reads the device's step-up grant alongside the scoring
+    script.  Writes that fail are kept locally until Redis is back.
+    """
+
+    async def decide(self, user_id, request_context, resource):
+        network_score = self.calculate_network_trust_score(user_id, request_context)
+        touch = self.trust_store.touch(**self._app_state_request(user_id, request_context))
+        stored = None
+        if self.step_up_store is not None and request_context.get("claims") is not None:
+            signals, stored = await asyncio.gather(touch, self.step_up_store.read(user_id,
+                                                                                  request_context["fingerprint"]))
+        else:
+            signals = await touch
+        app_score = signals.score
+        combined_score = self._combine_scores(network_score, app_score)
+        request_context["degraded"] = scored_locally(signals)
+        action = self.step_up_action(combined_score, network_score, app_score, resource, request_context)
+
+        result = None
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                grant = None
+                if action is not None:
+                    grant = self.step_up_store.resolve(user_id, request_context["fingerprint"], combined_score,
+                                                       request_context["claims"], action, stored, pipe)
+                pipe.hset(state_key(user_id), FIELD_TRUST_SCORE, combined_score)
+                policy = self.enforce_policy_with_layers(user_id, combined_score, network_score, app_score, resource,
+                                                         pipe=pipe, degraded=request_context["degraded"], grant=grant)
+                result = policy, combined_score, network_score, app_score
+                await pipe.execute()
+        except UNAVAILABLE:
+            self.keep_batch([(user_id, request_context, resource)], [result])
+
+        return result
+
+    async def step_up_grants(self, items, scores, pipe):
+        grants = [None] * len(items)
+        at, requests = self._step_up_requests(items, scores)
+        if requests:
+            for i, grant in zip(at, await self.step_up_store.check_many(requests, pipe=pipe)):
+                grants[i] = grant
+        return grants
+
+    async def decide_batch(self, items):
+        network_scores = [self.calculate_network_trust_score(u, ctx) for u, ctx, _ in items]
+        signals = await self.trust_store.touch_many([self._app_state_request(u, ctx) for u, ctx, _ in items])
+        scores = []
+        for (user_id, ctx, resource), network_score, sig in zip(items, network_scores, signals):
+            ctx["degraded"] = scored_locally(sig)
+            scores.append((self._combine_scores(network_score, sig.score), network_score, sig.score))
+
+        results = []
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                grants = await self.step_up_grants(items, scores, pipe)
+                for (user_id, ctx, resource), (combined_score, network_score, app_score), grant in zip(
+                        items, scores, grants):
+                    pipe.hset(state_key(user_id), FIELD_TRUST_SCORE, combined_score)
+                    policy = self.enforce_policy_with_layers(user_id, combined_score, network_score, app_score,
+                                                             resource, pipe=pipe, degraded=ctx["degraded"],
+                                                             grant=grant)
+                    results.append((policy, combined_score, network_score, app_score))
+                await pipe.execute()
+        except UNAVAILABLE:
+            self.keep_batch(items, results)
+        return results
+
+
+gateway = AsyncZeroTrustGateway(redis_client, trust_store, access_log, policy_store, decision_sink,
+                                reputation_store=reputation_store, user_baseline=user_baseline,
+                                risk_tracker=risk_tracker, step_up_store=step_up_store, use_ziti=USE_ZITI)
+
+
+# ========== Routes ==========
+async def index(request):
+    mode = "OpenZiti Enhanced" if USE_ZITI else "Standard"
+    return Response(f"<h3>Zero-Trust Gateway ({mode} Mode, ASGI)</h3>", media_type="text/html")
+
+
+async def metrics(request):
+    # The top-K risk series are read from Redis with the sync client, off the loop
+    body = await asyncio.to_thread(server.metrics_payload, risk_tracker)
+    return Response(body, headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+async def healthz(request):
+    try:
+        await redis_client.ping()
+        status = {
+            "status": "ok",
+            "mode": "openziti" if USE_ZITI else "standard",
+            "ziti_enabled": ziti_enabled,
+            "redis_breaker": redis_guard.breaker.state_name,
+        }
+        return JSONResponse(status, status_code=200)
+    except Exception as e:
+        return JSONResponse({"status": "err", "error": str(e), "redis_breaker": redis_guard.breaker.state_name},
+                            status_code=500)
+
+
+@redis_guard.request
+async def access_request(request):
+    started = time.time()
+
+    try:
+        data = await request.json()
+        if not isinstance(data, dict):
+            data = {}
+    except Exception:
+        data = {}
+    token = read_bearer_token(request, data.get("token"))
+
+    if not token:
+        return JSONResponse({"error": "需要认证令牌"}, status_code=401)
+
+    try:
+        user_info = await verify(token)
+        user_id = user_info.get("preferred_username", "unknown")
+        roles = user_info.get("realm_access", {}).get("roles", [])
+    except Exception as e:
+        return JSONResponse({"error": f"令牌无效: {str(e)}"}, status_code=401)
+
+    request_context = gateway.build_request_context(request.headers, remote_addr(request), data, claims=user_info)
+
+    resource = data.get("resource", "/")
+    policy, combined_score, network_score, app_score = await gateway.decide(user_id, request_context, resource)
+
+    LATENCY.observe(time.time() - started)
+    # decision_response only enqueues to the decision sink; no file I/O here
+    response, code = gateway.decision_response(user_id, roles, resource, policy, combined_score, network_score,
+                                               app_score, ip=request_context["ip"])
+    if traffic_capture is not None:
+        traffic_capture.record(request.headers, request_context["ip"], data, user_info, policy["action"],
+                               combined_score, code, time.time() - started, started)
+    return JSONResponse(response, status_code=code)
+
+
+@redis_guard.request
+async def access_request_batch(request):
+    try:
+        data = await request.json()
+    except Exception:
+        data = None
+    items = data.get("items") if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return JSONResponse({"error": "请求体必须是条目数组"}, status_code=400)
+    if len(items) > BATCH_MAX_ITEMS:
+        return JSONResponse({"error": f"批量条目过多（上限 {BATCH_MAX_ITEMS}）"}, status_code=413)
+
+    results = [None] * len(items)
+    claims_by_token = {}
+    pending = []  # (index, user_id, roles, request_context, resource)
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = {"error": "条目格式无效", "status": 400}
+            continue
+        token = (item.get("token") or "").strip()
+        if not token:
+            results[i] = {"error": "需要认证令牌", "status": 401}
+            continue
+        if token not in claims_by_token:
+            try:
+                claims_by_token[token] = await verify(token)
+            except Exception as e:
+                claims_by_token[token] = e
+        user_info = claims_by_token[token]
+        if isinstance(user_info, Exception):
+            results[i] = {"error": f"令牌无效: {str(user_info)}", "status": 401}
+            continue
+
+        headers = Headers(headers={str(k): str(v) for k, v in (item.get("headers") or {}).items()})
+        pending.append((
+            i,
+            user_info.get("preferred_username", "unknown"),
+            user_info.get("realm_access", {}).get("roles", []),
+            gateway.build_request_context(headers, remote_addr(request), item, claims=user_info),
+            item.get("resource", "/"),
+        ))
+
+    decisions = await gateway.decide_batch([(user_id, ctx, resource) for _, user_id, _, ctx, resource in pending])
+    for (i, user_id, roles, ctx, resource), (policy, combined_score, network_score, app_score) in zip(pending, decisions):
+        response, code = gateway.decision_response(user_id, roles, resource, policy, combined_score, network_score,
+                                                   app_score, ip=ctx["ip"])
+        response["status"] = code
+        results[i] = response
+
+    return JSONResponse({"results": results})
+
+
+async def get_user_behavior(request):
+    user_id = request.path_params["user_id"]
+    # One round trip: the user's keys share a slot (redis_layout.py)
+    state = await trust_store.read(user_id)
+    trust_score = state.trust_score
+
+    return JSONResponse({
+        "user_id": user_id,
+        "current_trust_score": trust_score,
+        "last_known_ip": state.last_ip or "unknown",
+        "recent_access_count": state.access_count,
+        "known_devices": state.devices,
+        "risk_level": "high" if trust_score < 60 else "medium" if trust_score < 80 else "low",
+        "ziti_enabled": USE_ZITI,
+    })
+
+
+async def get_access_logs(request):
+    try:
+        page = await access_log.query(**query_args(request.query_params))
+    except ValueError as e:
+        return JSONResponse({"error": f"查询参数无效: {str(e)}"}, status_code=400)
+    return JSONResponse(page)
+
+
+async def on_startup():
+    decision_sink.start()
+    for worker in workers:
+        worker.start()
+
+
+async def on_shutdown():
+    decision_sink.close()
+    if traffic_capture is not None:
+        traffic_capture.close()
+    for worker in workers:
+        worker.stop()
+    await redis_client.close()
+
+
+app = Starlette(
+    routes=[
+        Route("/", index),
+        Route("/metrics", metrics),
+        Route("/healthz", healthz),
+        Route("/api/access-request", access_request, methods=["POST"]),
+        Route("/api/access-request/batch", access_request_batch, methods=["POST"]),
+        Route("/api/user-behavior/{user_id}", get_user_behavior, methods=["GET"]),
+        Route("/api/access-logs", get_access_logs, methods=["GET"]),
+    ],
+    on_startup=[on_startup],
+    on_shutdown=[on_shutdown],
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    mode = "OpenZiti增强" if USE_ZITI else "标准"
+    print(f"🚀 零信任网关启动 ({mode}模式, ASGI): http://localhost:{PORT}")
+    print(f"   健康检查:      /healthz")
+    print(f"   Prom指标:      /metrics")
+    uvicorn.run(app, host="0.0.0.0", port=PORT, loop="auto", http="auto",
+                backlog=int(os.getenv("BACKLOG", "4096")), access_log=False)
@@ -1,207 +1,92 @@
 # -*- coding: utf-8 -*-
 import os
-import csv
 import time
-import json
-import hashlib
-from datetime import datetime
-from functools import wraps
 
-from flask import Flask, request, jsonify, render_template
-import jwt
-import redis
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from flask import Flask, request, jsonify
+from werkzeug.datastructures import Headers
+from prometheus_client import CONTENT_TYPE_LATEST
 
-
-KEYCLOAK_URL = os.getenv("KEYCLOAK_URL", "http://localhost:8080")
-REALM = os.getenv("REALM", "my-company")
-CLIENT_ID = os.getenv("CLIENT_ID", "my-app")
-REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
-REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
-CSV_PATH = os.getenv("CSV_PATH", "out/decisions_ziti.csv")
-USE_ZITI = os.getenv("USE_ZITI", "false").lower() == "true"
-ZITI_CONTROLLER = os.getenv("ZITI_CONTROLLER", "localhost:1280")
-
-
-DECISIONS = Counter("zt_decisions_total", "Zero Trust decisions", ["action", "reason", "layer"])
-LATENCY = Histogram("zt_decision_latency_seconds", "Decision latency seconds")
-TRUST_SCORE = Histogram("zt_trust_score", "Trust score distribution", ["layer"])
-ZITI_CONNECTIONS = Counter("ziti_connections_total", "OpenZiti connection attempts", ["status"])
+import ip_reputation
+import jwt_verify
+import policy_table
+import redis_layout
+import retention
+import server
+from access_log import AccessLog, query_args
+from behavior_baseline import BehaviorBaseline
+from degraded_mode import RedisGuard, ResilientTrustStore, background_options
+from decision_sink import DecisionSink
+from risk_sketch import RiskTracker
+from step_up import StepUpStore
+from traffic_capture import TrafficCapture
+from trust_state import TrustStateStore
+from user_cache import UserStateCache
+# 评分、策略与响应逻辑与 app_async.py 共用（见 ziti_gateway.py）
+from ziti_gateway import (
+    BATCH_MAX_ITEMS, CLIENT_ID, CSV_FIELDS, CSV_PATH, KEYCLOAK_URL, LATENCY, REALM, TRUST_SCRIPT,
+    EnhancedZeroTrustGateway, read_bearer_token, stage_timer, ziti_available,
+)
 
 
 app = Flask(__name__)
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+# 按 REDIS_MODE 连接单机/Sentinel/Cluster；用户键带哈希标签（见 redis_layout.py）
+# 每次调用受 REDIS_BUDGET_MS 与熔断器约束；Redis无响应时在进程内评分，按 FAILURE_MODE 限制结果（见 degraded_mode.py）
+redis_guard = RedisGuard("ziti")
+redis_client = redis_guard.wrap(stage_timer.count_round_trips(redis_layout.connect(**redis_guard.client_options())))
+# 后台任务与管理接口（降级写回、压缩、风险汇总、发布订阅监听、内存报告）使用较长超时（REDIS_BACKGROUND_TIMEOUT）的独立连接，不受请求预算约束
+background_client = redis_layout.connect(**background_options())
+# 可选的用户状态近端缓存（USER_CACHE=true），其他副本的变更通过Redis发布订阅失效
+user_cache = UserStateCache.from_env(redis_client, listener=background_client)
+access_log = AccessLog(redis_client)
+trust_store = ResilientTrustStore(TrustStateStore(redis_client, use_script=TRUST_SCRIPT, cache=user_cache),
+                                  redis_guard, access_log, client=background_client)
+trust_store.start()
+if user_cache is not None:
+    user_cache.start(warm_from=access_log, warm_users=int(os.getenv("USER_CACHE_WARM", "0")))
+# 可选的后台压缩：为保留期引入前写入的键补设空闲TTL（RETENTION_COMPACT=true，见 retention.py）
+compactor = retention.Compactor.from_env(background_client)
+if compactor is not None:
+    compactor.start()
+# 信任分最低的用户与访问最多的用户/IP，仅导出前K个序列（见 risk_sketch.py）
+risk_tracker = RiskTracker.from_env(background_client)
+if risk_tracker is not None:
+    risk_tracker.start()
+# 用户行为基线：请求路径只读写进程内存，后台定期合并进Redis（见 behavior_baseline.py）
+user_baseline = BehaviorBaseline.from_env()
+if user_baseline is not None:
+    user_baseline.start()
+# 策略表：阈值与资源规则来自 policy_ziti.json（POLICY_FILE），文件变更或收到重载信号时原子替换
+policy_store = policy_table.from_env("policy_ziti.json", background_client)
+policy_store.start()
+# IP信誉：ip_reputation.json 列出的黑/白名单与按网段的风险权重，编译为内存映射文件，变更时原子替换
+reputation_store = ip_reputation.from_env("ip_reputation.json", background_client)
+if reputation_store is not None:
+    reputation_store.start()
+# RS256 + JWKS缓存验证；JWT_VERIFY=false 时仅解析声明（本地演示）
+token_verifier = jwt_verify.from_env(KEYCLOAK_URL, REALM, CLIENT_ID)
+# 提权授权：令牌证明已完成MFA（acr/amr；STEP_UP_REAUTH=true 时也认可挑战之后的auth_time）的设备，require_mfa 决策按 STEP_UP_TRUST 重新判定，
+# 直到授权过期或信任分骤降（见 step_up.py）
+step_up_store = StepUpStore.from_env(redis_client)
 
+# OpenZiti：USE_ZITI=true 且模块可用时启用
+ziti_enabled = ziti_available()
+USE_ZITI = ziti_enabled
 
-ziti_enabled = False
-if USE_ZITI:
-    try:
-        import openziti
-        print("OpenZiti模块已加载")
-        ziti_enabled = True
-    except ImportError:
-        print("OpenZiti未安装，运行在标准模式")
-        USE_ZITI = False
+# 决策日志：请求线程只入队，后台线程批量写入（见 decision_sink.py）
+decision_sink = DecisionSink.from_env(CSV_PATH, CSV_FIELDS)
+# 流量采样：按用户抽样、匿名化后的请求输入，供 traffic_replay.py 回放（TRAFFIC_CAPTURE=true，见 traffic_capture.py）
+traffic_capture = TrafficCapture.from_env("out/captures/requests_ziti.jsonl")
 
-def read_bearer_token(req, body_token=None):
-    h = req.headers.get("Authorization", "")
-    if h.startswith("Bearer "):
-        return h.replace("Bearer ", "", 1).strip()
-    return (body_token or "").strip()
+gateway = EnhancedZeroTrustGateway(redis_client, trust_store, access_log, policy_store, decision_sink,
+                                   reputation_store=reputation_store, user_baseline=user_baseline,
+                                   risk_tracker=risk_tracker, step_up_store=step_up_store, use_ziti=USE_ZITI)
 
 def get_client_ip(req):
-    xff = req.headers.get("X-Forwarded-For", "")
-    if xff:
-        return xff.split(",")[0].strip()
-    if USE_ZITI and req.headers.get("X-Openziti-Identity"):
-        return "ziti-network"
-    return req.remote_addr or "0.0.0.0"
+    return gateway.client_ip(req.headers, req.remote_addr)
 
 def get_ziti_identity(req):
     return req.headers.get("X-Openziti-Identity", None)
 
-def ensure_csv_header(path: str):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    if not os.path.exists(path):
-        with open(path, "w", newline="", encoding="utf-8") as f:
-            w = csv.writer(f)
-            w.writerow(["ts", "user_id", "trust_score", "network_score", "app_score", "resource", "action", "reason", "via_ziti"])
-
-class EnhancedZeroTrustGateway:
-    
-    def __init__(self):
-        self.suspicious_ips = set()
-        self.user_behavior = {}
-        
-    def calculate_network_trust_score(self, user_id, request_context):
-        """网络层信任分（OpenZiti相关）"""
-        score = 50
-        
-        if request_context.get("via_ziti"):
-            score += 30
-            ZITI_CONNECTIONS.labels(status="authenticated").inc()
-        else:
-            ZITI_CONNECTIONS.labels(status="direct").inc()
-            
-        if request_context.get("ziti_identity"):
-            score += 20
-            
-        return min(100, score)
-    
-    def calculate_app_trust_score(self, user_id, request_context):
-        score = 100
-        
-        last_ip = redis_client.get(f"user:{user_id}:last_ip")
-        current_ip = request_context.get("ip")
-        if last_ip and last_ip != current_ip and current_ip != "ziti-network":
-            score -= 20
-            
-        current_hour = datetime.now().hour
-        if current_hour < 6 or current_hour > 23:
-            score -= 15
-            
-        key_ac = f"user:{user_id}:access_count"
-        access_count = redis_client.incr(key_ac)
-        redis_client.expire(key_ac, 60)
-        if access_count > 30:
-            score -= 30
-            
-        if request_context.get("sensitive_operation"):
-            score -= 10
-            
-        device_fingerprint = self._get_device_fingerprint(request_context)
-        known_device = redis_client.sismember(f"user:{user_id}:devices", device_fingerprint)
-        if not known_device:
-            score -= 25
-            redis_client.sadd(f"user:{user_id}:devices", device_fingerprint)
-            
-        redis_client.set(f"user:{user_id}:last_ip", current_ip)
-        
-        return max(0, min(100, score))
-    
-    def calculate_combined_trust_score(self, user_id, request_context):
-        network_score = self.calculate_network_trust_score(user_id, request_context)
-        app_score = self.calculate_app_trust_score(user_id, request_context)
-        
-        TRUST_SCORE.labels(layer="network").observe(network_score)
-        TRUST_SCORE.labels(layer="application").observe(app_score)
-        
-        if USE_ZITI:
-            combined_score = (network_score * 0.3 + app_score * 0.7)
-        else:
-            combined_score = app_score
-            
-        combined_score = int(combined_score)
-        redis_client.set(f"user:{user_id}:trust_score", combined_score)
-        TRUST_SCORE.labels(layer="combined").observe(combined_score)
-        
-        return combined_score, network_score, app_score
-    
-    def _get_device_fingerprint(self, context):
-        raw = "|".join([
-            context.get("user_agent", ""),
-            context.get("accept_language", ""),
-            context.get("platform", ""),
-            context.get("timezone", ""),
-        ])
-        return hashlib.sha256(raw.encode()).hexdigest()
-    
-    def enforce_policy_with_layers(self, user_id, combined_score, network_score, app_score, resource):
-        if combined_score >= 80:
-            policy = {
-                "action": "allow",
-                "restrictions": None,
-                "monitoring_level": "normal",
-                "reason": "high_trust_both_layers" if network_score > 70 else "high_trust_app_layer",
-            }
-        elif combined_score >= 60:
-            # 如果网络层分数高但应用层分数低，给予限制访问
-            if network_score >= 80 and app_score < 60:
-                reason = "network_trusted_app_suspicious"
-            else:
-                reason = "mid_risk_readonly"
-                
-            policy = {
-                "action": "allow_restricted",
-                "restrictions": ["read_only"],
-                "monitoring_level": "enhanced",
-                "reason": reason,
-            }
-        elif combined_score >= 40:
-            policy = {
-                "action": "require_mfa",
-                "restrictions": ["minimal_access"],
-                "monitoring_level": "strict",
-                "reason": "low_trust_stepup_required",
-            }
-        else:
-            policy = {
-                "action": "deny",
-                "restrictions": ["blocked"],
-                "monitoring_level": "alert",
-                "reason": "very_low_trust_blocked",
-            }
-            
-        self._log_enhanced_decision(user_id, combined_score, network_score, app_score, resource, policy)
-        return policy
-    
-    def _log_enhanced_decision(self, user_id, combined_score, network_score, app_score, resource, decision):
-        entry = {
-            "timestamp": datetime.now().isoformat(),
-            "user_id": user_id,
-            "trust_score": combined_score,
-            "network_score": network_score,
-            "app_score": app_score,
-            "resource": resource,
-            "decision": decision.get("action", ""),
-            "reason": decision.get("reason", ""),
-            "via_ziti": USE_ZITI,
-        }
-        redis_client.lpush("access_logs", json.dumps(entry))
-        redis_client.ltrim("access_logs", 0, 999)
-
-gateway = EnhancedZeroTrustGateway()
-
 #路由
 @app.route("/")
 def index():
@@ -210,7 +95,7 @@ def index():
 
 @app.route("/metrics")
 def metrics():
-    return generate_latest(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+    return server.metrics_payload(risk_tracker), 200, {"Content-Type": CONTENT_TYPE_LATEST}
 
 @app.route("/healthz")
 def healthz():
@@ -219,17 +104,19 @@ def healthz():
         status = {
             "status": "ok",
             "mode": "openziti" if USE_ZITI else "standard",
-            "ziti_enabled": ziti_enabled
+            "ziti_enabled": ziti_enabled,
+            "redis_breaker": redis_guard.breaker.state_name,
         }
         return jsonify(status), 200
     except Exception as e:
-        return jsonify({"status": "err", "error": str(e)}), 500
+        return jsonify({"status": "err", "error": str(e), "redis_breaker": redis_guard.breaker.state_name}), 500
 
 @app.route("/api/access-request", methods=["POST"])
+@stage_timer.request
+@redis_guard.request
 def access_request():
     """增强版零信任访问请求"""
     started = time.time()
-    ensure_csv_header(CSV_PATH)
     
     data = request.get_json(force=True, silent=True) or {}
     token = read_bearer_token(request, data.get("token"))
@@ -238,96 +125,125 @@ def access_request():
         return jsonify({"error": "需要认证令牌"}), 401
         
     try:
-        user_info = jwt.decode(token, options={"verify_signature": False})
+        with stage_timer.stage("token_decode"):
+            user_info = token_verifier.decode(token)
         user_id = user_info.get("preferred_username", "unknown")
         roles = user_info.get("realm_access", {}).get("roles", [])
     except Exception as e:
         return jsonify({"error": f"令牌无效: {str(e)}"}), 401
         
 
-    request_context = {
-        "ip": get_client_ip(request),
-        "user_agent": request.headers.get("User-Agent", ""),
-        "accept_language": request.headers.get("Accept-Language", ""),
-        "sensitive_operation": (data.get("resource", "") or "/").startswith("/admin"),
-        "platform": data.get("platform", ""),
-        "timezone": data.get("timezone", ""),
-        # OpenZiti相关
-        "via_ziti": request.headers.get("X-Via-Ziti", "false") == "true" or USE_ZITI,
-        "ziti_identity": get_ziti_identity(request),
-    }
+    request_context = gateway.build_request_context(request.headers, request.remote_addr, data, claims=user_info)
     
     # 计算多层信任分
     combined_score, network_score, app_score = gateway.calculate_combined_trust_score(user_id, request_context)
     resource = data.get("resource", "/")
-    policy = gateway.enforce_policy_with_layers(user_id, combined_score, network_score, app_score, resource)
+    grant = gateway.step_up_grant(user_id, combined_score, network_score, app_score, resource, request_context)
+    policy = gateway.enforce_policy_with_layers(user_id, combined_score, network_score, app_score, resource,
+                                                degraded=request_context["degraded"], grant=grant)
     
     # 指标记录
     LATENCY.observe(time.time() - started)
-    layer = "ziti" if USE_ZITI else "standard"
-    DECISIONS.labels(policy["action"], policy.get("reason", "unknown"), layer).inc()
-    
-    # CSV记录
-    try:
-        with open(CSV_PATH, "a", newline="", encoding="utf-8") as f:
-            w = csv.writer(f)
-            w.writerow([
-                datetime.now().isoformat(), 
-                user_id, 
-                combined_score,
-                network_score,
-                app_score,
-                resource, 
-                policy["action"], 
-                policy.get("reason", ""),
-                USE_ZITI
-            ])
-    except Exception:
-        pass
-        
-    response = {
-        "user_id": user_id,
-        "roles": roles,
-        "trust_score": combined_score,
-        "network_trust_score": network_score,
-        "app_trust_score": app_score,
-        "access_decision": policy["action"],
-        "restrictions": policy.get("restrictions", []),
-        "monitoring_level": policy["monitoring_level"],
-        "reason": policy.get("reason", ""),
-        "via_ziti": USE_ZITI,
-        "timestamp": datetime.now().isoformat(),
-    }
-    
-    # 返回码
-    action = policy["action"]
-    if action == "deny":
-        code = 403
-    elif action == "require_mfa":
-        code = 428
-    else:
-        code = 200
-        
-    return jsonify(response), code
+    response, code = gateway.decision_response(user_id, roles, resource, policy, combined_score, network_score,
+                                               app_score, ip=request_context["ip"])
+    if traffic_capture is not None:
+        traffic_capture.record(request.headers, request_context["ip"], data, user_info, policy["action"],
+                               combined_score, code, time.time() - started, started)
+    with stage_timer.stage("serialize"):
+        body = jsonify(response)
+    return body, code
+
+@app.route("/api/access-request/batch", methods=["POST"])
+@stage_timer.request
+@redis_guard.request
+def access_request_batch():
+    """批量访问决策：请求体为条目数组（或 {"items": [...]}），返回等长的结果数组"""
+    data = request.get_json(force=True, silent=True)
+    items = data.get("items") if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return jsonify({"error": "请求体必须是条目数组"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"批量条目过多（上限 {BATCH_MAX_ITEMS}）"}), 413
+
+    results = [None] * len(items)
+    claims_by_token = {}
+    pending = []  # (index, user_id, roles, request_context, resource)
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = {"error": "条目格式无效", "status": 400}
+            continue
+        token = (item.get("token") or "").strip()
+        if not token:
+            results[i] = {"error": "需要认证令牌", "status": 401}
+            continue
+        # 同一令牌在整批中只验证一次
+        if token not in claims_by_token:
+            try:
+                with stage_timer.stage("token_decode"):
+                    claims_by_token[token] = token_verifier.decode(token)
+            except Exception as e:
+                claims_by_token[token] = e
+        user_info = claims_by_token[token]
+        if isinstance(user_info, Exception):
+            results[i] = {"error": f"令牌无效: {str(user_info)}", "status": 401}
+            continue
+
+        headers = Headers({str(k): str(v) for k, v in (item.get("headers") or {}).items()})
+        pending.append((
+            i,
+            user_info.get("preferred_username", "unknown"),
+            user_info.get("realm_access", {}).get("roles", []),
+            gateway.build_request_context(headers, request.remote_addr, item, claims=user_info),
+            item.get("resource", "/"),
+        ))
+
+    decisions = gateway.decide_batch([(user_id, ctx, resource) for _, user_id, _, ctx, resource in pending])
+    for (i, user_id, roles, ctx, resource), (policy, combined_score, network_score, app_score) in zip(pending, decisions):
+        response, code = gateway.decision_response(user_id, roles, resource, policy, combined_score, network_score,
+                                                   app_score, ip=ctx["ip"])
+        response["status"] = code
+        results[i] = response
+
+    with stage_timer.stage("serialize"):
+        body = jsonify({"results": results})
+    return body, 200
 
 @app.route("/api/user-behavior/<user_id>", methods=["GET"])
 def get_user_behavior(user_id):
-    trust_score = redis_client.get(f"user:{user_id}:trust_score") or 100
-    last_ip = redis_client.get(f"user:{user_id}:last_ip") or "unknown"
-    access_count = redis_client.get(f"user:{user_id}:access_count") or 0
-    
-    devices = list(redis_client.smembers(f"user:{user_id}:devices"))
+    # 单次往返读取：分数与最近IP在同一哈希中，设备数用 ZCOUNT（只计未过期设备）
+    state = trust_store.read(user_id)
+    trust_score = state.trust_score
     
     return jsonify({
         "user_id": user_id,
-        "current_trust_score": int(trust_score),
-        "last_known_ip": last_ip,
-        "recent_access_count": int(access_count),
-        "known_devices": len(devices),
-        "risk_level": "high" if int(trust_score) < 60 else "medium" if int(trust_score) < 80 else "low",
+        "current_trust_score": trust_score,
+        "last_known_ip": state.last_ip or "unknown",
+        "recent_access_count": state.access_count,
+        "known_devices": state.devices,
+        "risk_level": "high" if trust_score < 60 else "medium" if trust_score < 80 else "low",
         "ziti_enabled": USE_ZITI
     })
 
+@app.route("/api/access-logs", methods=["GET"])
+def get_access_logs():
+    """审计日志分页查询（游标 + 时间/用户/动作/原因过滤）"""
+    try:
+        page = access_log.query(**query_args(request.args))
+    except ValueError as e:
+        return jsonify({"error": f"查询参数无效: {str(e)}"}), 400
+    return jsonify(page)
+
+@app.route("/api/admin/redis-memory", methods=["GET"])
+def redis_memory():
+    """按类别统计键数与估算字节数，以及占用内存最多的用户（抽样 MEMORY USAGE）"""
+    try:
+        report = retention.memory_report(background_client, sample=float(request.args.get("sample", 0.1)),
+                                         top=int(request.args.get("top", 10)),
+                                         max_keys=int(request.args.get("max_keys", 100000)))
+    except ValueError as e:
+        return jsonify({"error": f"查询参数无效: {str(e)}"}), 400
+    return jsonify(report)
+
 @app.route("/api/simulate-ziti", methods=["POST"])
 def simulate_ziti_connection():
     """模拟OpenZiti连接（测试用）"""
@@ -353,4 +269,5 @@ if __name__ == "__main__":
     print(f"   Prom指标:      /metrics")
     print(f"   OpenZiti:      {'✅ 已启用' if USE_ZITI else '❌ 未启用'}")
     
-    app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
+    # 默认以多进程生产服务器运行（见 server.py），SERVER_MODE=dev 使用Flask开发服务器
+    server.run("app_ziti", app, port)
\ No newline at end of file
@@ -0,0 +1,339 @@
+"""Per-user behavioral baseline, updated incrementally.
+
+For each user the gateway keeps one fixed-size record of exponentially
+decayed counters (half-life ``BASELINE_HALF_LIFE``):
+
+    requests per hour of the day     24 counters
+    requests per resource            32 hashed slots (first path segment)
+    requests per source network      32 hashed slots (IPv4 /24, IPv6 /48)
+    request rate                     EWMA over ``BASELINE_RATE_WINDOW`` seconds,
+                                     and its decayed mean at request times
+
+Decay uses a landmark (forward decay): a request adds ``2^((t - L) / H)``,
+so an update touches a handful of counters and ratios between counters
+need no decay at all.  The landmark moves every few half-lives, which
+rescales the record once.
+
+Once a user has ``BASELINE_MIN_REQUESTS`` requests, a request is scored
+against the record before it is added: an hour, resource or network with
+less than ``BASELINE_RARE_SHARE`` of the user's traffic, or a current rate
+above ``BASELINE_RATE_FACTOR`` times the usual one, each cost trust points.
+Until then the fixed night-time rule applies.
+
+Scoring and updates touch only process memory.  Each process keeps the
+records of its ``BASELINE_USERS`` most recent users and the requests it
+added since the last flush; every ``BASELINE_FLUSH`` seconds a script adds
+those into the user's record in Redis (``user:{<id>}:baseline``, 384
+bytes, expiring after ``RETAIN_USER_STATE`` idle seconds) and the merged
+record replaces the local copy, so workers and replicas converge on one
+baseline without a round trip on the request path.
+
+    BASELINE_MIN_REQUESTS=50 BASELINE_RARE_SHARE=0.02 BASELINE_FLUSH=5 python app_ziti.py
+    python behavior_baseline.py show alice
+"""
+import os
+import math
+import time
+import zlib
+import socket
+import struct
+import argparse
+import threading
+from array import array
+from collections import OrderedDict, namedtuple
+
+import redis
+
+import redis_layout
+from redis_layout import baseline_key, is_cluster
+from retention import RETAIN_USER_STATE
+
+BASELINE_HALF_LIFE = int(os.getenv("BASELINE_HALF_LIFE", str(14 * 86400)))
+BASELINE_RATE_WINDOW = int(os.getenv("BASELINE_RATE_WINDOW", "300"))
+BASELINE_MIN_REQUESTS = int(os.getenv("BASELINE_MIN_REQUESTS", "50"))
+BASELINE_RARE_SHARE = float(os.getenv("BASELINE_RARE_SHARE", "0.02"))
+BASELINE_RATE_FACTOR = float(os.getenv("BASELINE_RATE_FACTOR", "5"))
+BASELINE_RATE_MIN = float(os.getenv("BASELINE_RATE_MIN", "10"))
+BASELINE_USERS = int(os.getenv("BASELINE_USERS", "10000"))
+BASELINE_FLUSH = float(os.getenv("BASELINE_FLUSH", "5"))
+
+# Trust points per deviation
+PENALTY_UNUSUAL_HOUR = int(os.getenv("BASELINE_PENALTY_HOUR", "10"))
+PENALTY_UNUSUAL_RESOURCE = int(os.getenv("BASELINE_PENALTY_RESOURCE", "10"))
+PENALTY_UNUSUAL_NETWORK = int(os.getenv("BASELINE_PENALTY_NETWORK", "10"))
+PENALTY_RATE_SPIKE = int(os.getenv("BASELINE_PENALTY_RATE", "15"))
+
+# Record layout: two doubles (landmark and rate timestamp, epoch seconds),
+# then float counters; stored little-endian as "<2d92f".
+LANDMARK, RATE_TS, TOTAL, COUNT, RATE_FAST, RATE_SUM = range(6)
+HOURS, RESOURCE_SLOTS, NETWORK_SLOTS = 24, 32, 32
+HOUR_BASE = 6
+RESOURCE_BASE = HOUR_BASE + HOURS
+NETWORK_BASE = RESOURCE_BASE + RESOURCE_SLOTS
+FIELDS = NETWORK_BASE + NETWORK_SLOTS
+RECORD = struct.Struct(f"<2d{FIELDS - 2}f")
+LANDMARK_HALF_LIVES = 8  # weights stay below 2^8 before the landmark moves
+
+# warm: enough history to score against; penalty: sum of the deviations' costs
+BaselineSignals = namedtuple("BaselineSignals", ["warm", "unusual_hour", "unusual_resource", "unusual_network",
+                                                 "rate_spike", "penalty"])
+COLD = BaselineSignals(False, False, False, False, False, 0)
+
+# KEYS: baseline  ARGV: record added since the last flush, ttl_ms
+# Same arithmetic as _merge below; returns the merged record.
+MERGE_LUA = """
+local FIELDS, HALF_LIFE, RATE_WINDOW = __FIELDS__, __HALF_LIFE__, __RATE_WINDOW__
+local FMT = '<dd' .. string.rep('f', FIELDS - 2)
+local function load(s)
+    local r = {struct.unpack(FMT, s)}
+    r[FIELDS + 1] = nil
+    return r
+end
+local d = load(ARGV[1])
+local cur = redis.call('GET', KEYS[1])
+if cur and #cur == #ARGV[1] then
+    local r = load(cur)
+    if r[1] > d[1] then r, d = d, r end
+    local f = 2 ^ ((r[1] - d[1]) / HALF_LIFE)
+    local ts = math.max(r[2], d[2])
+    d[5] = d[5] * math.exp((d[2] - ts) / RATE_WINDOW) + r[5] * math.exp((r[2] - ts) / RATE_WINDOW)
+    d[2] = ts
+    d[3] = d[3] + r[3] * f
+    d[4] = d[4] + r[4]
+    for i = 6, FIELDS do d[i] = d[i] + r[i] * f end
+end
+local out = struct.pack(FMT, unpack(d))
+if tonumber(ARGV[2]) > 0 then
+    redis.call('SET', KEYS[1], out, 'PX', ARGV[2])
+else
+    redis.call('SET', KEYS[1], out)
+end
+return out
+"""
+
+
+def _slot(text, slots):
+    return zlib.crc32(text.encode()) % slots
+
+
+def resource_slot(resource):
+    """Slot of the resource's first path segment."""
+    return _slot((resource or "/").lstrip("/").split("/", 1)[0], RESOURCE_SLOTS)
+
+
+def network_slot(ip):
+    """Slot of the IPv4 /24 or IPv6 /48 holding ``ip`` (other values as-is)."""
+    ip = ip or ""
+    if ":" in ip:
+        try:
+            return _slot(socket.inet_pton(socket.AF_INET6, ip.split("%", 1)[0])[:6].hex(), NETWORK_SLOTS)
+        except OSError:
+            pass
+    elif ip.count(".") == 3:
+        return _slot(ip.rsplit(".", 1)[0], NETWORK_SLOTS)
+    return _slot(ip, NETWORK_SLOTS)
+
+
+class BehaviorBaseline:
+    def __init__(self, client, half_life=BASELINE_HALF_LIFE, rate_window=BASELINE_RATE_WINDOW,
+                 min_requests=BASELINE_MIN_REQUESTS, rare_share=BASELINE_RARE_SHARE,
+                 rate_factor=BASELINE_RATE_FACTOR, rate_min=BASELINE_RATE_MIN, max_users=BASELINE_USERS,
+                 flush_interval=BASELINE_FLUSH, ttl=RETAIN_USER_STATE):
+        self.client = client
+        self.cluster = is_cluster(client)
+        self.half_life = half_life
+        self.rate_window = rate_window
+        self.min_requests = min_requests
+        self.rare_share = rare_share
+        self.rate_factor = rate_factor
+        self.rate_min = rate_min
+        self.max_users = max_users
+        self.flush_interval = flush_interval
+        self.ttl_ms = max(0, ttl) * 1000
+        self._records = OrderedDict()  # user -> array("d"), least recently used first
+        self._pending = {}             # user -> array("d") added since the last flush
+        self._lock = threading.Lock()
+        self._merge_script = client.register_script(MERGE_LUA
+                                                    .replace("__FIELDS__", str(FIELDS))
+                                                    .replace("__HALF_LIFE__", str(half_life))
+                                                    .replace("__RATE_WINDOW__", str(rate_window)))
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls):
+        """``None`` if ``BEHAVIOR_BASELINE=false``.
+
+        Records are binary, so the baseline has its own connection without
+        response decoding.
+        """
+        if os.getenv("BEHAVIOR_BASELINE", "true").lower() != "true":
+            return None
+        return cls(redis_layout.connect(decode_responses=False))
+
+    # ---------- records ----------
+    def _new(self, now):
+        record = array("d", bytes(8 * FIELDS))
+        record[LANDMARK] = now - now % (LANDMARK_HALF_LIVES * self.half_life)
+        record[RATE_TS] = now
+        return record
+
+    def _rebase(self, record, landmark):
+        f = 2 ** ((record[LANDMARK] - landmark) / self.half_life)
+        record[TOTAL] *= f
+        for i in range(RATE_SUM, FIELDS):
+            record[i] *= f
+        record[LANDMARK] = landmark
+
+    def _fast(self, record, now):
+        """The rate EWMA's decayed count at ``now``."""
+        if now <= record[RATE_TS]:
+            return record[RATE_FAST]
+        return record[RATE_FAST] * math.exp((record[RATE_TS] - now) / self.rate_window)
+
+    def _add(self, record, now, w, rate, hour, rslot, nslot):
+        """Add one request of weight ``w``; ``rate`` is the user's current rate."""
+        record[RATE_FAST] = self._fast(record, now) + 1
+        record[RATE_TS] = max(record[RATE_TS], now)
+        record[TOTAL] += w
+        record[COUNT] += 1
+        record[RATE_SUM] += w * rate
+        record[HOUR_BASE + hour] += w
+        record[RESOURCE_BASE + rslot] += w
+        record[NETWORK_BASE + nslot] += w
+
+    def _merge(self, into, other):
+        if other[LANDMARK] > into[LANDMARK]:
+            self._rebase(into, other[LANDMARK])
+        f = 2 ** ((other[LANDMARK] - into[LANDMARK]) / self.half_life)
+        ts = max(into[RATE_TS], other[RATE_TS])
+        into[RATE_FAST] = self._fast(into, ts) + self._fast(other, ts)
+        into[RATE_TS] = ts
+        into[TOTAL] += other[TOTAL] * f
+        into[COUNT] += other[COUNT]
+        for i in range(RATE_SUM, FIELDS):
+            into[i] += other[i] * f
+
+    def _signals(self, record, fast, hour, rslot, nslot):
+        if record[COUNT] < self.min_requests or record[TOTAL] <= 0:
+            return COLD
+        rare = self.rare_share * record[TOTAL]
+        hours = record[HOUR_BASE + (hour - 1) % HOURS] + record[HOUR_BASE + hour] + record[HOUR_BASE + (hour + 1) % HOURS]
+        usual_rate = record[RATE_SUM] / record[TOTAL]
+        unusual_hour = hours < rare
+        unusual_resource = record[RESOURCE_BASE + rslot] < rare
+        unusual_network = record[NETWORK_BASE + nslot] < rare
+        rate_spike = fast >= self.rate_min and fast / self.rate_window > self.rate_factor * usual_rate
+        penalty = (PENALTY_UNUSUAL_HOUR * unusual_hour + PENALTY_UNUSUAL_RESOURCE * unusual_resource
+                   + PENALTY_UNUSUAL_NETWORK * unusual_network + PENALTY_RATE_SPIKE * rate_spike)
+        return BaselineSignals(True, unusual_hour, unusual_resource, unusual_network, rate_spike, penalty)
+
+    # ---------- request path ----------
+    def update(self, user_id, resource, ip, now=None):
+        """Score a request against ``user_id``'s baseline, then add it (O(1), no Redis)."""
+        now = time.time() if now is None else now
+        hour = time.localtime(now).tm_hour
+        rslot, nslot = resource_slot(resource), network_slot(ip)
+        with self._lock:
+            record = self._records.get(user_id)
+            if record is None:
+                record = self._records[user_id] = self._new(now)
+                if len(self._records) > self.max_users:
+                    self._records.popitem(last=False)
+            else:
+                self._records.move_to_end(user_id)
+            # Decayed request count over the rate window, this request included
+            fast = self._fast(record, now) + 1
+            signals = self._signals(record, fast, hour, rslot, nslot)
+
+            pending = self._pending.get(user_id)
+            if pending is None:
+                pending = self._pending[user_id] = self._new(now)
+            for r in (record, pending):
+                if now - r[LANDMARK] >= LANDMARK_HALF_LIVES * self.half_life:
+                    self._rebase(r, now - now % (LANDMARK_HALF_LIVES * self.half_life))
+                self._add(r, now, 2 ** ((now - r[LANDMARK]) / self.half_life), fast / self.rate_window,
+                          hour, rslot, nslot)
+        return signals
+
+    # ---------- flush ----------
+    def flush(self):
+        """Add the pending requests to Redis and refresh the local records."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        users = list(pending)
+        args = [[RECORD.pack(*pending[u]), self.ttl_ms] for u in users]
+        if self.cluster:
+            # Cluster pipelines cannot carry EVALSHA; each user's record goes to its own node
+            merged = [self._merge_script(keys=[baseline_key(u)], args=a) for u, a in zip(users, args)]
+        else:
+            pipe = self.client.pipeline(transaction=False)
+            for u, a in zip(users, args):
+                self._merge_script(keys=[baseline_key(u)], args=a, client=pipe)
+            merged = pipe.execute()
+        with self._lock:
+            for user_id, data in zip(users, merged):
+                if user_id not in self._records:
+                    continue
+                record = array("d", RECORD.unpack(data))
+                newer = self._pending.get(user_id)
+                if newer is not None:
+                    self._merge(record, newer)
+                self._records[user_id] = record
+        return len(users)
+
+    def read(self, user_id):
+        """The user's merged record from Redis as an ``array``, or ``None``."""
+        data = self.client.get(baseline_key(user_id))
+        return array("d", RECORD.unpack(data)) if data and len(data) == RECORD.size else None
+
+    # ---------- background flush ----------
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="behavior-baseline-flush", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+        try:
+            self.flush()
+        except (redis.exceptions.RedisError, OSError):
+            pass
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except (redis.exceptions.RedisError, OSError):
+                # The requests of this interval are dropped; the baseline is a statistic
+                pass
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Behavioral baseline tools")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("show", help="print a user's baseline").add_argument("user_id")
+    args = ap.parse_args()
+
+    baseline = BehaviorBaseline(redis_layout.connect(decode_responses=False))
+    record = baseline.read(args.user_id)
+    if record is None:
+        print("no baseline")
+        return
+    total = record[TOTAL] or 1.0
+    now = time.time()
+    print(f"requests {record[COUNT]:.0f}  current rate {baseline._fast(record, now) / baseline.rate_window * 60:.2f}/min"
+          f"  usual rate {record[RATE_SUM] / total * 60:.2f}/min")
+    print("hours    " + " ".join(f"{h:02d}:{record[HOUR_BASE + h] / total:.2f}" for h in range(HOURS)
+                                 if record[HOUR_BASE + h] / total >= 0.005))
+    for name, base, slots in (("resource", RESOURCE_BASE, RESOURCE_SLOTS), ("network", NETWORK_BASE, NETWORK_SLOTS)):
+        shares = sorted(((record[base + i] / total, i) for i in range(slots)), reverse=True)
+        print(f"{name:<9}" + " ".join(f"#{i}:{s:.2f}" for s, i in shares if s >= 0.005))
+
+
+if __name__ == "__main__":
+    main()
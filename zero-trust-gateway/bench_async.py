@@ -0,0 +1,125 @@
+# bench_async.py — Requests/sec and p99 of /api/access-request under many concurrent connections
+#
+# Start the gateway under test first, e.g.
+#   python app_ziti.py                       (Flask, port 5000)
+#   python app_async.py                      (ASGI,  port 5000)
+# with JWKS_URL pointing at `python jwks_dev.py serve` (or JWT_VERIFY=false), then
+#   python bench_async.py --url http://localhost:5000/api/access-request -c 1000 -d 20
+import os, time, json, asyncio, argparse
+from urllib.parse import urlsplit
+
+from jwks_dev import load_or_create_key, mint_token
+
+USERNAME = os.getenv("KC_USERNAME", "alice")
+
+
+def make_token(username=USERNAME):
+    """RS256 token from the dev key; run the gateway with JWKS_URL at jwks_dev.py."""
+    return mint_token(load_or_create_key(), username)
+
+
+class HTTPConnection:
+    """Minimal HTTP/1.1 keep-alive client over asyncio streams."""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method, path, headers=None, body=b""):
+        if self.writer is None:
+            await self._connect()
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", f"Content-Length: {len(body)}"]
+        lines += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed")
+        status = int(status_line.split()[1])
+        length, close = 0, status_line.startswith(b"HTTP/1.0")
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            name = name.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "connection":
+                close = value.strip().lower() == "close"
+        payload = await self.reader.readexactly(length) if length else b""
+        if close:
+            await self.close()
+        return status, payload
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+async def worker(url, headers, body, deadline, latencies, statuses):
+    u = urlsplit(url)
+    conn = HTTPConnection(u.hostname, u.port or 80)
+    while time.perf_counter() < deadline:
+        t0 = time.perf_counter()
+        try:
+            status, _ = await conn.request("POST", u.path, headers, body)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            await conn.close()
+            status = "ERR"
+        latencies.append(time.perf_counter() - t0)
+        statuses[status] = statuses.get(status, 0) + 1
+    await conn.close()
+
+
+async def run(url, concurrency, duration, resource, token):
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    body = json.dumps({"resource": resource}).encode()
+    latencies, statuses = [], {}
+    deadline = time.perf_counter() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(url, headers, body, deadline, latencies, statuses) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "url": url,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "statuses": statuses,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", action="append", help="gateway endpoint; repeat to compare (e.g. Flask vs ASGI)")
+    ap.add_argument("-c", "--concurrency", type=int, default=200)
+    ap.add_argument("-d", "--duration", type=float, default=10.0)
+    ap.add_argument("--resource", default="/finance/report")
+    ap.add_argument("--token", default=os.getenv("TOKEN") or None)
+    args = ap.parse_args()
+
+    token = args.token or make_token()
+    urls = args.url or ["http://localhost:5000/api/access-request"]
+    print(f"{'url':<45}{'conns':>7}{'reqs':>9}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}  statuses")
+    for url in urls:
+        r = asyncio.run(run(url, args.concurrency, args.duration, args.resource, token))
+        print(f"{r['url']:<45}{r['concurrency']:>7}{r['requests']:>9}{r['rps']:>10.0f}"
+              f"{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}  {r['statuses']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# bench_batch.py — Decisions/sec: N single /api/access-request calls vs one /api/access-request/batch
+#
+#   python bench_batch.py --base http://localhost:5000 --items 100 --rounds 20
+import os, time, json, asyncio, argparse
+from urllib.parse import urlsplit
+
+from bench_async import HTTPConnection, make_token
+
+USERNAME = os.getenv("KC_USERNAME", "alice")
+
+
+def build_items(n, users):
+    tokens = [make_token(f"{USERNAME}{u}" if users > 1 else USERNAME) for u in range(users)]
+    return [{
+        "token": tokens[i % users],
+        "resource": "/admin/panel" if i % 5 == 0 else "/finance/report",
+        "platform": "Linux",
+        "timezone": "UTC",
+        "headers": {"User-Agent": f"bench-agent/{i % 3}", "Accept-Language": "en-US"},
+    } for i in range(n)]
+
+
+async def run_singles(conn, path, items):
+    for item in items:
+        headers = {"Authorization": f"Bearer {item['token']}", "Content-Type": "application/json", **item["headers"]}
+        body = json.dumps({k: item[k] for k in ("resource", "platform", "timezone")}).encode()
+        await conn.request("POST", path, headers, body)
+
+
+async def run_batch(conn, path, items):
+    status, payload = await conn.request("POST", path + "/batch", {"Content-Type": "application/json"},
+                                         json.dumps(items).encode())
+    if status != 200:
+        raise RuntimeError(f"batch endpoint returned {status}: {payload[:200]!r}")
+
+
+async def main_async(args):
+    u = urlsplit(args.base)
+    conn = HTTPConnection(u.hostname, u.port or 80)
+    path = "/api/access-request"
+    items = build_items(args.items, args.users)
+
+    rows = []
+    for name, fn in (("single", run_singles), ("batch", run_batch)):
+        await fn(conn, path, items)  # warm-up
+        t0 = time.perf_counter()
+        for _ in range(args.rounds):
+            await fn(conn, path, items)
+        elapsed = time.perf_counter() - t0
+        rows.append((name, args.items * args.rounds / elapsed, elapsed / args.rounds * 1000))
+    await conn.close()
+
+    print(f"{'mode':<8}{'decisions/s':>14}{'ms per ' + str(args.items):>16}")
+    for name, dps, ms in rows:
+        print(f"{name:<8}{dps:>14.0f}{ms:>16.1f}")
+    print(f"speed-up: {rows[1][1] / rows[0][1]:.1f}x")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base", default="http://localhost:5000")
+    ap.add_argument("--items", type=int, default=100)
+    ap.add_argument("--rounds", type=int, default=20)
+    ap.add_argument("--users", type=int, default=1, help="distinct synthetic users in each batch")
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
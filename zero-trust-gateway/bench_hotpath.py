@@ -0,0 +1,232 @@
+# bench_hotpath.py — Micro-benchmarks of the access-decision hot path, stage by stage
+#
+#   pip install -r requirements-dev.txt                   # fakeredis, for the in-memory Redis
+#   python bench_hotpath.py                               # both gateways, in-memory Redis
+#   python bench_hotpath.py --rtt-ms 0.3 --json out/hotpath.json
+#   python bench_hotpath.py --live --variant app_ziti     # against REDIS_HOST:REDIS_PORT
+#   python bench_hotpath.py --compare out/hotpath_base.json --json out/hotpath.json
+#
+# Each gateway runs in its own subprocess (their Prometheus metrics share names).
+# Per stage: ops/s, p50/p99, Redis round trips per call, and from a separate
+# tracemalloc pass the peak bytes allocated during one call and the memory
+# blocks still held afterwards.  --json writes everything for diffing between
+# commits; --compare prints the change against an earlier file and exits 1 on
+# a regression beyond --threshold.
+import os, sys, json, time, argparse, platform, statistics, subprocess, tempfile, tracemalloc
+
+VARIANTS = ("app", "app_ziti")
+RESOURCES = ("/", "/finance/report", "/admin/panel", "/hr/records")
+
+
+def time_stage(fn, n, counter, warmup):
+    for i in range(warmup):
+        fn(i)
+    counter.count = 0
+    samples = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - t0)
+    round_trips = counter.count / n
+    samples.sort()
+    return {
+        "ops_per_s": n / sum(samples),
+        "p50_us": statistics.median(samples) * 1e6,
+        "p99_us": samples[max(0, int(len(samples) * 0.99) - 1)] * 1e6,
+        "round_trips": round_trips,
+    }
+
+
+def alloc_stage(fn, n):
+    """Mean peak bytes allocated while one call runs, and blocks retained per call."""
+    tracemalloc.start()
+    try:
+        peaks = []
+        blocks = sys.getallocatedblocks()
+        for i in range(n):
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fn(i)
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        retained = (sys.getallocatedblocks() - blocks) / n
+    finally:
+        tracemalloc.stop()
+    return {"alloc_peak_bytes": statistics.mean(peaks), "blocks_retained": retained}
+
+
+def stages(variant, gateway_module, token, users):
+    """``[(name, fn(i))]`` for one gateway, cheapest stage first."""
+    gw = gateway_module.gateway
+    policy_store = gateway_module.policy_store
+    client = gateway_module.app.test_client()
+    headers = {"Authorization": f"Bearer {token}", "User-Agent": "bench-hotpath/1.0", "Accept-Language": "en"}
+
+    def ctx(i):
+        return {"ip": f"10.1.{i % users % 250}.1", "user_agent": "bench-hotpath/1.0", "accept_language": "en",
+                "resource": RESOURCES[i % len(RESOURCES)],
+                "sensitive_operation": policy_store.is_sensitive(RESOURCES[i % len(RESOURCES)])}
+
+    contexts = [ctx(i) for i in range(users)]
+
+    def user(i):
+        return f"hot-{i % users}"
+
+    out = [
+        ("fingerprint", lambda i: gw._get_device_fingerprint(contexts[i % users])),
+        ("policy_lookup", lambda i: policy_store.decide(RESOURCES[i % len(RESOURCES)], i % 101)),
+    ]
+    if variant == "app":
+        out += [
+            ("trust_score", lambda i: gw.calculate_trust_score(user(i), contexts[i % users])),
+            ("enforce_policy", lambda i: gw.enforce_zero_trust_policy(user(i), i % 101, RESOURCES[i % len(RESOURCES)])),
+        ]
+    else:
+        out += [
+            ("network_score", lambda i: gw.calculate_network_trust_score(user(i), contexts[i % users])),
+            ("app_score", lambda i: gw.calculate_app_trust_score(user(i), contexts[i % users])),
+            ("combined_score", lambda i: gw.calculate_combined_trust_score(user(i), contexts[i % users])),
+            ("enforce_policy", lambda i: gw.enforce_policy_with_layers(user(i), i % 101, 80, i % 101,
+                                                                       RESOURCES[i % len(RESOURCES)])),
+        ]
+
+    def handler(i):
+        r = client.post("/api/access-request", json={"resource": RESOURCES[i % len(RESOURCES)]}, headers=headers)
+        if r.status_code >= 500 or r.status_code == 401:
+            raise RuntimeError(f"handler returned {r.status_code}: {r.get_data(as_text=True)[:200]}")
+
+    out.append(("handler", handler))
+    return out
+
+
+def worker(args):
+    """Runs inside the subprocess: import one gateway against the chosen Redis and measure it."""
+    import redis
+    from jwks_dev import load_or_create_key, mint_token, serve_in_background
+    from bench_trust_state import RoundTripCounter
+
+    key = load_or_create_key()
+    _, jwks_url = serve_in_background(key)
+    os.environ["JWKS_URL"] = jwks_url
+    os.environ.setdefault("CSV_PATH", os.path.join(tempfile.mkdtemp(prefix="bench-hotpath-"), "decisions.csv"))
+
+    if args.live:
+        redis.Redis(host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", "6379"))).flushdb()
+    else:
+        import fakeredis
+        server = fakeredis.FakeServer()
+        fake = fakeredis.FakeRedis
+        # The gateways build their client at import time; hand them the in-memory server
+        redis.Redis = lambda *a, **kw: fake(server=server, decode_responses=kw.get("decode_responses", False))
+
+    module = __import__(args.worker)
+    counter = RoundTripCounter(module.redis_client, args.rtt_ms / 1000)
+    token = mint_token(key, "hotpath")
+
+    results = []
+    for name, fn in stages(args.worker, module, token, args.users):
+        if args.stage and name not in args.stage:
+            continue
+        row = {"variant": args.worker, "stage": name}
+        row.update(time_stage(fn, args.n, counter, args.warmup))
+        row.update(alloc_stage(fn, args.alloc_n))
+        results.append(row)
+    module.decision_sink.close()
+    json.dump(results, sys.stdout)
+
+
+def run_variant(variant, args):
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker", variant, "-n", str(args.n),
+           "--warmup", str(args.warmup), "--alloc-n", str(args.alloc_n), "--users", str(args.users),
+           "--rtt-ms", str(args.rtt_ms)]
+    cmd += ["--live"] if args.live else []
+    for s in args.stage or ():
+        cmd += ["--stage", s]
+    proc = subprocess.run(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    if proc.returncode != 0:
+        sys.exit(f"{variant} benchmark failed:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Print the change per stage; returns the rows that regressed by more than ``threshold``."""
+    old = {(r["variant"], r["stage"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\nvs {baseline.get('commit') or 'baseline'}")
+    print(f"{'variant':<10}{'stage':<16}{'ops/s':>10}{'p50':>10}{'rt':>8}{'alloc':>10}")
+    for r in results:
+        o = old.get((r["variant"], r["stage"]))
+        if o is None:
+            print(f"{r['variant']:<10}{r['stage']:<16}{'new':>10}")
+            continue
+        ops = r["ops_per_s"] / o["ops_per_s"] - 1
+        p50 = r["p50_us"] / o["p50_us"] - 1
+        alloc = r["alloc_peak_bytes"] / o["alloc_peak_bytes"] - 1 if o["alloc_peak_bytes"] else 0.0
+        rt = r["round_trips"] - o["round_trips"]
+        flag = ""
+        if ops < -threshold or rt > 0 or alloc > threshold:
+            regressions.append(r)
+            flag = "  <-- regression"
+        print(f"{r['variant']:<10}{r['stage']:<16}{ops:>+10.1%}{p50:>+10.1%}{rt:>+8.2f}{alloc:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=3000, help="timed calls per stage")
+    ap.add_argument("--warmup", type=int, default=200)
+    ap.add_argument("--alloc-n", type=int, default=300, help="calls per stage in the tracemalloc pass")
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--variant", choices=VARIANTS + ("all",), default="all")
+    ap.add_argument("--stage", action="append", help="only this stage (repeatable)")
+    ap.add_argument("--live", action="store_true", help="use REDIS_HOST:REDIS_PORT instead of fakeredis (flushes the db)")
+    ap.add_argument("--rtt-ms", type=float, default=0.0, help="simulated network RTT per round trip")
+    ap.add_argument("--json", help="write results to this file")
+    ap.add_argument("--compare", help="earlier --json output to diff against")
+    ap.add_argument("--threshold", type=float, default=0.10, help="relative change counted as a regression")
+    ap.add_argument("--worker", choices=VARIANTS, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        return worker(args)
+
+    results = []
+    for variant in VARIANTS if args.variant == "all" else (args.variant,):
+        results += run_variant(variant, args)
+
+    print(f"{'variant':<10}{'stage':<16}{'ops/s':>10}{'p50 us':>10}{'p99 us':>10}{'rt/call':>9}{'alloc B':>10}{'blocks':>8}")
+    for r in results:
+        print(f"{r['variant']:<10}{r['stage']:<16}{r['ops_per_s']:>10.0f}{r['p50_us']:>10.1f}{r['p99_us']:>10.1f}"
+              f"{r['round_trips']:>9.2f}{r['alloc_peak_bytes']:>10.0f}{r['blocks_retained']:>8.2f}")
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "backend": "live" if args.live else "fakeredis",
+        "rtt_ms": args.rtt_ms,
+        "n": args.n,
+        "users": args.users,
+        "results": results,
+    }
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if (baseline.get("backend"), baseline.get("rtt_ms")) != (report["backend"], report["rtt_ms"]):
+            print(f"warning: baseline ran on {baseline.get('backend')} with rtt {baseline.get('rtt_ms')} ms", file=sys.stderr)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
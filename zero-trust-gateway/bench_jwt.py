@@ -0,0 +1,59 @@
+# bench_jwt.py — Offline cost of token validation: claims-only vs RS256 (cold, warm, cached)
+#
+#   python bench_jwt.py -n 20000
+import time, argparse
+
+import jwt
+
+from jwks_dev import load_or_create_key, mint_token, serve_in_background
+from jwt_verify import JWKSCache, TokenVerifier
+
+
+def timeit(fn, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=20000)
+    ap.add_argument("--tokens", type=int, default=1000, help="distinct tokens for the cache-hit case")
+    args = ap.parse_args()
+
+    key = load_or_create_key()
+    server, jwks_url = serve_in_background(key)
+    tokens = [mint_token(key, f"user{i}") for i in range(args.tokens)]
+    token = tokens[0]
+    issuer = jwt.decode(token, options={"verify_signature": False})["iss"]
+
+    def verifier(cache_size):
+        return TokenVerifier(JWKSCache(jwks_url), audience="my-app", issuer=issuer, cache_size=cache_size)
+
+    # Cold: first request pays the JWKS fetch
+    t0 = time.perf_counter()
+    verifier(0).decode(token)
+    cold_us = (time.perf_counter() - t0) * 1e6
+
+    no_cache = verifier(0)
+    no_cache.decode(token)
+    cached = verifier(len(tokens))
+    for t in tokens:
+        cached.decode(t)
+    i = iter(range(10 ** 9))
+
+    rows = [
+        ("claims only (old)", timeit(lambda: jwt.decode(token, options={"verify_signature": False}), args.n)),
+        ("rs256 cold (JWKS fetch)", cold_us),
+        ("rs256 warm keys", timeit(lambda: no_cache.decode(token), args.n)),
+        ("rs256 cached claims", timeit(lambda: cached.decode(tokens[next(i) % len(tokens)]), args.n)),
+    ]
+    print(f"{'path':<26}{'us/op':>10}{'ops/s':>12}")
+    for name, us in rows:
+        print(f"{name:<26}{us:>10.1f}{1e6 / us:>12.0f}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# bench_outage.py — Fault injection: decision latency and outcome while Redis goes away and comes back
+#
+#   python bench_outage.py                                  # all gateways, live Redis at REDIS_HOST:REDIS_PORT
+#   python bench_outage.py --variant app_ziti --outage-s 10 --mode refuse
+#   python bench_outage.py --budget-ms 50 --slack-ms 20 --json out/outage.json
+#
+# Each gateway runs in its own subprocess, connected to Redis through a local
+# TCP proxy.  Three phases: healthy, outage (the proxy swallows every byte, or
+# with --mode refuse closes every connection), recovery.  Per phase: p50/p99/max
+# latency, decisions scored without Redis and the actions returned.
+#
+# Exits 1 if the outage p99 exceeds REDIS_BUDGET_MS + --slack-ms, if a request
+# fails, or if after recovery the locally kept updates are not all written back
+# (every decision in the audit log, state of users first seen during the outage
+# in Redis).  Flushes the Redis db.
+import os, sys, json, time, socket, argparse, platform, statistics, subprocess, tempfile, threading
+from collections import Counter
+
+VARIANTS = ("app", "app_ziti", "app_async")
+RESOURCES = ("/", "/finance/report", "/admin/panel", "/hr/records")
+
+
+class FaultProxy:
+    """TCP proxy to Redis that can swallow traffic (``blackhole``) or drop connections (``refuse``)."""
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.mode = "pass"
+        self._conns = []
+        self._lock = threading.Lock()
+        self._sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self._sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def set_mode(self, mode):
+        self.mode = mode
+        if mode == "refuse":
+            with self._lock:
+                conns, self._conns = self._conns, []
+            for s in conns:
+                try:
+                    s.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                s.close()
+
+    def _accept(self):
+        while True:
+            client, _ = self._sock.accept()
+            if self.mode == "refuse":
+                client.close()
+                continue
+            try:
+                server = socket.create_connection(self.upstream)
+            except OSError:
+                client.close()
+                continue
+            with self._lock:
+                self._conns += [client, server]
+            for src, dst in ((client, server), (server, client)):
+                threading.Thread(target=self._pump, args=(src, dst), daemon=True).start()
+
+    def _pump(self, src, dst):
+        try:
+            while True:
+                data = src.recv(65536)
+                if not data:
+                    break
+                if self.mode == "pass":
+                    dst.sendall(data)
+        except OSError:
+            pass
+        for s in (src, dst):
+            try:
+                s.close()
+            except OSError:
+                pass
+
+
+def fallback_total(counter):
+    return sum(s.value for m in counter.collect() for s in m.samples if s.name.endswith("_total"))
+
+
+def percentile(samples, q):
+    return samples[max(0, int(len(samples) * q) - 1)] if samples else 0.0
+
+
+def worker(args):
+    """Runs inside the subprocess: one gateway behind the proxy, through the three phases."""
+    import redis
+
+    host, port = os.getenv("REDIS_HOST", "localhost"), int(os.getenv("REDIS_PORT", "6379"))
+    direct = redis.Redis(host=host, port=port, decode_responses=True)
+    direct.flushdb()
+    proxy = FaultProxy((host, port))
+    os.environ.update({"REDIS_HOST": "127.0.0.1", "REDIS_PORT": str(proxy.port), "REDIS_MODE": "standalone",
+                       "REDIS_BUDGET_MS": str(args.budget_ms), "BREAKER_RESET": str(args.reset_s),
+                       "RECONCILE_INTERVAL": "0.2", "SERVER_MODE": "dev", "TRUSTED_PROXIES": "1"})
+    os.environ.setdefault("CSV_PATH", os.path.join(tempfile.mkdtemp(prefix="bench-outage-"), "decisions.csv"))
+
+    from jwks_dev import load_or_create_key, mint_token, serve_in_background
+    key = load_or_create_key()
+    _, jwks_url = serve_in_background(key)
+    os.environ["JWKS_URL"] = jwks_url
+
+    module = __import__(args.worker)
+    import degraded_mode
+    from access_log import ACCESS_LOG_STREAM
+    if args.worker == "app_async":
+        from starlette.testclient import TestClient
+        client = TestClient(module.app).__enter__()
+    else:
+        client = module.app.test_client()
+    from redis_layout import FIELD_LAST_IP, state_key
+    # Users outage-<users>... are only seen during the outage: their state exists only in process until reconciled
+    tokens = [mint_token(key, f"outage-{u}") for u in range(2 * args.users)]
+    octet = {"healthy": 1, "outage": 2, "recovery": 3}
+
+    def call(i, phase):
+        u = i % args.users + (args.users if phase == "outage" else 0)
+        headers = {"Authorization": f"Bearer {tokens[u]}", "User-Agent": f"bench-outage/{phase}",
+                   "X-Forwarded-For": f"10.2.{u % 250}.{octet[phase]}"}
+        t0 = time.perf_counter()
+        r = client.post("/api/access-request", json={"resource": RESOURCES[i % len(RESOURCES)]}, headers=headers)
+        elapsed = time.perf_counter() - t0
+        body = r.json() if args.worker == "app_async" else r.get_json()
+        return elapsed, r.status_code, (body or {}).get("access_decision")
+
+    def phase(name, count=None, seconds=None):
+        samples, actions, errors, i = [], Counter(), 0, 0
+        fallback = fallback_total(degraded_mode.FALLBACK_DECISIONS)
+        deadline = time.monotonic() + (seconds or 0)
+        while (i < count) if count is not None else (time.monotonic() < deadline):
+            elapsed, status, action = call(i, name)
+            samples.append(elapsed)
+            if status >= 500 or action is None:
+                errors += 1
+            actions[action or str(status)] += 1
+            i += 1
+        samples.sort()
+        return {"variant": args.worker, "phase": name, "requests": len(samples),
+                "p50_ms": statistics.median(samples) * 1e3, "p99_ms": percentile(samples, 0.99) * 1e3,
+                "max_ms": samples[-1] * 1e3, "errors": errors,
+                "scored_locally": int(fallback_total(degraded_mode.FALLBACK_DECISIONS) - fallback),
+                "actions": dict(actions)}
+
+    for i in range(args.users):
+        call(i, "healthy")
+    xlen_before = direct.xlen(ACCESS_LOG_STREAM)
+    rows = [phase("healthy", count=args.n)]
+    proxy.set_mode(args.mode)
+    rows.append(phase("outage", seconds=args.outage_s))
+    proxy.set_mode("pass")
+    rows.append(phase("recovery", seconds=args.recovery_s))
+
+    # Everything kept during the outage should reach Redis within a few reconcile rounds
+    store = module.trust_store
+    deadline = time.monotonic() + args.reset_s + 10
+    while store.local.pending() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    decisions = sum(r["requests"] for r in rows)
+    logged = direct.xlen(ACCESS_LOG_STREAM) - xlen_before
+    last_ip = direct.hget(state_key(f"outage-{args.users}"), FIELD_LAST_IP)
+    check = {"variant": args.worker, "pending": store.local.pending(), "decisions": decisions, "logged": logged,
+             "breaker": store.guard.breaker.state_name, "last_ip": last_ip}
+    module.decision_sink.close()
+    json.dump({"phases": rows, "check": check}, sys.stdout)
+    sys.stdout.flush()
+    os._exit(0)  # leave the proxy's and gateway's daemon threads behind
+
+
+def run_variant(variant, args):
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker", variant, "-n", str(args.n),
+           "--users", str(args.users), "--outage-s", str(args.outage_s), "--recovery-s", str(args.recovery_s),
+           "--mode", args.mode, "--budget-ms", str(args.budget_ms), "--reset-s", str(args.reset_s)]
+    proc = subprocess.run(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    if proc.returncode != 0:
+        sys.exit(f"{variant} outage run failed:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=500, help="requests in the healthy phase")
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--outage-s", type=float, default=6.0)
+    ap.add_argument("--recovery-s", type=float, default=4.0)
+    ap.add_argument("--mode", choices=("blackhole", "refuse"), default="blackhole")
+    ap.add_argument("--budget-ms", type=float, default=100.0, help="REDIS_BUDGET_MS for the gateway")
+    ap.add_argument("--reset-s", type=float, default=1.0, help="BREAKER_RESET for the gateway")
+    ap.add_argument("--slack-ms", type=float, default=50.0, help="allowed outage p99 above the budget")
+    ap.add_argument("--variant", choices=VARIANTS + ("all",), default="all")
+    ap.add_argument("--json", help="write results to this file")
+    ap.add_argument("--worker", choices=VARIANTS, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        return worker(args)
+
+    runs = [run_variant(v, args) for v in (VARIANTS if args.variant == "all" else (args.variant,))]
+    failures = []
+    print(f"{'variant':<11}{'phase':<10}{'reqs':>7}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'local':>7}{'errors':>7}  actions")
+    for run in runs:
+        for r in run["phases"]:
+            print(f"{r['variant']:<11}{r['phase']:<10}{r['requests']:>7}{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+                  f"{r['max_ms']:>9.1f}{r['scored_locally']:>7}{r['errors']:>7}  {r['actions']}")
+            if r["errors"]:
+                failures.append(f"{r['variant']}: {r['errors']} failed requests during {r['phase']}")
+            if r["phase"] == "outage" and r["p99_ms"] > args.budget_ms + args.slack_ms:
+                failures.append(f"{r['variant']}: outage p99 {r['p99_ms']:.1f} ms over the {args.budget_ms:.0f} ms budget")
+        c = run["check"]
+        print(f"{c['variant']:<11}after     breaker {c['breaker']}, {c['logged']}/{c['decisions']} decisions logged, "
+              f"pending {c['pending']}, last_ip {c['last_ip']}")
+        if c["pending"] or c["logged"] < c["decisions"] or c["last_ip"] != f"10.2.{args.users % 250}.2":
+            failures.append(f"{c['variant']}: updates kept during the outage were not all written back")
+
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "mode": args.mode, "budget_ms": args.budget_ms,
+                       "runs": runs}, f, indent=2)
+    for f in failures:
+        print(f"FAIL {f}", file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
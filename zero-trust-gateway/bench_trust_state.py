@@ -0,0 +1,127 @@
+# bench_trust_state.py — Compare Redis round trips and latency of the trust scoring paths
+#
+#   python bench_trust_state.py                     # against REDIS_MODE / REDIS_HOST (redis_layout.py)
+#   python bench_trust_state.py --fake --rtt-ms 0.5 # in-memory Redis, simulated network RTT
+#   python bench_trust_state.py --stable            # one IP/device per user (near-cache hits)
+#
+# --fake uses fakeredis: pip install -r requirements-dev.txt
+import time, argparse, statistics
+
+import redis_layout
+from trust_state import TrustStateStore
+from user_cache import UserStateCache
+
+
+class RoundTripCounter:
+    """Counts (and optionally delays) every round trip made through a client."""
+
+    def __init__(self, client, rtt_s=0.0):
+        self.count = 0
+        self.rtt_s = rtt_s
+        execute_command = client.execute_command
+        make_pipeline = client.pipeline
+
+        def counted_execute(*args, **kwargs):
+            self._tick()
+            return execute_command(*args, **kwargs)
+
+        def counted_pipeline(*args, **kwargs):
+            pipe = make_pipeline(*args, **kwargs)
+            pipe_execute = pipe.execute
+
+            def execute(*a, **kw):
+                self._tick()
+                return pipe_execute(*a, **kw)
+            pipe.execute = execute
+            return pipe
+
+        client.execute_command = counted_execute
+        client.pipeline = counted_pipeline
+
+    def _tick(self):
+        self.count += 1
+        if self.rtt_s:
+            time.sleep(self.rtt_s)
+
+
+def legacy_touch(client, user_id, ip, fingerprint, base_score=100):
+    """The serial seven-command sequence (and key layout) the gateways used before trust_state."""
+    score = base_score
+    key_ip, key_dev, key_score = f"user:{user_id}:last_ip", f"user:{user_id}:devices", f"user:{user_id}:trust_score"
+    key_ac = f"user:{user_id}:access_count"
+    last_ip = client.get(key_ip)
+    if last_ip and last_ip != ip:
+        score -= 20
+    access_count = client.incr(key_ac)
+    client.expire(key_ac, 60)
+    if access_count > 30:
+        score -= 30
+    if not client.sismember(key_dev, fingerprint):
+        score -= 25
+        client.sadd(key_dev, fingerprint)
+    client.set(key_ip, ip)
+    client.set(key_score, score)
+    return max(0, min(100, score))
+
+
+def run(name, fn, counter, n, users, stable=False):
+    counter.count = 0
+    samples = []
+    for i in range(n):
+        u = i % users
+        user = f"bench-{name}-{u}"
+        ip = f"10.0.{u % 7}.{u % 5}" if stable else f"10.0.{i % 7}.{i % 5}"
+        fp = f"fp-{u % 3}" if stable else f"fp-{i % 3}"
+        t0 = time.perf_counter()
+        fn(user, ip, fp)
+        samples.append(time.perf_counter() - t0)
+    samples.sort()
+    return {
+        "path": name,
+        "round_trips": counter.count / n,
+        "ops_per_s": n / sum(samples),
+        "p50_ms": statistics.median(samples) * 1000,
+        "p99_ms": samples[int(len(samples) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=5000, help="decisions per path")
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--fake", action="store_true", help="use fakeredis instead of a live server")
+    ap.add_argument("--rtt-ms", type=float, default=0.0, help="simulated network RTT per round trip")
+    ap.add_argument("--stable", action="store_true", help="each user keeps one IP and device")
+    args = ap.parse_args()
+
+    if args.fake:
+        import fakeredis
+        client = fakeredis.FakeRedis(decode_responses=True)
+    else:
+        client = redis_layout.connect()
+    counter = RoundTripCounter(client, args.rtt_ms / 1000)
+
+    script_store = TrustStateStore(client)
+    pipeline_store = TrustStateStore(client, use_script=False)
+    cache = UserStateCache(client)
+    cached_store = TrustStateStore(client, cache=cache)
+    cache.start()
+    script_store.touch("bench-warmup", "127.0.0.1", "fp")  # load the script once
+    cached_store.touch("bench-warmup", "127.0.0.1", "fp")
+    cached_store.touch("bench-warmup", "127.0.0.1", "fp")
+
+    results = [
+        run("legacy", lambda u, ip, fp: legacy_touch(client, u, ip, fp), counter, args.n, args.users, args.stable),
+        run("pipeline", lambda u, ip, fp: pipeline_store.touch(u, ip, fp), counter, args.n, args.users, args.stable),
+        run("script", lambda u, ip, fp: script_store.touch(u, ip, fp), counter, args.n, args.users, args.stable),
+        run("cached", lambda u, ip, fp: cached_store.touch(u, ip, fp), counter, args.n, args.users, args.stable),
+    ]
+    cache.stop()
+
+    print(f"{'path':<10}{'rt/decision':>12}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    for r in results:
+        print(f"{r['path']:<10}{r['round_trips']:>12.2f}{r['ops_per_s']:>12.0f}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# bench_users.py — Multi-user scaling on one offline machine: Redis keys and memory per user, cache hit rates
+#
+#   python bench_users.py                                   # 1k, 10k, 50k synthetic users through app_ziti
+#   python bench_users.py --users 1000,5000 --variant all --requests-per-user 4
+#   USER_CACHE=true python bench_users.py --users 20000 --json out/bench_users.json
+#
+# Users come from synthetic_users.py and their tokens are signed with the dev
+# key; the gateway trusts it through a file:// JWKS, so neither Keycloak nor
+# a JWKS server is needed.  Each gateway runs in its own subprocess with the
+# test client.  Per step (population size, growing): every new user makes a
+# first request (cold), then requests-per-user x users requests are drawn
+# with the population's Zipf activity (steady).  Reported per step:
+#   - steady latency p50/p99 and requests/s (in process, no HTTP)
+#   - Redis keys and MEMORY USAGE per user, used_memory growth per user
+#     (including the shared access-log stream), and how users' keys spread
+#     over --shards equal hash-slot ranges (or the real nodes in cluster mode)
+#   - gateway RSS growth per user
+#   - verified-token cache and per-user near-cache (USER_CACHE=true) hit rates
+# Flushes the Redis db.
+import os, sys, json, time, random, argparse, platform, statistics, subprocess, tempfile
+from collections import Counter
+
+VARIANTS = ("app", "app_ziti", "app_async")
+
+
+def counter_total(counter):
+    return sum(s.value for m in counter.collect() for s in m.samples if s.name.endswith("_total"))
+
+
+def rss_bytes():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def percentile(samples, q):
+    return samples[max(0, int(len(samples) * q) - 1)] if samples else 0.0
+
+
+def worker(args):
+    """Runs inside the subprocess: one gateway, growing populations."""
+    import redis
+    from redis.crc import key_slot
+
+    host, port = os.getenv("REDIS_HOST", "localhost"), int(os.getenv("REDIS_PORT", "6379"))
+    if os.getenv("REDIS_MODE", "standalone").lower() == "standalone":
+        redis.Redis(host=host, port=port).flushdb()
+    from jwks_dev import jwks_document, load_or_create_key
+    key = load_or_create_key()
+    tmp = tempfile.mkdtemp(prefix="bench-users-")
+    with open(os.path.join(tmp, "jwks.json"), "w") as f:
+        json.dump(jwks_document(key), f)
+    # Client addresses travel as X-Forwarded-For, as if one proxy stood in front
+    os.environ.update({"JWKS_URL": f"file://{tmp}/jwks.json", "SERVER_MODE": "dev", "TRUSTED_PROXIES": "1",
+                       "CSV_PATH": os.path.join(tmp, "decisions.csv")})
+
+    module = __import__(args.worker)
+    import jwt_verify, redis_layout, user_cache
+    from redis_layout import baseline_key, device_first_key, devices_key, state_key
+    from synthetic_users import Population, TokenFactory
+    if args.worker == "app_async":
+        from starlette.testclient import TestClient
+        client = TestClient(module.app).__enter__()
+    else:
+        client = module.app.test_client()
+    # app_async's request client is asynchronous; read through its synchronous background client
+    redis_client = module.background_client if args.worker == "app_async" else module.redis_client
+    cluster = redis_layout.is_cluster(redis_client)
+    factory = TokenFactory(key, ttl=24 * 3600)
+    rng = random.Random(args.seed)
+
+    def call(user, resource=None):
+        headers, body = Population.request(user, rng, resource)
+        headers["Authorization"] = f"Bearer {factory.token(user)}"
+        t0 = time.perf_counter()
+        r = client.post("/api/access-request", json=body, headers=headers)
+        return time.perf_counter() - t0, r.status_code
+
+    def used_memory():
+        info = redis_client.info("memory")
+        if cluster:
+            return sum(v["used_memory"] for v in info.values() if isinstance(v, dict) and "used_memory" in v)
+        return info["used_memory"]
+
+    def dbsize():
+        size = redis_client.dbsize()
+        return sum(size.values()) if isinstance(size, dict) else size
+
+    rows, seen = [], 0
+    memory0, keys0, rss0 = used_memory(), dbsize(), rss_bytes()
+    for size in args.sizes:
+        population = Population(size, args.seed)
+        users = population.identities
+        t0 = time.perf_counter()
+        factory.mint_all(users[seen:])
+        mint_s = time.perf_counter() - t0
+        for user in users[seen:]:
+            call(user)
+        seen = size
+
+        counters = {"jwt_hits": jwt_verify.TOKEN_CACHE_HITS, "jwt_misses": jwt_verify.TOKEN_CACHE_MISSES,
+                    "cache_hits": user_cache.CACHE_HITS, "cache_misses": user_cache.CACHE_MISSES}
+        before = {k: counter_total(c) for k, c in counters.items()}
+        samples, statuses = [], Counter()
+        started = time.perf_counter()
+        for _ in range(int(args.requests_per_user * size)):
+            elapsed, status = call(population.pick(rng))
+            samples.append(elapsed)
+            statuses[status] += 1
+        wall = time.perf_counter() - started
+        delta = {k: counter_total(c) - before[k] for k, c in counters.items()}
+        samples.sort()
+
+        # Keys and MEMORY USAGE of a sample of users; hash-slot spread of all their keys
+        sample = rng.sample(users, min(args.sample, size))
+        pipe = redis_client.pipeline(transaction=False)
+        names = [k for u in sample for k in (state_key(u.username), devices_key(u.username),
+                                             device_first_key(u.username), baseline_key(u.username))]
+        for k in names:
+            pipe.memory_usage(k)
+        usage = [u for u in pipe.execute() if u]
+        if cluster:
+            shards = Counter(redis_client.get_node_from_key(state_key(u.username)).name for u in users)
+        else:
+            shards = Counter(key_slot(state_key(u.username).encode()) * args.shards // 16384 for u in users)
+        share = [n / size for n in shards.values()]
+
+        rows.append({
+            "variant": args.worker, "users": size, "requests": len(samples),
+            "rps": len(samples) / wall if wall else 0.0,
+            "p50_ms": statistics.median(samples) * 1e3, "p99_ms": percentile(samples, 0.99) * 1e3,
+            "statuses": {str(k): v for k, v in sorted(statuses.items())},
+            "keys_per_user": (dbsize() - keys0) / size,
+            "user_keys_bytes": sum(usage) / len(sample),
+            "used_memory_per_user": (used_memory() - memory0) / size,
+            "rss_per_user": (rss_bytes() - rss0) / size,
+            "shard_share_min": min(share), "shard_share_max": max(share), "shards": len(shards),
+            "jwt_hit_rate": delta["jwt_hits"] / max(1, delta["jwt_hits"] + delta["jwt_misses"]),
+            "user_cache_hit_rate": (delta["cache_hits"] / (delta["cache_hits"] + delta["cache_misses"])
+                                    if delta["cache_hits"] + delta["cache_misses"] else None),
+            "mint_s": mint_s,
+        })
+    module.decision_sink.close()
+    json.dump(rows, sys.stdout)
+    sys.stdout.flush()
+    os._exit(0)  # leave the gateway's daemon threads behind
+
+
+def run_variant(variant, args):
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker", variant, "--users", args.users,
+           "--requests-per-user", str(args.requests_per_user), "--sample", str(args.sample),
+           "--shards", str(args.shards), "--seed", str(args.seed)]
+    proc = subprocess.run(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    if proc.returncode != 0:
+        sys.exit(f"{variant} run failed:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", default="1000,10000,50000", help="population sizes, growing")
+    ap.add_argument("--requests-per-user", type=float, default=2.0, help="steady requests per user and step")
+    ap.add_argument("--sample", type=int, default=500, help="users whose keys are sized with MEMORY USAGE")
+    ap.add_argument("--shards", type=int, default=3, help="hash-slot ranges for the spread (standalone)")
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--variant", choices=VARIANTS + ("all",), default="app_ziti")
+    ap.add_argument("--json", help="write results to this file")
+    ap.add_argument("--worker", choices=VARIANTS, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    args.sizes = sorted(int(n) for n in args.users.split(","))
+
+    if args.worker:
+        return worker(args)
+
+    rows = [r for v in (VARIANTS if args.variant == "all" else (args.variant,)) for r in run_variant(v, args)]
+    print(f"{'variant':<10}{'users':>8}{'req/s':>8}{'p50 ms':>8}{'p99 ms':>8}{'keys/u':>8}{'B/u keys':>9}"
+          f"{'B/u redis':>10}{'B/u rss':>9}{'shard min-max':>15}{'jwt hit':>9}{'cache hit':>10}")
+    for r in rows:
+        cache = f"{r['user_cache_hit_rate']:.1%}" if r["user_cache_hit_rate"] is not None else "off"
+        print(f"{r['variant']:<10}{r['users']:>8}{r['rps']:>8.0f}{r['p50_ms']:>8.2f}{r['p99_ms']:>8.2f}"
+              f"{r['keys_per_user']:>8.2f}{r['user_keys_bytes']:>9.0f}{r['used_memory_per_user']:>10.0f}"
+              f"{r['rss_per_user']:>9.0f}{r['shard_share_min']:>8.1%}-{r['shard_share_max']:<6.1%}"
+              f"{r['jwt_hit_rate']:>9.1%}{cache:>10}")
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"python": platform.python_version(), "redis_mode": os.getenv("REDIS_MODE", "standalone"),
+                       "user_cache": os.getenv("USER_CACHE", "false"), "rows": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+# test_ziti.py is the end-to-end comparison script (it needs Keycloak and both gateways running), not a test module
+collect_ignore = ["test_ziti.py"]
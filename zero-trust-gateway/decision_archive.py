@@ -0,0 +1,569 @@
+"""Columnar archive of decision logs, partitioned by day.
+
+``ingest`` reads decision logs (the decision sink's CSV/JSONL, rotated and
+gzipped files included, or run_all.py's decisions.csv) in chunks and writes
+their rows as immutable segments under ``ARCHIVE_DIR/day=YYYY-MM-DD/``.
+A segment holds up to ``ARCHIVE_SEGMENT_ROWS`` rows of one day sorted by
+``(user_id, ts)``:
+
+    meta.json     columns and their encoding, row count, time range
+    index.npz     per block of ``BLOCK_ROWS`` rows: first (user, ts), min/max ts, byte offsets
+    <column>.col  the column's blocks, each zlib-compressed
+    <column>.dict sorted distinct values of a text column (the column stores codes)
+
+Numbers and booleans are stored as the narrowest NumPy type that holds
+them, text as dictionary codes, timestamps as microseconds.  A query for a
+user looks the user up in each segment's dictionary, then bisects the
+sparse block index, and decompresses only those blocks of the
+memory-mapped column files it needs; a time-only query skips blocks by
+their min/max ts and whole days by partition.
+
+Ingestion is incremental: how far each log was read is kept in
+``sources.json``, keyed by the log's first row, so appending to the live
+file or rotating it (and gzipping the rotated file) never archives a row
+twice.
+
+``Summary`` aggregates blocks as they stream past: per group, counts,
+allow/deny rates, mean scores and latency quantiles from a fixed
+logarithmic histogram, in memory independent of the number of rows.
+
+    python decision_archive.py ingest out/
+    python decision_archive.py query --user alice --since 7d
+    python decision_archive.py summary --by action --since 30d --csv out/summary_30d.csv
+    python decision_archive.py info
+"""
+import io
+import os
+import sys
+import csv
+import gzip
+import json
+import mmap
+import uuid
+import zlib
+import bisect
+import hashlib
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "out/archive")
+ARCHIVE_SEGMENT_ROWS = int(os.getenv("ARCHIVE_SEGMENT_ROWS", "2000000"))
+BLOCK_ROWS = 8192
+BUFFER_ROWS = 4_000_000
+CHUNK_ROWS = 500_000
+COMPRESS_LEVEL = 6
+
+TS_COLUMNS = ("ts", "timestamp")
+USER_COLUMN = "user_id"
+LOG_SUFFIXES = (".csv", ".csv.gz", ".jsonl", ".jsonl.gz")
+SOURCES = "sources.json"
+
+US_PER_DAY = 86_400_000_000
+_INTS = (np.int8, np.int16, np.int32, np.int64)
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+def to_us(value):
+    """Microseconds since the epoch (naive timestamps as they are) for a datetime or ISO string."""
+    if value is None:
+        return None
+    return int(np.datetime64(pd.Timestamp(value).tz_localize(None), "us").astype(np.int64))
+
+
+def _day(day_number):
+    return str(np.datetime64(int(day_number), "D"))
+
+
+def _write_atomic(path, data):
+    tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+# ========== Segments ==========
+class Segment:
+    """One immutable, sorted run of rows of a day."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.columns = {c["name"]: c for c in self.meta["columns"]}
+        with np.load(os.path.join(path, "index.npz")) as index:
+            self.block_user = index["block_user"]
+            self.block_ts = index["block_ts"]
+            self.block_min = index["block_min"]
+            self.block_max = index["block_max"]
+            self.offsets = index["offsets"]
+        self._keys = None
+        self._dicts = {}
+        self._maps = {}
+
+    @property
+    def rows(self):
+        return self.meta["rows"]
+
+    @classmethod
+    def write(cls, directory, frame):
+        """Write ``frame`` (a ``ts`` column of microseconds plus anything else) as a new segment."""
+        users = frame[USER_COLUMN].astype(str).to_numpy() if USER_COLUMN in frame else np.full(len(frame), "")
+        user_values, user_codes = np.unique(users, return_inverse=True)
+        ts = frame["ts"].to_numpy(dtype=np.int64)
+        order = np.lexsort((ts, user_codes))
+        ts, user_codes = ts[order], user_codes[order]
+
+        tmp = os.path.join(directory, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp)
+        starts = np.arange(0, len(order), BLOCK_ROWS)
+        columns, offsets = [], []
+        for name in frame.columns:
+            if name == USER_COLUMN:
+                values, codes = user_values, user_codes
+                column, data = {"name": name, "kind": "dict"}, codes
+            else:
+                column, data, values = _encode(name, frame[name], order)
+            if column["kind"] == "dict":
+                data = data.astype(np.min_scalar_type(max(len(values) - 1, 0)))
+                with open(os.path.join(tmp, f"{name}.dict"), "w", encoding="utf-8") as f:
+                    json.dump([str(v) for v in values], f)
+            column["dtype"] = data.dtype.str
+            columns.append(column)
+            offsets.append(_write_blocks(os.path.join(tmp, f"{name}.col"), data, starts))
+
+        np.savez(os.path.join(tmp, "index.npz"), block_user=user_codes[starts].astype(np.uint32),
+                 block_ts=ts[starts], block_min=np.minimum.reduceat(ts, starts),
+                 block_max=np.maximum.reduceat(ts, starts), offsets=np.array(offsets, dtype=np.int64))
+        meta = {"rows": int(len(order)), "block_rows": BLOCK_ROWS, "columns": columns,
+                "ts_min": int(ts.min()), "ts_max": int(ts.max())}
+        _write_atomic(os.path.join(tmp, "meta.json"), meta)
+        path = os.path.join(directory, f"seg-{meta['ts_min']}-{uuid.uuid4().hex[:8]}")
+        os.rename(tmp, path)
+        return cls(path)
+
+    # ---------- reading ----------
+    def _dict(self, name):
+        if name not in self._dicts:
+            with open(os.path.join(self.path, f"{name}.dict"), encoding="utf-8") as f:
+                self._dicts[name] = np.array(json.load(f), dtype=object)
+        return self._dicts[name]
+
+    def _column(self, name):
+        if name not in self._maps:
+            with open(os.path.join(self.path, f"{name}.col"), "rb") as f:
+                self._maps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        return self._maps[name]
+
+    def user_code(self, user):
+        if USER_COLUMN not in self.columns:
+            return None
+        values = self._dict(USER_COLUMN)
+        i = bisect.bisect_left(values, user)
+        return i if i < len(values) and values[i] == user else None
+
+    def blocks(self, user=None, start=None, end=None):
+        """Indices of the blocks that may hold matching rows; ``start``/``end`` in microseconds."""
+        if user is not None:
+            code = self.user_code(user)
+            if code is None:
+                return range(0)
+            if self._keys is None:
+                self._keys = list(zip(self.block_user.tolist(), self.block_ts.tolist()))
+            lo = max(bisect.bisect_right(self._keys, (code, start if start is not None else -2 ** 63)) - 1, 0)
+            hi = bisect.bisect_right(self._keys, (code, end if end is not None else 2 ** 63 - 1))
+            return range(lo, hi)
+        keep = np.ones(len(self.block_ts), dtype=bool)
+        if start is not None:
+            keep &= self.block_max >= start
+        if end is not None:
+            keep &= self.block_min <= end
+        return np.flatnonzero(keep)
+
+    def read(self, block, name, decode=True):
+        column = self.columns[name]
+        i = list(self.columns).index(name)
+        raw = self._column(name)[self.offsets[i, block]:self.offsets[i, block + 1]]
+        data = np.frombuffer(zlib.decompress(raw), dtype=np.dtype(column["dtype"]))
+        if not decode:
+            return data
+        if column["kind"] == "dict":
+            return self._dict(name)[data]
+        if column["kind"] == "ts":
+            return data.astype("datetime64[us]")
+        if column["kind"] == "bool":
+            return data.astype(bool)
+        return data
+
+    def scan(self, user=None, start=None, end=None, columns=None):
+        """``{column: array}`` per block, holding only the matching rows."""
+        names = [c for c in (columns or self.columns) if c in self.columns]
+        code = self.user_code(user) if user is not None else None
+        for block in self.blocks(user, start, end):
+            ts = self.read(block, "ts", decode=False)
+            mask = np.ones(len(ts), dtype=bool)
+            if code is not None:
+                mask &= self.read(block, USER_COLUMN, decode=False) == code
+            if start is not None:
+                mask &= ts >= start
+            if end is not None:
+                mask &= ts <= end
+            if mask.any():
+                yield {name: self.read(block, name)[mask] for name in names}
+
+    def close(self):
+        for m in self._maps.values():
+            if isinstance(m, mmap.mmap):
+                m.close()
+        self._maps = {}
+
+
+def _encode(name, series, order):
+    """``(column meta, values in row order, dictionary or None)`` for one column."""
+    if name == "ts":
+        return {"name": name, "kind": "ts"}, series.to_numpy(dtype=np.int64)[order], None
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return {"name": name, "kind": "bool"}, series.to_numpy(dtype=np.uint8)[order], None
+    if pd.api.types.is_integer_dtype(series.dtype):
+        data = series.to_numpy()[order]
+        lo, hi = (int(data.min()), int(data.max())) if len(data) else (0, 0)
+        dtype = next(t for t in _INTS if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max)
+        return {"name": name, "kind": "int"}, data.astype(dtype), None
+    if pd.api.types.is_float_dtype(series.dtype):
+        return {"name": name, "kind": "float"}, series.to_numpy(dtype=np.float64)[order], None
+    text = series.astype(object).where(series.notna(), "").astype(str).to_numpy()[order]
+    values, codes = np.unique(text, return_inverse=True)
+    return {"name": name, "kind": "dict"}, codes, values
+
+
+def _write_blocks(path, data, starts):
+    offsets = [0]
+    with open(path, "wb") as f:
+        for lo in starts:
+            f.write(zlib.compress(data[lo:lo + BLOCK_ROWS].tobytes(), COMPRESS_LEVEL))
+            offsets.append(f.tell())
+    return offsets
+
+
+# ========== Source logs ==========
+def log_files(paths, exclude=None):
+    out = []
+    for p in paths:
+        if os.path.isdir(p):
+            for root, dirs, files in os.walk(p):
+                if exclude and os.path.abspath(root).startswith(exclude):
+                    continue
+                out += [os.path.join(root, f) for f in files if f.endswith(LOG_SUFFIXES)]
+        else:
+            out.append(p)
+    return sorted(out)
+
+
+def _open(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+def _fingerprint(path):
+    """``(key, header line)``: a log keeps its key when appended to, renamed or gzipped."""
+    with _open(path) as f:
+        header = f.readline() if ".csv" in path else b""
+        first = f.readline()
+    if not first.endswith(b"\n"):
+        return None, header
+    return hashlib.sha1(header + first).hexdigest(), header
+
+
+def _complete_lines(path, offset):
+    """The bytes of ``path`` after ``offset`` up to its last newline (a live log may end mid-row)."""
+    with _open(path) as f:
+        f.seek(offset)
+        data = f.read() if path.endswith(".gz") else f.read(os.path.getsize(path) - offset)
+    return data[:data.rfind(b"\n") + 1]
+
+
+def _read_log(path, offset, header, chunk_rows):
+    """``(chunks, end offset)`` for the rows of ``path`` after ``offset``."""
+    data = _complete_lines(path, offset)
+    end = offset + len(data)
+    if not data:
+        return iter(()), end
+    if ".jsonl" in path:
+        return pd.read_json(io.StringIO(data.decode("utf-8")), lines=True, chunksize=chunk_rows, dtype=False), end
+    names = next(csv.reader([header.decode("utf-8")]))
+    return pd.read_csv(io.BytesIO(data), header=None, names=names, chunksize=chunk_rows), end
+
+
+# ========== Archive ==========
+class DecisionArchive:
+    def __init__(self, root=ARCHIVE_DIR, segment_rows=ARCHIVE_SEGMENT_ROWS):
+        self.root = root
+        self.segment_rows = segment_rows
+        self._buffer = {}  # day number -> [frames]
+        self._buffered = 0
+
+    # ---------- writing ----------
+    def ingest(self, paths, chunk_rows=CHUNK_ROWS):
+        """Archive the rows of ``paths`` (files or directories) not archived before; returns the row count."""
+        os.makedirs(self.root, exist_ok=True)
+        sources_path = os.path.join(self.root, SOURCES)
+        sources = {}
+        if os.path.exists(sources_path):
+            with open(sources_path, encoding="utf-8") as f:
+                sources = json.load(f)
+        total = 0
+        for path in log_files(paths, exclude=os.path.abspath(self.root)):
+            key, header = _fingerprint(path)
+            if key is None:
+                continue
+            offset = sources.get(key, {}).get("offset", len(header))
+            chunks, end = _read_log(path, offset, header, chunk_rows)
+            for chunk in chunks:
+                total += self.add(chunk)
+            sources[key] = {"path": os.path.abspath(path), "offset": end}
+        self.flush()
+        # Recorded only once the rows are in segments; a crash in between re-reads them
+        _write_atomic(sources_path, sources)
+        return total
+
+    def add(self, frame):
+        """Buffer a chunk of log rows; returns how many had a usable timestamp."""
+        ts_col = next((c for c in TS_COLUMNS if c in frame.columns), None)
+        if ts_col is None:
+            raise ArchiveError(f"no timestamp column (one of {', '.join(TS_COLUMNS)})")
+        ts = pd.to_datetime(frame[ts_col], errors="coerce", format="ISO8601")
+        if getattr(ts.dt, "tz", None) is not None:
+            ts = ts.dt.tz_convert(None)
+        frame = frame[ts.notna()].drop(columns=[ts_col])
+        us = ts[ts.notna()].to_numpy().astype("datetime64[us]").astype(np.int64)
+        frame.insert(0, "ts", us)
+        days = us // US_PER_DAY
+        for day in np.unique(days):
+            part = frame[days == day]
+            self._buffer.setdefault(int(day), []).append(part)
+            self._buffered += len(part)
+            if sum(len(p) for p in self._buffer[int(day)]) >= self.segment_rows:
+                self._flush_day(int(day))
+        while self._buffered > BUFFER_ROWS:
+            self._flush_day(max(self._buffer, key=lambda d: sum(len(p) for p in self._buffer[d])))
+        return len(frame)
+
+    def _flush_day(self, day):
+        parts = self._buffer.pop(day)
+        self._buffered -= sum(len(p) for p in parts)
+        frame = pd.concat(parts, ignore_index=True)
+        directory = os.path.join(self.root, f"day={_day(day)}")
+        os.makedirs(directory, exist_ok=True)
+        for lo in range(0, len(frame), self.segment_rows):
+            Segment.write(directory, frame.iloc[lo:lo + self.segment_rows].reset_index(drop=True))
+
+    def flush(self):
+        for day in list(self._buffer):
+            self._flush_day(day)
+
+    # ---------- reading ----------
+    def days(self, start=None, end=None):
+        """Partition directories overlapping ``[start, end]`` (microseconds)."""
+        if not os.path.isdir(self.root):
+            return []
+        lo = _day(start // US_PER_DAY) if start is not None else ""
+        hi = _day(end // US_PER_DAY) if end is not None else "~"
+        return [os.path.join(self.root, d) for d in sorted(os.listdir(self.root))
+                if d.startswith("day=") and lo <= d[4:] <= hi]
+
+    def segments(self, start=None, end=None):
+        for day in self.days(start, end):
+            for name in sorted(os.listdir(day)):
+                if name.startswith("seg-"):
+                    yield Segment(os.path.join(day, name))
+
+    def scan(self, user=None, start=None, end=None, columns=None):
+        """Matching rows as ``{column: array}`` blocks; ``start``/``end`` are datetimes, ISO strings or None."""
+        start, end = to_us(start), to_us(end)
+        for segment in self.segments(start, end):
+            if (start is not None and segment.meta["ts_max"] < start) or \
+                    (end is not None and segment.meta["ts_min"] > end):
+                continue
+            try:
+                yield from segment.scan(user, start, end, columns)
+            finally:
+                segment.close()
+
+
+# ========== Streaming aggregation ==========
+# Latency histogram: 5% wide buckets from 0.01 ms to about 10 minutes
+LATENCY_EDGES = 0.01 * 1.05 ** np.arange(370)
+
+
+class Summary:
+    """Per-group counts, action rates, means and latency quantiles over streamed blocks."""
+
+    def __init__(self, by=(), means=("trust_score", "network_score", "app_score"), latency="latency_ms",
+                 action="action"):
+        self.by = tuple(by)
+        self.means = tuple(means)
+        self.latency = latency
+        self.action = action
+        self._groups = {}
+
+    def _group(self, key):
+        g = self._groups.get(key)
+        if g is None:
+            g = self._groups[key] = {"count": 0, "actions": {}, "sums": dict.fromkeys(self.means, 0.0),
+                                     "counts": dict.fromkeys(self.means, 0), "latency_sum": 0.0, "latency_n": 0,
+                                     "latency": np.zeros(len(LATENCY_EDGES) + 1, dtype=np.int64)}
+        return g
+
+    def add(self, block):
+        """Aggregate one ``{column: array}`` block (as ``DecisionArchive.scan`` yields)."""
+        n = len(next(iter(block.values()))) if block else 0
+        if not n:
+            return
+        if self.by:
+            values, codes = [], np.zeros(n, dtype=np.int64)
+            for c in self.by:
+                v, inverse = np.unique(np.asarray(block[c]).astype(str) if c in block else np.full(n, ""),
+                                       return_inverse=True)
+                values.append(v)
+                codes = codes * len(v) + inverse.reshape(-1)
+            for code in np.unique(codes):
+                key, rest = [], int(code)
+                for v in reversed(values):
+                    rest, i = divmod(rest, len(v))
+                    key.append(str(v[i]))
+                self._add(self._group(tuple(reversed(key))), block, codes == code)
+        else:
+            self._add(self._group(()), block, np.ones(n, dtype=bool))
+
+    def _add(self, g, block, mask):
+        g["count"] += int(mask.sum())
+        if self.action in block:
+            actions, counts = np.unique(np.asarray(block[self.action])[mask].astype(str), return_counts=True)
+            for a, c in zip(actions.tolist(), counts):
+                g["actions"][a] = g["actions"].get(a, 0) + int(c)
+        for col in self.means:
+            if col in block:
+                values = _numbers(block[col], mask)
+                g["sums"][col] += float(values.sum())
+                g["counts"][col] += len(values)
+        if self.latency in block:
+            values = _numbers(block[self.latency], mask)
+            g["latency_sum"] += float(values.sum())
+            g["latency_n"] += len(values)
+            g["latency"] += np.bincount(np.searchsorted(LATENCY_EDGES, values), minlength=len(g["latency"]))
+
+    def add_records(self, records):
+        """Aggregate a list of dicts."""
+        if records:
+            names = {k for r in records for k in r}
+            self.add({k: np.array([r.get(k) for r in records], dtype=object) for k in names})
+
+    def rows(self):
+        out = []
+        for key, g in sorted(self._groups.items()):
+            row = dict(zip(self.by, key))
+            n = g["count"]
+            row["count"] = n
+            row["allow_rate"] = 100 * g["actions"].get("allow", 0) / n if n else 0.0
+            row["deny_rate"] = 100 * g["actions"].get("deny", 0) / n if n else 0.0
+            for col in self.means:
+                row[f"avg_{col}"] = g["sums"][col] / g["counts"][col] if g["counts"][col] else float("nan")
+            if g["latency_n"]:
+                row["avg_latency_ms"] = g["latency_sum"] / g["latency_n"]
+                for q in (50, 95, 99):
+                    row[f"p{q}_latency_ms"] = _quantile(g["latency"], q / 100)
+            row["actions"] = dict(sorted(g["actions"].items()))
+            out.append(row)
+        return out
+
+
+def _numbers(values, mask):
+    """The values under ``mask`` as floats, blanks and non-numbers dropped."""
+    values = np.asarray(values)[mask]
+    if values.dtype.kind not in "biuf":
+        values = pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(float)
+    values = values.astype(float, copy=False)
+    return values[~np.isnan(values)]
+
+
+def _quantile(histogram, q):
+    """Upper edge of the bucket holding quantile ``q`` (within 5%)."""
+    rank = q * histogram.sum()
+    i = int(np.searchsorted(np.cumsum(histogram), rank))
+    return float(LATENCY_EDGES[min(i, len(LATENCY_EDGES) - 1)])
+
+
+# ========== CLI ==========
+def parse_time(text):
+    """``7d``, ``12h``, ``30m`` (ago) or an ISO date/time."""
+    if not text:
+        return None
+    units = {"d": "days", "h": "hours", "m": "minutes"}
+    if text[-1] in units and text[:-1].isdigit():
+        return datetime.now() - timedelta(**{units[text[-1]]: int(text[:-1])})
+    return datetime.fromisoformat(text)
+
+
+def _print_rows(rows, out):
+    if not rows:
+        return
+    fields = list(rows[0])
+    w = csv.DictWriter(out, fieldnames=fields, extrasaction="ignore")
+    w.writeheader()
+    for r in rows:
+        w.writerow({k: (f"{v:.2f}" if isinstance(v, float) else v) for k, v in r.items()})
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Columnar decision log archive")
+    ap.add_argument("--archive", default=ARCHIVE_DIR)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    i = sub.add_parser("ingest", help="archive new rows of decision logs")
+    i.add_argument("paths", nargs="+", help="log files or directories")
+    q = sub.add_parser("query", help="print matching decisions as CSV")
+    s = sub.add_parser("summary", help="rates, mean scores and latency quantiles per group")
+    for p in (q, s):
+        p.add_argument("--user")
+        p.add_argument("--since", help="7d, 12h, 30m or an ISO date/time")
+        p.add_argument("--until")
+    q.add_argument("--columns", help="comma-separated columns (default all)")
+    s.add_argument("--by", default="", help="comma-separated group columns")
+    s.add_argument("--csv", help="also write the summary to this file")
+    sub.add_parser("info", help="partitions, segments, rows and size")
+    args = ap.parse_args()
+
+    archive = DecisionArchive(args.archive)
+    if args.cmd == "ingest":
+        print(f"{archive.ingest(args.paths)} rows archived")
+    elif args.cmd == "query":
+        columns = args.columns.split(",") if args.columns else None
+        w = None
+        for block in archive.scan(args.user, parse_time(args.since), parse_time(args.until), columns):
+            if w is None:
+                w = csv.writer(sys.stdout)
+                w.writerow(list(block))
+            w.writerows(zip(*block.values()))
+    elif args.cmd == "summary":
+        by = [c for c in args.by.split(",") if c]
+        summary = Summary(by=by)
+        for block in archive.scan(args.user, parse_time(args.since), parse_time(args.until)):
+            summary.add(block)
+        rows = summary.rows()
+        _print_rows(rows, sys.stdout)
+        if args.csv:
+            with open(args.csv, "w", newline="", encoding="utf-8") as f:
+                _print_rows(rows, f)
+    else:
+        for day in archive.days():
+            segments = [Segment(os.path.join(day, n)) for n in sorted(os.listdir(day)) if n.startswith("seg-")]
+            size = sum(os.path.getsize(os.path.join(s.path, f)) for s in segments for f in os.listdir(s.path))
+            print(f"{os.path.basename(day)[4:]}  {len(segments)} segment(s)  {sum(s.rows for s in segments)} rows  "
+                  f"{size / 1024 / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
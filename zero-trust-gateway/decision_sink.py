@@ -0,0 +1,190 @@
+"""Background decision log writer.
+
+Request handlers hand a record to ``DecisionSink.submit`` (a non-blocking
+queue put); a single writer thread drains the queue in batches, appends them
+to CSV or JSONL, and rotates/compresses files by size or by day.  When the
+queue is full the record is dropped and counted rather than slowing the
+request down.
+"""
+import os
+import csv
+import gzip
+import json
+import queue
+import atexit
+import shutil
+import threading
+import time
+from datetime import datetime
+
+from prometheus_client import Counter, Gauge
+
+SINK_QUEUE_DEPTH = Gauge("zt_decision_log_queue_depth", "Decision records waiting to be written", ["sink"],
+                         multiprocess_mode="livesum")
+SINK_DROPPED = Counter("zt_decision_log_dropped_total", "Decision records dropped because the queue was full", ["sink"])
+SINK_WRITTEN = Counter("zt_decision_log_written_total", "Decision records written to disk", ["sink"])
+SINK_ERRORS = Counter("zt_decision_log_errors_total", "Decision log write failures", ["sink"])
+
+_STOP = object()
+
+
+class DecisionSink:
+    def __init__(self, path, fields, fmt="csv", max_queue=10000, batch_size=500, flush_interval=1.0,
+                 rotate_bytes=0, rotate_daily=False, compress=False):
+        if fmt not in ("csv", "jsonl"):
+            raise ValueError(f"Unsupported decision log format: {fmt}")
+        self.path = path
+        self.fields = list(fields)
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_daily = rotate_daily
+        self.compress = compress
+
+        self.name = os.path.basename(path)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._file = None
+        self._writer = None
+        self._opened_day = None
+        self._depth = SINK_QUEUE_DEPTH.labels(sink=self.name)
+
+    @classmethod
+    def from_env(cls, path, fields):
+        fmt = os.getenv("DECISION_LOG_FORMAT", "csv").lower()
+        if fmt == "jsonl" and path.endswith(".csv"):
+            path = path[:-4] + ".jsonl"
+        # Under the multi-worker server each worker appends to its own file
+        slot = os.getenv("WORKER_SLOT")
+        if slot is not None:
+            stem, ext = os.path.splitext(path)
+            path = f"{stem}.w{slot}{ext}"
+        return cls(
+            path, fields, fmt=fmt,
+            max_queue=int(os.getenv("DECISION_LOG_QUEUE", "10000")),
+            batch_size=int(os.getenv("DECISION_LOG_BATCH", "500")),
+            flush_interval=float(os.getenv("DECISION_LOG_FLUSH_SECONDS", "1.0")),
+            rotate_bytes=int(float(os.getenv("DECISION_LOG_ROTATE_MB", "0")) * 1024 * 1024),
+            rotate_daily=os.getenv("DECISION_LOG_ROTATE_DAILY", "false").lower() == "true",
+            compress=os.getenv("DECISION_LOG_GZIP", "false").lower() == "true",
+        )
+
+    # ---------- producer side ----------
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"decision-sink-{self.name}", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def submit(self, record):
+        """Queue a record; returns False (and counts a drop) if the queue is full."""
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            SINK_DROPPED.labels(sink=self.name).inc()
+            return False
+
+    def close(self, timeout=10):
+        """Flush everything queued so far and stop the writer."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    # ---------- writer thread ----------
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            if stopping:
+                # drain whatever was queued ahead of the stop marker
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not _STOP:
+                        batch.append(item)
+            # Sampled once per batch (a callback gauge is not exported by multi-process metrics)
+            self._depth.set(self._queue.qsize())
+            if batch:
+                try:
+                    self._write_batch(batch)
+                    SINK_WRITTEN.labels(sink=self.name).inc(len(batch))
+                except Exception:
+                    SINK_ERRORS.labels(sink=self.name).inc()
+                    self._close_file()
+        self._close_file()
+
+    def _write_batch(self, batch):
+        if self._file is None:
+            self._open()
+        if self._should_rotate():
+            self._rotate()
+        if self.fmt == "csv":
+            self._writer.writerows([[r.get(f, "") for f in self.fields] for r in batch])
+        else:
+            self._file.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch))
+        self._file.flush()
+
+    def _should_rotate(self):
+        if self.rotate_daily and self._opened_day != datetime.now().date():
+            return True
+        return bool(self.rotate_bytes) and self._file.tell() >= self.rotate_bytes
+
+    def _rotate(self):
+        if self._file is not None:
+            self._close_file()
+            # Stamped with the file's last write, i.e. the time its newest record covers, not the
+            # rotation time: a daily rotation just after midnight must not label yesterday as today
+            stamp = datetime.fromtimestamp(os.path.getmtime(self.path)).strftime("%Y%m%d-%H%M%S")
+            stem, ext = os.path.splitext(self.path)
+            rotated, n = f"{stem}.{stamp}{ext}", 1
+            while os.path.exists(rotated) or os.path.exists(rotated + ".gz"):
+                rotated, n = f"{stem}.{stamp}-{n}{ext}", n + 1
+            os.replace(self.path, rotated)
+            if self.compress:
+                with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(rotated)
+        self._open()
+
+    def _open(self):
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._file = open(self.path, "a", newline="", encoding="utf-8")
+        # A file left over from an earlier run covers the day it was last written
+        mtime = os.fstat(self._file.fileno()).st_mtime if self._file.tell() else time.time()
+        self._opened_day = datetime.fromtimestamp(mtime).date()
+        if self.fmt == "csv":
+            self._writer = csv.writer(self._file)
+            if self._file.tell() == 0:
+                self._writer.writerow(self.fields)
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            finally:
+                self._file = None
+                self._writer = None
@@ -0,0 +1,444 @@
+"""Degraded mode: keep deciding when Redis is slow or down.
+
+``RedisGuard.wrap`` puts every command and pipeline of the gateway's Redis
+client behind
+
+- a per-call timeout of ``REDIS_BUDGET_MS`` (socket timeouts, from
+  ``client_options``; only for the request-path client: background work
+  and admin reports use a separate client with ``background_options``,
+  ``REDIS_BACKGROUND_TIMEOUT`` seconds per call);
+- a per-request budget: once a request has spent ``REDIS_BUDGET_MS`` waiting
+  on Redis, its remaining calls fail at once;
+- a circuit breaker: ``BREAKER_FAILURES`` consecutive connection errors or
+  timeouts open it and calls fail at once; every ``BREAKER_RESET`` seconds
+  one call is let through, and its success closes the breaker.
+
+``ResilientTrustStore`` scores a request whose Redis call failed from a
+bounded in-process ``LocalStateStore``: per user the last IP, recent devices
+(mirrored from Redis while it answers) and local rate counters, for at most
+``FALLBACK_USERS`` users.  ``FAILURE_MODE`` limits what such a decision
+grants:
+
+    restricted  (default) the policy table's decision, with allow cut to allow_restricted
+    closed      deny
+
+The changes made locally (last IP, new devices, trust scores) and audit
+entries that could not be written are kept, up to ``RECONCILE_MAX``, and
+written back by a background thread once Redis answers again.  Writes are
+last-writer-wins: a replica that stayed connected may see its last IP
+replaced by this one's.
+
+    REDIS_BUDGET_MS=100 BREAKER_FAILURES=3 BREAKER_RESET=5 FAILURE_MODE=closed python app_ziti.py
+    python bench_outage.py --variant app_ziti
+"""
+import os
+import time
+import inspect
+import threading
+from contextvars import ContextVar
+from functools import wraps
+from types import MappingProxyType
+from collections import OrderedDict, deque
+
+import redis
+from prometheus_client import Counter, Gauge
+
+from device_registry import DEVICE_MAX, DeviceRegistry
+from rate_limit import LocalRateLimiter
+from redis_layout import FIELD_LAST_IP, FIELD_TRUST_SCORE, state_key
+from retention import RETAIN_USER_STATE
+from trust_state import TrustSignals, apply_penalties, _request
+
+REDIS_BUDGET_MS = float(os.getenv("REDIS_BUDGET_MS", "100"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "3"))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "5"))
+FAILURE_MODE = os.getenv("FAILURE_MODE", "restricted")
+FALLBACK_USERS = int(os.getenv("FALLBACK_USERS", "50000"))
+RECONCILE_MAX = int(os.getenv("RECONCILE_MAX", "100000"))
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "1"))
+RECONCILE_BATCH = 500
+REDIS_BACKGROUND_TIMEOUT = float(os.getenv("REDIS_BACKGROUND_TIMEOUT", "5"))
+
+# Errors meaning "Redis did not answer"; RedisUnavailable is one of them
+UNAVAILABLE = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+BREAKER_STATE = Gauge("zt_redis_breaker_state", "Redis circuit breaker (0 closed, 1 half-open, 2 open)", ["layer"],
+                      multiprocess_mode="max")
+BREAKER_TRANSITIONS = Counter("zt_redis_breaker_transitions_total", "Redis circuit breaker state changes",
+                              ["layer", "state"])
+FALLBACK_DECISIONS = Counter("zt_fallback_decisions_total", "Decisions scored without Redis", ["layer", "action"])
+RECONCILED = Counter("zt_reconciled_total", "Locally kept updates written back to Redis", ["kind"])
+RECONCILE_DROPPED = Counter("zt_reconcile_dropped_total", "Locally kept updates dropped (queue full)", ["kind"])
+
+_DEGRADED_POLICIES = {
+    "restricted": MappingProxyType({"action": "allow_restricted", "restrictions": ("read_only",),
+                                    "monitoring_level": "enhanced", "reason": "redis_unavailable_restricted"}),
+    "closed": MappingProxyType({"action": "deny", "restrictions": ("blocked",),
+                                "monitoring_level": "alert", "reason": "redis_unavailable"}),
+}
+
+_spent = ContextVar("redis_budget_spent", default=None)
+
+
+def background_options(timeout=REDIS_BACKGROUND_TIMEOUT):
+    """Keyword arguments for ``redis_layout.connect`` for a client outside the request budget."""
+    return {"socket_timeout": timeout, "socket_connect_timeout": timeout}
+
+
+class RedisUnavailable(redis.exceptions.ConnectionError):
+    """Raised instead of calling Redis: breaker open or request budget spent."""
+
+
+class LocalSignals(TrustSignals):
+    """``TrustSignals`` computed by ``LocalStateStore``."""
+    __slots__ = ()
+
+
+def scored_locally(signals):
+    return isinstance(signals, LocalSignals)
+
+
+# ========== Circuit Breaker ==========
+class CircuitBreaker:
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+    NAMES = ("closed", "half_open", "open")
+
+    def __init__(self, layer, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.layer = layer
+        self.failures = max(1, failures)
+        self.reset = reset
+        self.state = self.CLOSED
+        self._count = 0
+        self._since = 0.0
+        self._lock = threading.Lock()
+        BREAKER_STATE.labels(layer).set(self.CLOSED)
+
+    @property
+    def state_name(self):
+        return self.NAMES[self.state]
+
+    def _set(self, state):
+        if state != self.state:
+            self.state = state
+            BREAKER_STATE.labels(self.layer).set(state)
+            BREAKER_TRANSITIONS.labels(self.layer, self.NAMES[state]).inc()
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            # One probe per reset period; a probe that never reports lets the next one through
+            now = time.monotonic()
+            if now - self._since >= self.reset:
+                self._since = now
+                self._set(self.HALF_OPEN)
+                return True
+            return False
+
+    def success(self):
+        if self.state == self.CLOSED and not self._count:
+            return
+        with self._lock:
+            self._count = 0
+            self._set(self.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self._count += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._count >= self.failures):
+                self._since = time.monotonic()
+                self._set(self.OPEN)
+
+
+class RedisGuard:
+    def __init__(self, layer, budget_ms=REDIS_BUDGET_MS, breaker=None):
+        self.budget = budget_ms / 1000
+        self.breaker = breaker if breaker is not None else CircuitBreaker(layer)
+
+    def client_options(self):
+        """Keyword arguments for ``redis_layout.connect`` bounding each call."""
+        if self.budget <= 0:
+            return {}
+        return {"socket_timeout": self.budget, "socket_connect_timeout": self.budget}
+
+    def _before(self):
+        spent = _spent.get()
+        if spent is not None and self.budget > 0 and spent[0] >= self.budget:
+            raise RedisUnavailable("request's Redis budget spent")
+        if not self.breaker.allow():
+            raise RedisUnavailable("Redis circuit breaker open")
+        return spent, time.perf_counter()
+
+    def _after(self, spent, started, error=None):
+        if spent is not None:
+            spent[0] += time.perf_counter() - started
+        if isinstance(error, UNAVAILABLE):
+            self.breaker.failure()
+        else:
+            # Any reply, errors included, shows Redis is up
+            self.breaker.success()
+
+    def _guard(self, call):
+        if inspect.iscoroutinefunction(call):
+            async def guarded(*args, **kwargs):
+                spent, started = self._before()
+                try:
+                    result = await call(*args, **kwargs)
+                except Exception as e:
+                    self._after(spent, started, e)
+                    raise
+                self._after(spent, started)
+                return result
+        else:
+            def guarded(*args, **kwargs):
+                spent, started = self._before()
+                try:
+                    result = call(*args, **kwargs)
+                except Exception as e:
+                    self._after(spent, started, e)
+                    raise
+                self._after(spent, started)
+                return result
+        return guarded
+
+    def wrap(self, client):
+        """Route ``client``'s commands and pipeline executions through the guard."""
+        make_pipeline = client.pipeline
+
+        def guarded_pipeline(*args, **kwargs):
+            pipe = make_pipeline(*args, **kwargs)
+            pipe.execute = self._guard(pipe.execute)
+            return pipe
+
+        client.execute_command = self._guard(client.execute_command)
+        client.pipeline = guarded_pipeline
+        return client
+
+    def request(self, view):
+        """Decorator for a view: its Redis calls share one ``REDIS_BUDGET_MS`` budget."""
+        if inspect.iscoroutinefunction(view):
+            @wraps(view)
+            async def budgeted(*args, **kwargs):
+                token = _spent.set([0.0])
+                try:
+                    return await view(*args, **kwargs)
+                finally:
+                    _spent.reset(token)
+        else:
+            @wraps(view)
+            def budgeted(*args, **kwargs):
+                token = _spent.set([0.0])
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    _spent.reset(token)
+        return budgeted
+
+
+# ========== Local State ==========
+class LocalStateStore:
+    """In-process stand-in for the Redis trust state (bounded LRU of users)."""
+
+    def __init__(self, limits, max_users=FALLBACK_USERS, max_devices=DEVICE_MAX, max_log=RECONCILE_MAX):
+        self.rates = LocalRateLimiter(limits, maxsize=max_users)
+        self.max_users = max_users
+        self.max_devices = max(1, max_devices)
+        self.max_log = max_log
+        self._users = OrderedDict()   # user -> [last_ip, OrderedDict of fingerprints]
+        self._missed = OrderedDict()  # user -> [last_ip, trust_score or None, set of new fingerprints]
+        self._log = deque()
+        self._lock = threading.Lock()
+
+    def _user(self, user_id):
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = [None, OrderedDict()]
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return state
+
+    def _see(self, state, ip, fingerprint):
+        state[0] = ip
+        devices = state[1]
+        known = fingerprint in devices
+        devices[fingerprint] = None
+        devices.move_to_end(fingerprint)
+        if len(devices) > self.max_devices:
+            devices.popitem(last=False)
+        return known
+
+    def remember(self, user_id, ip, fingerprint):
+        """Mirror a request Redis has scored."""
+        with self._lock:
+            self._see(self._user(user_id), ip, fingerprint)
+
+    def touch(self, r):
+        """``TrustStateStore.touch`` without Redis; the change is kept for ``reconcile``."""
+        level, penalty = self.rates.check(r["user_id"], r["ip"], r["resource"])
+        with self._lock:
+            state = self._user(r["user_id"])
+            last_ip = state[0]
+            known = self._see(state, r["ip"], r["fingerprint"])
+            score = apply_penalties(r["base_score"] - penalty, last_ip, r["ip"], known, r["ip_exempt"])
+            missed = self._missed_entry(r["user_id"])
+            if missed is not None:
+                missed[0] = r["ip"]
+                if r["store_score"]:
+                    missed[1] = score
+                if not known:
+                    missed[2].add(r["fingerprint"])
+        return LocalSignals(last_ip, level, known, score, 0)
+
+    def _missed_entry(self, user_id):
+        missed = self._missed.get(user_id)
+        if missed is None:
+            if len(self._missed) >= self.max_users:
+                RECONCILE_DROPPED.labels("state").inc()
+                return None
+            missed = self._missed[user_id] = [None, None, set()]
+        return missed
+
+    def keep(self, scores=None, log=()):
+        """Keep trust scores (``{user: score}``) and audit entries that could not be written."""
+        with self._lock:
+            for user_id, score in (scores or {}).items():
+                missed = self._missed_entry(user_id)
+                if missed is not None:
+                    missed[1] = score
+            for entry in log:
+                if len(self._log) >= self.max_log:
+                    RECONCILE_DROPPED.labels("log").inc()
+                    continue
+                self._log.append(entry)
+
+    def pending(self):
+        return bool(self._missed or self._log)
+
+    def reconcile(self, client, access_log, devices, state_ttl_ms, batch=RECONCILE_BATCH):
+        """Write one batch of kept updates to Redis; returns how many were written."""
+        with self._lock:
+            users = [self._missed.popitem(last=False) for _ in range(min(batch, len(self._missed)))]
+            entries = [self._log.popleft() for _ in range(min(batch, len(self._log)))]
+        try:
+            pipe = client.pipeline(transaction=False)
+            for user_id, (ip, score, _) in users:
+                fields = {k: v for k, v in ((FIELD_LAST_IP, ip), (FIELD_TRUST_SCORE, score)) if v is not None}
+                if fields:
+                    pipe.hset(state_key(user_id), mapping=fields)
+                    if state_ttl_ms:
+                        pipe.pexpire(state_key(user_id), state_ttl_ms)
+            for entry in entries:
+                access_log.append(entry, pipe=pipe)
+            pipe.execute()
+            for user_id, (_, _, fingerprints) in users:
+                if fingerprints:
+                    devices.convert(client, user_id, fingerprints)
+        except UNAVAILABLE:
+            # Back in front of anything kept since
+            with self._lock:
+                for user_id, missed in reversed(users):
+                    if user_id not in self._missed:
+                        self._missed[user_id] = missed
+                        self._missed.move_to_end(user_id, last=False)
+                self._log.extendleft(reversed(entries))
+            raise
+        RECONCILED.labels("state").inc(len(users))
+        RECONCILED.labels("log").inc(len(entries))
+        return len(users) + len(entries)
+
+
+# ========== Trust Store Wrapper ==========
+class ResilientTrustStore:
+    """``TrustStateStore`` that scores locally when Redis does not answer.
+
+    ``client`` and ``access_log`` (synchronous) are used to write kept
+    updates back; other attributes are the wrapped store's.
+    """
+
+    def __init__(self, store, guard, access_log, client=None, mode=FAILURE_MODE, local=None,
+                 state_ttl=RETAIN_USER_STATE, reconcile_interval=RECONCILE_INTERVAL):
+        if mode not in _DEGRADED_POLICIES:
+            raise ValueError(f"FAILURE_MODE must be one of {', '.join(_DEGRADED_POLICIES)}")
+        self.store = store
+        self.guard = guard
+        self.access_log = access_log
+        self.client = client if client is not None else store.client
+        self.mode = mode
+        self.local = local if local is not None else LocalStateStore(store.limits)
+        self.devices = DeviceRegistry()
+        self.state_ttl_ms = max(0, state_ttl) * 1000
+        self.reconcile_interval = reconcile_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def touch(self, user_id, ip, fingerprint, **kwargs):
+        try:
+            signals = self.store.touch(user_id, ip, fingerprint, **kwargs)
+        except UNAVAILABLE:
+            return self.local.touch(_request(user_id, ip, fingerprint, **kwargs))
+        self.local.remember(user_id, ip, fingerprint)
+        return signals
+
+    def touch_many(self, requests):
+        try:
+            results = self.store.touch_many(requests)
+        except UNAVAILABLE:
+            return [self.local.touch(_request(**r)) for r in requests]
+        for r in requests:
+            self.local.remember(r["user_id"], r["ip"], r["fingerprint"])
+        return results
+
+    def keep(self, scores=None, log=()):
+        self.local.keep(scores, log)
+
+    def restrict(self, policy):
+        """Policy for a decision scored locally, per ``FAILURE_MODE``."""
+        if self.mode == "closed" or policy["action"] == "allow":
+            policy = _DEGRADED_POLICIES[self.mode]
+        FALLBACK_DECISIONS.labels(self.guard.breaker.layer, policy["action"]).inc()
+        return policy
+
+    # ---------- reconciliation ----------
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="redis-reconcile", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def _run(self):
+        while not self._stop.wait(self.reconcile_interval):
+            try:
+                while self.local.pending() and not self._stop.is_set():
+                    self.local.reconcile(self.client, self.access_log, self.devices, self.state_ttl_ms)
+            except redis.exceptions.RedisError:
+                pass
+
+
+class AsyncResilientTrustStore(ResilientTrustStore):
+    """The same over an ``AsyncTrustStateStore``; ``client`` must be a synchronous client."""
+
+    async def touch(self, user_id, ip, fingerprint, **kwargs):
+        try:
+            signals = await self.store.touch(user_id, ip, fingerprint, **kwargs)
+        except UNAVAILABLE:
+            return self.local.touch(_request(user_id, ip, fingerprint, **kwargs))
+        self.local.remember(user_id, ip, fingerprint)
+        return signals
+
+    async def touch_many(self, requests):
+        try:
+            results = await self.store.touch_many(requests)
+        except UNAVAILABLE:
+            return [self.local.touch(_request(**r)) for r in requests]
+        for r in requests:
+            self.local.remember(r["user_id"], r["ip"], r["fingerprint"])
+        return results
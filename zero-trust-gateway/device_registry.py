@@ -0,0 +1,178 @@
+"""Bounded per-user device registry.
+
+Each user's devices are kept in two keys of the user's slot (see
+``redis_layout.py``):
+
+    user:{<id>}:devices        sorted set  fingerprint -> last seen (ms)
+    user:{<id>}:devices:first  hash        fingerprint -> first seen (ms)
+
+A user keeps at most ``DEVICE_MAX`` devices: adding one more evicts the
+least recently seen.  Devices not seen for ``DEVICE_MAX_AGE`` seconds are
+dropped (0 keeps them until evicted), and both keys expire when the user
+has been idle that long.  "Known device?" is a ZSCORE and "how many
+devices?" a ZCOUNT, so neither transfers the set.
+
+The registry is updated inside the trust scoring script (``DEVICE_LUA``),
+which also reports how long ago the device was first seen.  A known device
+younger than ``DEVICE_YOUNG_AGE`` seconds costs ``DEVICE_YOUNG_PENALTY``
+trust points (0 by default: the age is reported but not scored).
+
+    DEVICE_MAX=20 DEVICE_MAX_AGE=7776000 DEVICE_YOUNG_AGE=86400 DEVICE_YOUNG_PENALTY=10 python app_ziti.py
+"""
+import os
+import time
+
+from redis_layout import devices_key, device_first_key
+
+DEVICE_MAX = int(os.getenv("DEVICE_MAX", "20"))
+DEVICE_MAX_AGE = int(os.getenv("DEVICE_MAX_AGE", str(90 * 86400)))
+DEVICE_YOUNG_AGE = int(os.getenv("DEVICE_YOUNG_AGE", "86400"))
+DEVICE_YOUNG_PENALTY = int(os.getenv("DEVICE_YOUNG_PENALTY", "0"))
+
+# Used by the scoring scripts after RATE_LUA (which defines now_ms).
+# Returns added (0/1), first-seen age in ms, and the number of devices removed.
+DEVICE_LUA = """
+local DEVICE_MAX, DEVICE_MAX_AGE_MS = __DEVICE_MAX__, __DEVICE_MAX_AGE_MS__
+
+local function touch_device(seen_key, first_key, fp)
+    local removed = 0
+    if DEVICE_MAX_AGE_MS > 0 then
+        local stale = redis.call('ZRANGEBYSCORE', seen_key, '-inf', now_ms - DEVICE_MAX_AGE_MS)
+        if #stale > 0 then
+            redis.call('ZREMRANGEBYSCORE', seen_key, '-inf', now_ms - DEVICE_MAX_AGE_MS)
+            redis.call('HDEL', first_key, unpack(stale))
+            removed = #stale
+        end
+    end
+    local added = redis.call('ZADD', seen_key, now_ms, fp)
+    local first
+    if added == 1 then
+        first = now_ms
+        redis.call('HSET', first_key, fp, now_ms)
+        local excess = redis.call('ZCARD', seen_key) - DEVICE_MAX
+        if excess > 0 then
+            -- fp has the newest score, so it is never among the oldest
+            local old = redis.call('ZRANGE', seen_key, 0, excess - 1)
+            redis.call('ZREMRANGEBYRANK', seen_key, 0, excess - 1)
+            redis.call('HDEL', first_key, unpack(old))
+            removed = removed + excess
+        end
+    else
+        first = tonumber(redis.call('HGET', first_key, fp)) or now_ms
+    end
+    if DEVICE_MAX_AGE_MS > 0 then
+        redis.call('PEXPIRE', seen_key, DEVICE_MAX_AGE_MS)
+        redis.call('PEXPIRE', first_key, DEVICE_MAX_AGE_MS)
+    end
+    return added, now_ms - first, removed
+end
+"""
+
+
+class DeviceRegistry:
+    def __init__(self, max_devices=DEVICE_MAX, max_age=DEVICE_MAX_AGE,
+                 young_age=DEVICE_YOUNG_AGE, young_penalty=DEVICE_YOUNG_PENALTY):
+        self.max_devices = max(1, max_devices)
+        self.max_age_ms = max(0, max_age) * 1000
+        self.young_age_ms = max(0, young_age) * 1000
+        self.young_penalty = young_penalty
+        self.fallback_replies = 9 if self.max_age_ms else 7
+
+    def render_lua(self):
+        return (DEVICE_LUA
+                .replace("__DEVICE_MAX__", str(self.max_devices))
+                .replace("__DEVICE_MAX_AGE_MS__", str(self.max_age_ms)))
+
+    def penalty(self, added, age_ms):
+        """Trust points lost for a known device first seen less than ``young_age`` ago."""
+        if added or self.young_penalty <= 0 or age_ms >= self.young_age_ms:
+            return 0
+        return self.young_penalty
+
+    # ---------- queries ----------
+    def _min_seen(self, now_ms=None):
+        if not self.max_age_ms:
+            return "-inf"
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        return now_ms - self.max_age_ms
+
+    def queue_count(self, pipe, user_id):
+        """Queue the live-device count (ZCOUNT, O(log n))."""
+        return pipe.zcount(devices_key(user_id), self._min_seen(), "+inf")
+
+    def queue_fingerprints(self, pipe, user_id):
+        return pipe.zrangebyscore(devices_key(user_id), self._min_seen(), "+inf")
+
+    def known(self, client, user_id, fingerprint):
+        seen = client.zscore(devices_key(user_id), fingerprint)
+        return seen is not None and (not self.max_age_ms or seen > self._min_seen())
+
+    def first_seen_age(self, client, user_id, fingerprint):
+        """Seconds since ``fingerprint`` was first seen for ``user_id``, or ``None``."""
+        first = client.hget(device_first_key(user_id), fingerprint)
+        return None if first is None else max(0.0, time.time() - int(first) / 1000)
+
+    def forget(self, client, user_id, fingerprint):
+        pipe = client.pipeline(transaction=False)
+        pipe.zrem(devices_key(user_id), fingerprint)
+        pipe.hdel(device_first_key(user_id), fingerprint)
+        return pipe.execute()[0]
+
+    # ---------- MULTI/EXEC fallback (no scripting) ----------
+    def queue_fallback(self, pipe, user_id, fingerprint, now_ms):
+        """Queue ``DEVICE_LUA``'s update; returns the number of replies.
+
+        A transaction cannot feed removed members into HDEL, so their
+        first-seen fields are left for ``cleanup``, which also resets the
+        first-seen time of a device re-added over such a leftover.
+        """
+        seen_key, first_key = devices_key(user_id), device_first_key(user_id)
+        cutoff = now_ms - self.max_age_ms if self.max_age_ms else "-inf"
+        pipe.zrangebyscore(seen_key, "-inf", cutoff)
+        pipe.zremrangebyscore(seen_key, "-inf", cutoff)
+        pipe.zadd(seen_key, {fingerprint: now_ms})
+        pipe.hsetnx(first_key, fingerprint, now_ms)
+        pipe.hget(first_key, fingerprint)
+        # Everything but the newest max_devices
+        pipe.zrange(seen_key, 0, -self.max_devices - 1)
+        pipe.zremrangebyrank(seen_key, 0, -self.max_devices - 1)
+        if self.max_age_ms:
+            pipe.pexpire(seen_key, self.max_age_ms)
+            pipe.pexpire(first_key, self.max_age_ms)
+        return self.fallback_replies
+
+    def fallback_result(self, replies, fingerprint, now_ms):
+        """``(added, age_ms, repair)`` from ``queue_fallback``'s replies; ``repair`` goes to ``cleanup``."""
+        stale, added, first_set, first, evicted = replies[0], replies[2], replies[3], replies[4], replies[5]
+        removed = [m for m in list(stale) + list(evicted) if m != fingerprint]
+        reset = {fingerprint: now_ms} if added and not first_set else {}
+        if added:
+            first = now_ms
+        return int(added), now_ms - int(first or now_ms), (removed, reset)
+
+    @staticmethod
+    def cleanup(pipe, user_id, repair):
+        removed, reset = repair
+        if removed:
+            pipe.hdel(device_first_key(user_id), *removed)
+        if reset:
+            pipe.hset(device_first_key(user_id), mapping=reset)
+
+    # ---------- conversion ----------
+    def convert(self, client, user_id, members, now_ms=None):
+        """Register ``members`` as seen now."""
+        key = devices_key(user_id)
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        members = list(members)[-self.max_devices:]
+        if not members:
+            return 0
+        pipe = client.pipeline(transaction=False)
+        pipe.zadd(key, {m: now_ms for m in members}, nx=True)
+        for m in members:
+            pipe.hsetnx(device_first_key(user_id), m, now_ms)
+        pipe.zremrangebyrank(key, 0, -self.max_devices - 1)
+        if self.max_age_ms:
+            pipe.pexpire(key, self.max_age_ms)
+            pipe.pexpire(device_first_key(user_id), self.max_age_ms)
+        pipe.execute()
+        return len(members)
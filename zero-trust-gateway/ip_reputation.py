@@ -0,0 +1,408 @@
+"""IP reputation from local block/allow lists and per-range risk weights.
+
+A JSON file names the list files and what a match costs in trust points:
+
+    {"block_penalty": 100, "risk_penalty": 40,
+     "sources": [{"path": "lists/blocklist.txt", "action": "block"},
+                 {"path": "lists/allowlist.txt", "action": "allow"},
+                 {"path": "lists/risk_ranges.txt", "action": "risk", "weight": 0.5}]}
+
+List files hold one IPv4 or IPv6 CIDR per line (a bare address is a /32 or
+/128), optionally followed by a weight between 0 and 1 for ``risk`` lists;
+``#`` starts a comment.  A block costs ``block_penalty``, a risk range
+``weight * risk_penalty``, an allow entry nothing.  The longest matching
+prefix wins, so an allowlisted /24 inside a blocked /8 is allowed; on the
+same prefix allow beats block, and block beats risk.
+
+The prefixes are compiled into a binary file (``IP_REPUTATION_CACHE``):
+the prefix tree flattened into sorted arrays of range starts, one per
+address family, with the match for each range.  Gateways memory-map that
+file and search it with ``bisect`` in place, so startup does not parse the
+lists, and every worker on a host shares the same pages.  A worker that
+finds the file out of date with the lists compiles it and renames it into
+place.  ``IPReputationStore`` maps a freshly compiled file and swaps the
+reference when a list changes or a message arrives on the reload channel:
+
+    python ip_reputation.py compile ip_reputation.json
+    python ip_reputation.py lookup ip_reputation.json 192.0.2.7 2001:db8::1
+    python ip_reputation.py reload
+"""
+import os
+import sys
+import json
+import mmap
+import socket
+import struct
+import bisect
+import hashlib
+import argparse
+import threading
+from array import array
+from collections import namedtuple
+
+import redis
+from prometheus_client import Counter, Gauge
+
+import redis_layout
+
+IP_REPUTATION_CHANNEL = os.getenv("IP_REPUTATION_CHANNEL", "ip_reputation:reload")
+IP_REPUTATION_RELOAD_SECONDS = float(os.getenv("IP_REPUTATION_RELOAD_SECONDS", "5"))
+
+IP_REPUTATION_RELOADS = Counter("zt_ip_reputation_reloads_total", "IP reputation list reloads", ["result"])
+IP_REPUTATION_LOADED_AT = Gauge("zt_ip_reputation_loaded_timestamp_seconds",
+                                "When the active IP reputation table was loaded", multiprocess_mode="max")
+
+ACTIONS = ("risk", "block", "allow")  # ascending precedence on the same prefix
+
+# magic, format version, byte-order mark, IPv4 ranges, IPv6 ranges, metadata length
+_HEADER = struct.Struct("=4sHHIII12x")
+_MAGIC, _VERSION, _BOM = b"ZTIP", 1, 0x0102
+
+Reputation = namedtuple("Reputation", ["action", "penalty", "source"])
+
+
+class ReputationError(ValueError):
+    pass
+
+
+# ---------- compilation ----------
+def _parse_network(text):
+    """``(address bits, first address, prefix length)`` of a CIDR or bare address."""
+    addr, _, length = text.partition("/")
+    for family, bits in ((socket.AF_INET, 32), (socket.AF_INET6, 128)):
+        try:
+            packed = socket.inet_pton(family, addr)
+        except OSError:
+            continue
+        length = int(length) if length else bits
+        if not 0 <= length <= bits:
+            raise ReputationError(f"bad prefix length: {text}")
+        mask = ((1 << length) - 1) << (bits - length)
+        return bits, int.from_bytes(packed, "big") & mask, length
+    raise ReputationError(f"not an IP network: {text}")
+
+
+def _read_list(path, source):
+    action = source.get("action")
+    if action not in ACTIONS:
+        raise ReputationError(f"{path}: action must be one of {', '.join(ACTIONS)}")
+    default_weight = float(source.get("weight", 1.0))
+    with open(path) as f:
+        for n, line in enumerate(f, 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            try:
+                weight = float(fields[1]) if len(fields) > 1 else default_weight
+                if not 0 <= weight <= 1:
+                    raise ValueError
+                yield _parse_network(fields[0]) + (action, weight)
+            except (ReputationError, ValueError):
+                raise ReputationError(f"{path}:{n}: expected '<cidr> [weight 0..1]', got {line.strip()!r}")
+
+
+def _flatten(prefixes, bits):
+    """Sorted range starts and the value of each range (0 for no match).
+
+    ``prefixes`` maps ``(first address, length)`` to a value; CIDR blocks are
+    either nested or disjoint, so a walk in address order with a stack of
+    enclosing blocks yields the longest match for each range.
+    """
+    starts, values = [], []
+
+    def emit(start, value):
+        if starts and starts[-1] == start:
+            starts.pop()
+            values.pop()
+        if not values or values[-1] != value:
+            starts.append(start)
+            values.append(value)
+
+    stack = []  # (last address, value)
+    for (first, length), value in sorted(prefixes.items()):
+        while stack and stack[-1][0] < first:
+            last, _ = stack.pop()
+            emit(last + 1, stack[-1][1] if stack else 0)
+        emit(first, value)
+        stack.append((first + (1 << (bits - length)) - 1, value))
+    while stack:
+        last, _ = stack.pop()
+        if last + 1 < 1 << bits:
+            emit(last + 1, stack[-1][1] if stack else 0)
+    return starts, values
+
+
+def _resolve(path):
+    return path if os.path.isabs(path) else os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+
+
+def _load_config(path):
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except ValueError as e:
+        raise ReputationError(f"{path}: {e}")
+    base = os.path.dirname(os.path.abspath(path))
+    sources = []
+    for source in config.get("sources", []):
+        if "path" not in source:
+            raise ReputationError(f"{path}: every source needs a path")
+        sources.append(dict(source, path=os.path.join(base, source["path"])))
+    return config, sources
+
+
+def signature(path):
+    """Hash of the config file and the size/mtime of every list it names."""
+    h = hashlib.sha256()
+    st = os.stat(path)
+    h.update(f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}".encode())
+    try:
+        _, sources = _load_config(path)
+    except ReputationError:
+        return h.hexdigest()
+    for source in sources:
+        try:
+            st = os.stat(source["path"])
+            h.update(f"|{source['path']}|{st.st_size}|{st.st_mtime_ns}".encode())
+        except OSError:
+            h.update(f"|{source['path']}|missing".encode())
+    return h.hexdigest()
+
+
+def compile_lists(path, out_path):
+    """Compile the lists named by ``path`` into ``out_path``; returns the range counts."""
+    sig = signature(path)
+    config, sources = _load_config(path)
+    block_penalty = int(config.get("block_penalty", 100))
+    risk_penalty = int(config.get("risk_penalty", 40))
+    by_family = {32: {}, 128: {}}
+    for source in sources:
+        name = os.path.basename(source["path"])
+        for bits, first, length, action, weight in _read_list(source["path"], source):
+            penalty = {"block": block_penalty, "allow": 0}.get(action, round(weight * risk_penalty))
+            new = (ACTIONS.index(action), penalty, name)
+            old = by_family[bits].get((first, length))
+            if old is None or new[:2] > old[:2]:
+                by_family[bits][(first, length)] = new
+
+    matches = sorted({m for prefixes in by_family.values() for m in prefixes.values()})
+    index = {m: i + 1 for i, m in enumerate(matches)}  # 0 = no match
+    flat = {bits: _flatten({k: index[m] for k, m in prefixes.items()}, bits)
+            for bits, prefixes in by_family.items()}
+    (v4_starts, v4_values), (v6_starts, v6_values) = flat[32], flat[128]
+    meta = json.dumps({"signature": sig,
+                       "matches": [[ACTIONS[a], penalty, name] for a, penalty, name in matches]}).encode()
+
+    tmp = f"{out_path}.{os.getpid()}.tmp"
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, _BOM, len(v4_starts), len(v6_starts), len(meta)))
+        # 64-bit arrays first so every array stays aligned to its item size
+        array("Q", [s >> 64 for s in v6_starts]).tofile(f)
+        array("Q", [s & (1 << 64) - 1 for s in v6_starts]).tofile(f)
+        array("I", v4_starts).tofile(f)
+        array("I", v4_values).tofile(f)
+        array("I", v6_values).tofile(f)
+        f.write(meta)
+    os.replace(tmp, out_path)
+    return len(v4_starts), len(v6_starts)
+
+
+# ---------- lookup ----------
+class ReputationTable:
+    """A compiled list file, memory-mapped and searched in place."""
+
+    def __init__(self, out_path):
+        with open(out_path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, bom, n4, n6, meta_len = _HEADER.unpack_from(self._map)
+        except struct.error:
+            raise ReputationError(f"{out_path}: truncated")
+        if (magic, version, bom) != (_MAGIC, _VERSION, _BOM):
+            raise ReputationError(f"{out_path}: not a compiled list for this format/platform")
+        view, offset = memoryview(self._map), _HEADER.size
+        self._v6_hi, offset = view[offset:offset + 8 * n6].cast("Q"), offset + 8 * n6
+        self._v6_lo, offset = view[offset:offset + 8 * n6].cast("Q"), offset + 8 * n6
+        self._v4_starts, offset = view[offset:offset + 4 * n4].cast("I"), offset + 4 * n4
+        self._v4_values, offset = view[offset:offset + 4 * n4].cast("I"), offset + 4 * n4
+        self._v6_values, offset = view[offset:offset + 4 * n6].cast("I"), offset + 4 * n6
+        meta = json.loads(bytes(view[offset:offset + meta_len]))
+        self.signature = meta["signature"]
+        self.matches = [None] + [Reputation(*m) for m in meta["matches"]]
+        self.ranges = (n4, n6)
+
+    @classmethod
+    def load(cls, path, out_path):
+        """Map ``out_path``, compiling it first if it does not match the lists."""
+        try:
+            table = cls(out_path)
+            if table.signature == signature(path):
+                return table
+        except (OSError, ReputationError, ValueError, KeyError):
+            pass
+        compile_lists(path, out_path)
+        return cls(out_path)
+
+    def lookup(self, ip):
+        """Longest-prefix ``Reputation`` for ``ip``, or ``None``."""
+        if not ip:
+            return None
+        try:
+            n = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")
+        except OSError:
+            try:
+                packed = socket.inet_pton(socket.AF_INET6, ip.split("%", 1)[0])
+            except OSError:
+                return None
+            if packed[:12] == b"\0" * 10 + b"\xff\xff":  # IPv4-mapped
+                n = int.from_bytes(packed[12:], "big")
+            else:
+                return self._lookup_v6(int.from_bytes(packed[:8], "big"), int.from_bytes(packed[8:], "big"))
+        i = bisect.bisect_right(self._v4_starts, n) - 1
+        return self.matches[self._v4_values[i]] if i >= 0 else None
+
+    def _lookup_v6(self, hi, lo):
+        # The last range starting at or below (hi, lo): among those sharing the
+        # high half, the low halves are sorted too.
+        left = bisect.bisect_left(self._v6_hi, hi)
+        right = bisect.bisect_right(self._v6_hi, hi, left)
+        i = bisect.bisect_right(self._v6_lo, lo, left, right) - 1
+        if i < left:
+            i = left - 1
+        return self.matches[self._v6_values[i]] if i >= 0 else None
+
+    def penalty(self, ip):
+        match = self.lookup(ip)
+        return match.penalty if match is not None else 0
+
+
+class IPReputationStore:
+    """Holds the active ``ReputationTable`` and replaces it on change.
+
+    A reload maps the new file before the reference is swapped; in-flight
+    lookups finish on the old mapping, which is released once unreferenced.
+    A broken list leaves the old table in place.
+    """
+
+    def __init__(self, path, out_path, client=None, channel=IP_REPUTATION_CHANNEL,
+                 poll_interval=IP_REPUTATION_RELOAD_SECONDS):
+        self.path = path
+        self.out_path = out_path
+        self.client = client
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.table = ReputationTable.load(path, out_path)
+        self._seen = self.table.signature
+        self._stop = threading.Event()
+        self._thread = None
+        IP_REPUTATION_LOADED_AT.set_to_current_time()
+
+    def lookup(self, ip):
+        return self.table.lookup(ip)
+
+    def penalty(self, ip):
+        return self.table.penalty(ip)
+
+    def reload(self):
+        try:
+            table = ReputationTable.load(self.path, self.out_path)
+        except (OSError, ReputationError) as e:
+            IP_REPUTATION_RELOADS.labels(result="error").inc()
+            print(f"IP reputation reload failed, keeping previous lists: {e}", file=sys.stderr)
+            return False
+        self.table = table
+        IP_REPUTATION_RELOADS.labels(result="ok").inc()
+        IP_REPUTATION_LOADED_AT.set_to_current_time()
+        return True
+
+    def _check_files(self):
+        try:
+            sig = signature(self.path)
+        except OSError:
+            return
+        if sig != self._seen:
+            self._seen = sig
+            self.reload()
+
+    # ---------- watcher ----------
+    def start(self):
+        if self._thread is None and self.poll_interval > 0:
+            self._thread = threading.Thread(target=self._watch, name="ip-reputation-reload", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def _watch(self):
+        while not self._stop.is_set():
+            pubsub = None
+            try:
+                if self.client is not None:
+                    pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(self.channel)
+                while not self._stop.is_set():
+                    if pubsub is not None:
+                        if pubsub.get_message(timeout=self.poll_interval) is not None:
+                            self.reload()
+                            continue
+                    else:
+                        self._stop.wait(self.poll_interval)
+                    self._check_files()
+            except (redis.exceptions.RedisError, OSError):
+                # No signal channel for now: keep watching the files and retry
+                self._check_files()
+                self._stop.wait(self.poll_interval)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+
+def from_env(default_path, client=None):
+    """``None`` if ``IP_REPUTATION=false``."""
+    if os.getenv("IP_REPUTATION", "true").lower() != "true":
+        return None
+    path = _resolve(os.getenv("IP_REPUTATION_FILE", default_path))
+    out_path = _resolve(os.getenv("IP_REPUTATION_CACHE", "out/ip_reputation.bin"))
+    return IPReputationStore(path, out_path, client=client)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="IP reputation list tools")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    c = sub.add_parser("compile", help="compile the lists named by a config file")
+    c.add_argument("path")
+    c.add_argument("--out", default="out/ip_reputation.bin")
+    lk = sub.add_parser("lookup", help="show the match for each address")
+    lk.add_argument("path")
+    lk.add_argument("ip", nargs="+")
+    lk.add_argument("--out", default="out/ip_reputation.bin")
+    sub.add_parser("reload", help="ask every gateway to reload its lists")
+    args = ap.parse_args()
+
+    if args.cmd == "compile":
+        try:
+            n4, n6 = compile_lists(args.path, args.out)
+        except (OSError, ReputationError) as e:
+            sys.exit(f"invalid: {e}")
+        print(f"{args.out}: {n4} IPv4 and {n6} IPv6 ranges")
+    elif args.cmd == "lookup":
+        try:
+            table = ReputationTable.load(args.path, args.out)
+        except (OSError, ReputationError) as e:
+            sys.exit(f"invalid: {e}")
+        for ip in args.ip:
+            m = table.lookup(ip)
+            print(f"{ip:<40}" + (f"{m.action:<7}penalty {m.penalty:<4}{m.source}" if m else "-"))
+    else:
+        client = redis_layout.connect()
+        print(f"{client.publish(IP_REPUTATION_CHANNEL, 'reload')} gateway(s) notified")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# jwks_dev.py — Offline stand-in for Keycloak's JWKS endpoint, plus a token minter
+#
+#   python jwks_dev.py serve --port 8099
+#   JWKS_URL=http://localhost:8099/realms/my-company/protocol/openid-connect/certs python app_ziti.py
+#   python jwks_dev.py mint --user alice --roles user,admin
+#   python jwks_dev.py jwks --out dev-keys/jwks.json   # then JWKS_URL=file://$PWD/dev-keys/jwks.json, no server
+#
+# The key in dev-keys/ is generated on first use, per checkout, and never committed (see
+# .gitignore).  It is for local testing only; never point a real deployment at it.
+import os, sys, time, json, uuid, argparse, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+from jwt.algorithms import RSAAlgorithm
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+KEYCLOAK_URL = os.getenv("KEYCLOAK_URL", "http://localhost:8080")
+REALM = os.getenv("REALM", "my-company")
+CLIENT_ID = os.getenv("CLIENT_ID", "my-app")
+KEY_PATH = os.getenv("DEV_SIGNING_KEY", os.path.join(os.path.dirname(os.path.abspath(__file__)), "dev-keys", "dev-signing-key.pem"))
+KID = os.getenv("DEV_SIGNING_KID", "zt-dev-1")
+
+
+def load_or_create_key(path=KEY_PATH):
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return serialization.load_pem_private_key(f.read(), password=None)
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Owner-only, and linked into place so processes starting together agree on one key
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ))
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        return load_or_create_key(path)
+    finally:
+        os.remove(tmp)
+    return key
+
+
+def jwks_document(key, kid=KID):
+    jwk = json.loads(RSAAlgorithm.to_jwk(key.public_key()))
+    jwk.update({"kid": kid, "use": "sig", "alg": "RS256"})
+    return {"keys": [jwk]}
+
+
+def mint_token(key, username, roles=("user",), ttl=3600, kid=KID, issuer=None, audience=CLIENT_ID, extra=None):
+    now = int(time.time())
+    claims = {
+        "exp": now + ttl,
+        "iat": now,
+        "jti": str(uuid.uuid4()),
+        "iss": issuer or f"{KEYCLOAK_URL}/realms/{REALM}",
+        "aud": audience,
+        "sub": str(uuid.uuid5(uuid.NAMESPACE_DNS, username)),
+        "typ": "Bearer",
+        "azp": CLIENT_ID,
+        "preferred_username": username,
+        "realm_access": {"roles": list(roles)},
+    }
+    if extra:
+        claims.update(extra)
+    return jwt.encode(claims, key, algorithm="RS256", headers={"kid": kid})
+
+
+def make_server(key, port=8099, host="127.0.0.1", kid=KID):
+    body = json.dumps(jwks_document(key, kid)).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if not (self.path.endswith("/protocol/openid-connect/certs") or self.path == "/jwks.json"):
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def serve_in_background(key, port=0, host="127.0.0.1"):
+    """Start the stand-in server on a daemon thread; returns (server, jwks_url)."""
+    server = make_server(key, port, host)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://{host}:{server.server_address[1]}/realms/{REALM}/protocol/openid-connect/certs"
+    return server, url
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    s = sub.add_parser("serve")
+    s.add_argument("--host", default="127.0.0.1")
+    s.add_argument("--port", type=int, default=8099)
+    m = sub.add_parser("mint")
+    m.add_argument("--user", default="alice")
+    m.add_argument("--roles", default="user")
+    m.add_argument("--ttl", type=int, default=3600)
+    j = sub.add_parser("jwks")
+    j.add_argument("--out", default=os.path.join(os.path.dirname(KEY_PATH), "jwks.json"))
+    args = ap.parse_args()
+
+    key = load_or_create_key()
+    if args.cmd == "serve":
+        server = make_server(key, args.port, args.host)
+        print(f"JWKS: http://{args.host}:{args.port}/realms/{REALM}/protocol/openid-connect/certs", file=sys.stderr)
+        server.serve_forever()
+    elif args.cmd == "jwks":
+        with open(args.out, "w") as f:
+            json.dump(jwks_document(key), f, indent=2)
+        print(f"JWKS_URL=file://{os.path.abspath(args.out)}", file=sys.stderr)
+    else:
+        print(mint_token(key, args.user, args.roles.split(","), args.ttl))
+
+
+if __name__ == "__main__":
+    main()
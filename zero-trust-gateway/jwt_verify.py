@@ -0,0 +1,226 @@
+"""RS256 token verification with cached JWKS keys.
+
+Signing keys are held in memory and refreshed by a background thread, so the
+request path never waits on Keycloak except the first time an unknown ``kid``
+shows up (and then at most once per ``min_refetch_interval``, by one thread,
+whether or not the fetch succeeds).  Unknown ``kid``s are remembered for
+``negative_ttl`` in a bounded LRU; malformed ones are rejected outright.  Tokens that
+already passed verification are remembered in a bounded LRU keyed by the
+token's SHA-256 and dropped at their ``exp``.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import jwt
+import requests
+from prometheus_client import Counter
+
+TOKEN_CACHE_HITS = Counter("zt_jwt_cache_hits_total", "Tokens answered from the verified-token cache")
+TOKEN_CACHE_MISSES = Counter("zt_jwt_cache_misses_total", "Tokens that needed a signature check")
+
+_KID = re.compile(r"[A-Za-z0-9._~+/=:-]{1,128}\Z")
+
+
+class JWKSCache:
+    def __init__(self, jwks_url, refresh_interval=300, min_refetch_interval=10, negative_ttl=60, timeout=5,
+                 max_missing=1024):
+        self.jwks_url = jwks_url
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.max_missing = max(1, max_missing)
+
+        self._keys = {}
+        self._missing = OrderedDict()  # kid -> time until which lookups fail fast, oldest first
+        self._last_fetch = 0.0
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start the background refresh thread (idempotent)."""
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="jwks-refresh", daemon=True)
+            self._refresher.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:
+                pass  # keep serving the keys we already have
+
+    def refresh(self):
+        if self.jwks_url.startswith("file://"):
+            # A local JWKS document (e.g. `python jwks_dev.py jwks`) for offline testing
+            with open(self.jwks_url[len("file://"):], encoding="utf-8") as f:
+                document = json.load(f)
+        else:
+            resp = requests.get(self.jwks_url, timeout=self.timeout)
+            resp.raise_for_status()
+            document = resp.json()
+        keys = {}
+        for jwk in document.get("keys", []):
+            if jwk.get("use", "sig") != "sig" or "kid" not in jwk:
+                continue
+            try:
+                keys[jwk["kid"]] = jwt.PyJWK(jwk).key
+            except jwt.PyJWKError:
+                continue
+        self._keys = keys
+        with self._lock:
+            self._last_fetch = max(self._last_fetch, time.monotonic())
+            for kid in [k for k in self._missing if k in keys]:
+                del self._missing[kid]
+        return keys
+
+    def _remember_missing(self, kid, now):
+        with self._lock:
+            self._missing.pop(kid, None)
+            self._missing[kid] = now + self.negative_ttl
+            # Entries share one TTL, so the oldest expires first
+            while len(self._missing) > self.max_missing or next(iter(self._missing.values())) <= now:
+                self._missing.popitem(last=False)
+
+    def get_key(self, kid):
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+        if not isinstance(kid, str) or not _KID.match(kid):
+            raise jwt.PyJWKClientError("Malformed signing key id")
+
+        self.start()
+        now = time.monotonic()
+        if self._missing.get(kid, 0) > now:
+            raise jwt.PyJWKClientError(f"Unknown signing key: {kid}")
+
+        # Claim the fetch under the lock, fetch outside it: concurrent lookups fail
+        # fast instead of queueing behind a slow or unreachable JWKS endpoint
+        with self._lock:
+            fetch = now - self._last_fetch >= self.min_refetch_interval
+            if fetch:
+                self._last_fetch = now
+        error = None
+        if fetch:
+            try:
+                self.refresh()
+            except Exception as e:
+                error = e
+        key = self._keys.get(kid)
+        if key is None:
+            self._remember_missing(kid, now)
+            if error is not None and not self._keys:
+                raise jwt.PyJWKClientError(f"Failed to fetch JWKS: {error}")
+            raise jwt.PyJWKClientError(f"Unknown signing key: {kid}")
+        return key
+
+
+class VerifiedTokenCache:
+    """Bounded LRU of verified claims keyed by token hash, expiring at ``exp``."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        k = self.key(token)
+        with self._lock:
+            entry = self._entries.get(k)
+            if entry is None:
+                return None
+            claims, exp = entry
+            if exp <= time.time():
+                del self._entries[k]
+                return None
+            self._entries.move_to_end(k)
+            return claims
+
+    def put(self, token, claims):
+        if self.maxsize <= 0:
+            return
+        k = self.key(token)
+        with self._lock:
+            self._entries[k] = (claims, claims["exp"])
+            self._entries.move_to_end(k)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TokenVerifier:
+    def __init__(self, jwks, audience=None, issuer=None, algorithms=("RS256",), leeway=0,
+                 cache_size=10000, verify=True):
+        self.jwks = jwks
+        self.audience = audience or None
+        self.issuer = issuer or None
+        self.algorithms = list(algorithms)
+        self.leeway = leeway
+        self.verify = verify
+        self.cache = VerifiedTokenCache(cache_size)
+
+    def cached(self, token):
+        """Claims for a token verified earlier, or None. Never does I/O."""
+        if not self.verify:
+            return None
+        claims = self.cache.get(token)
+        if claims is not None:
+            TOKEN_CACHE_HITS.inc()
+        return claims
+
+    def decode(self, token):
+        if not self.verify:
+            return jwt.decode(token, options={"verify_signature": False})
+
+        claims = self.cache.get(token)
+        if claims is not None:
+            TOKEN_CACHE_HITS.inc()
+            return claims
+        TOKEN_CACHE_MISSES.inc()
+
+        kid = jwt.get_unverified_header(token).get("kid")
+        if not kid:
+            raise jwt.InvalidTokenError("Token header has no kid")
+        claims = jwt.decode(
+            token, self.jwks.get_key(kid), algorithms=self.algorithms,
+            audience=self.audience, issuer=self.issuer, leeway=self.leeway,
+            options={"require": ["exp", "iat"], "verify_aud": self.audience is not None},
+        )
+        self.cache.put(token, claims)
+        return claims
+
+
+def from_env(keycloak_url, realm, client_id):
+    """Build the verifier the gateways share from environment settings."""
+    issuer = os.getenv("OIDC_ISSUER", f"{keycloak_url}/realms/{realm}")
+    jwks_url = os.getenv("JWKS_URL", f"{issuer}/protocol/openid-connect/certs")
+    jwks = JWKSCache(
+        jwks_url,
+        refresh_interval=int(os.getenv("JWKS_REFRESH_SECONDS", "300")),
+        min_refetch_interval=int(os.getenv("JWKS_MIN_REFETCH_SECONDS", "10")),
+        negative_ttl=int(os.getenv("JWKS_NEGATIVE_TTL", "60")),
+        max_missing=int(os.getenv("JWKS_NEGATIVE_MAX", "1024")),
+    )
+    return TokenVerifier(
+        jwks,
+        audience=os.getenv("JWT_AUDIENCE", client_id),
+        issuer=issuer,
+        leeway=int(os.getenv("JWT_LEEWAY", "0")),
+        cache_size=int(os.getenv("JWT_CACHE_SIZE", "10000")),
+        verify=os.getenv("JWT_VERIFY", "true").lower() == "true",
+    )
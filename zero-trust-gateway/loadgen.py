@@ -0,0 +1,353 @@
+# loadgen.py — Open-loop load generator for /api/access-request
+#
+# Requests are scheduled at a target arrival rate whatever the gateway is
+# doing, and latency is measured from each request's *scheduled* send time,
+# so a stalled gateway shows up as queueing delay instead of a slower client
+# (no coordinated omission).  Traffic is a weighted mix of run_all.GROUPS.
+#
+#   python loadgen.py --profile constant --rate 500 --duration 30
+#   python loadgen.py --profile step --rates 100,250,500,1000,2000 --step-duration 20
+#   python loadgen.py --profile ramp --rate 100 --to-rate 3000 --steps 15 --step-duration 10
+#   python loadgen.py --profile soak --rate 300 --duration 3600 --interval 60
+#
+# Requests come from --users synthetic users (synthetic_users.py: realm roles,
+# devices, addresses and Zipf activity), with tokens minted by the dev key, so
+# run the gateway with JWKS_URL pointing at `python jwks_dev.py serve` or at
+# file://.../dev-keys/jwks.json (or JWT_VERIFY=false), and with
+# TRUSTED_PROXIES=1 so the users' addresses (sent as X-Forwarded-For) count;
+# --keycloak uses run_all.get_token() for one real user.
+import os, csv, json, random, asyncio, argparse
+from collections import Counter, defaultdict
+from urllib.parse import urlsplit
+
+from bench_async import HTTPConnection
+from run_all import GROUPS
+
+API_URL = os.getenv("GATEWAY_URL", "http://localhost:5000/api/access-request")
+OUT_DIR = "out"
+SUMMARY_CSV = os.path.join(OUT_DIR, "loadgen_summary.csv")
+
+
+class LatencyHistogram:
+    """Log-linear histogram of microsecond values (HdrHistogram-style).
+
+    Values below 2**SUB_BITS are exact; above that each power of two is split
+    into 2**(SUB_BITS-1) buckets, i.e. about 0.2% relative precision.
+    Storage is sparse, so an hour-long soak costs a few thousand buckets.
+    """
+
+    SUB_BITS = 10
+
+    def __init__(self):
+        self.counts = Counter()
+        self.total = 0
+        self.max = 0
+        self.sum = 0
+
+    def record(self, seconds):
+        v = max(0, int(seconds * 1e6))
+        e = max(0, v.bit_length() - self.SUB_BITS)
+        self.counts[(e << self.SUB_BITS) | (v >> e)] += 1
+        self.total += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def _value(self, index):
+        e, m = index >> self.SUB_BITS, index & ((1 << self.SUB_BITS) - 1)
+        return ((m << e) + ((m + 1) << e) - 1) / 2
+
+    def percentile(self, q):
+        """Value at quantile ``q`` (0..1), in milliseconds."""
+        if not self.total:
+            return 0.0
+        rank, seen = max(1, int(q * self.total + 0.5)), 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._value(index), self.max) / 1000
+        return self.max / 1000
+
+    def mean(self):
+        return self.sum / self.total / 1000 if self.total else 0.0
+
+    def write_hgrm(self, path):
+        """Percentile distribution in the HdrHistogram text layout."""
+        with open(path, "w") as f:
+            f.write(f"{'Value(ms)':>12} {'Percentile':>14} {'TotalCount':>10} {'1/(1-Percentile)':>18}\n\n")
+            seen = 0
+            for index in sorted(self.counts):
+                seen += self.counts[index]
+                p = seen / self.total
+                inv = f"{1 / (1 - p):18.2f}" if p < 1 else f"{'inf':>18}"
+                f.write(f"{self._value(index) / 1000:12.3f} {p:14.12f} {seen:10d} {inv}\n")
+            f.write(f"#[Mean = {self.mean():.3f}, Max = {self.max / 1000:.3f}, Total count = {self.total}]\n")
+
+
+class Phase:
+    def __init__(self, label, rate, duration):
+        self.label, self.rate, self.duration = label, rate, duration
+        self.latency = LatencyHistogram()
+        self.send_lag = LatencyHistogram()
+        self.scheduled = 0
+        self.completed = 0  # completions while this phase was the active one
+        self.statuses = Counter()
+        self.decisions = defaultdict(Counter)  # group -> action -> count
+        self.errors = Counter()
+        self.max_waiting = 0
+
+
+def build_profile(args):
+    if args.profile == "constant":
+        return [Phase(f"{args.rate:g}/s", args.rate, args.duration)]
+    if args.profile == "soak":
+        n = max(1, int(args.duration // args.interval))
+        return [Phase(f"t+{i * args.interval:g}s", args.rate, args.interval) for i in range(n)]
+    if args.profile == "step":
+        return [Phase(f"{r:g}/s", r, args.step_duration) for r in (float(x) for x in args.rates.split(","))]
+    # ramp: linear from --rate to --to-rate in --steps steps
+    steps = max(2, args.steps)
+    rates = [args.rate + (args.to_rate - args.rate) * i / (steps - 1) for i in range(steps)]
+    return [Phase(f"{r:.0f}/s", r, args.step_duration) for r in rates]
+
+
+def build_mix(spec):
+    """Weights per GROUPS entry; defaults to each group's request count in run_all."""
+    weights = {name: times for name, _, times, _, _ in GROUPS}
+    if spec:
+        weights = {k: 0 for k in weights}
+        for part in spec.split(","):
+            name, _, w = part.partition("=")
+            if name not in weights:
+                raise SystemExit(f"unknown group {name!r}; known: {', '.join(weights)}")
+            weights[name] = float(w or 1)
+    groups = [(name, resource, headers) for name, resource, _, _, headers in GROUPS if weights[name] > 0]
+    return groups, [weights[name] for name, _, _ in groups]
+
+
+class SingleUser:
+    """Every request with one fixed token (--token / --keycloak)."""
+
+    def __init__(self, token):
+        self.token = token
+
+    def request(self, rng, resource):
+        return {"Authorization": f"Bearer {self.token}", "User-Agent": "loadgen/1.0"}, {"resource": resource}
+
+
+class SyntheticUsers:
+    """Requests spread over a synthetic population, tokens minted up front."""
+
+    def __init__(self, size, seed=None):
+        from synthetic_users import Population, TokenFactory, SYNTHETIC_SEED
+        self.population = Population(size, SYNTHETIC_SEED if seed is None else seed)
+        self.factory = TokenFactory(ttl=24 * 3600)
+        self.factory.mint_all(self.population)
+
+    def request(self, rng, resource):
+        user = self.population.pick(rng)
+        headers, body = self.population.request(user, rng, resource)
+        headers["Authorization"] = f"Bearer {self.factory.token(user)}"
+        return headers, body
+
+
+def make_users(args):
+    if args.token:
+        return SingleUser(args.token)
+    if args.keycloak:
+        from run_all import get_token
+        return SingleUser(get_token())
+    return SyntheticUsers(args.users, args.seed)
+
+
+class LoadGenerator:
+    def __init__(self, url, connections, timeout, users, groups, weights, arrivals="uniform", seed=None):
+        u = urlsplit(url)
+        self.host, self.port, self.path = u.hostname, u.port or 80, u.path
+        self.timeout = timeout
+        self.users = users
+        self.groups, self.weights = groups, weights
+        self.arrivals = arrivals
+        self.rng = random.Random(seed)
+        self.pool = asyncio.Queue()
+        for _ in range(connections):
+            self.pool.put_nowait(HTTPConnection(self.host, self.port))
+        self.waiting = 0
+        self.pending = set()
+        self.active = None
+
+    def _next_request(self):
+        name, resource, extra = self.rng.choices(self.groups, self.weights)[0]
+        headers, body = self.users.request(self.rng, resource)
+        headers.update({"Content-Type": "application/json", **extra})
+        return name, headers, json.dumps(body).encode()
+
+    async def _send(self, phase, intended):
+        loop = asyncio.get_running_loop()
+        # Scheduler lateness only; waiting for a free connection counts as gateway latency
+        phase.send_lag.record(loop.time() - intended)
+        name, headers, body = self._next_request()
+        self.waiting += 1
+        phase.max_waiting = max(phase.max_waiting, self.waiting)
+        conn = await self.pool.get()
+        self.waiting -= 1
+        try:
+            status, payload = await asyncio.wait_for(conn.request("POST", self.path, headers, body), self.timeout)
+        except asyncio.TimeoutError:
+            await conn.close()
+            phase.errors["timeout"] += 1
+            status = "ERR"
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            await conn.close()
+            phase.errors[type(e).__name__] += 1
+            status = "ERR"
+        finally:
+            self.pool.put_nowait(conn)
+        phase.latency.record(loop.time() - intended)
+        if self.active is not None:
+            self.active.completed += 1
+        phase.statuses[status] += 1
+        if status != "ERR":
+            try:
+                action = json.loads(payload).get("access_decision") or f"http_{status}"
+            except ValueError:
+                action = f"http_{status}"
+            phase.decisions[name][action] += 1
+
+    async def run(self, phases):
+        loop = asyncio.get_running_loop()
+        t = loop.time()
+        for phase in phases:
+            self.active = phase
+            end = t + phase.duration
+            interval = 1.0 / phase.rate
+            while t < end:
+                delay = t - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                task = loop.create_task(self._send(phase, t))
+                self.pending.add(task)
+                task.add_done_callback(self.pending.discard)
+                phase.scheduled += 1
+                t += self.rng.expovariate(phase.rate) if self.arrivals == "poisson" else interval
+        self.active = None  # stragglers still get latencies but no longer count as throughput
+        if self.pending:
+            await asyncio.wait(self.pending, timeout=self.timeout + 5)
+        while not self.pool.empty():
+            await self.pool.get_nowait().close()
+
+
+def distribution(counter):
+    total = sum(counter.values())
+    return {k: v / total for k, v in counter.items()} if total else {}
+
+
+def drift(phase, baseline):
+    """Largest per-group total-variation distance from the baseline decision mix."""
+    worst = 0.0
+    for group, counts in phase.decisions.items():
+        p, q = distribution(counts), distribution(baseline.decisions.get(group, Counter()))
+        if not q:
+            continue
+        worst = max(worst, 0.5 * sum(abs(p.get(a, 0) - q.get(a, 0)) for a in set(p) | set(q)))
+    return worst
+
+
+def report(phases, args):
+    baseline = phases[0]
+    rows = []
+    print(f"{'phase':<12}{'target':>8}{'achieved':>10}{'p50':>9}{'p90':>9}{'p99':>9}{'p99.9':>9}{'max':>9}"
+          f"{'errors':>8}{'lag p99':>9}{'drift':>7}")
+    saturation = None
+    for phase in phases:
+        done = phase.latency.total
+        achieved = phase.completed / phase.duration
+        errors = sum(phase.errors.values())
+        row = {
+            "phase": phase.label, "target_rps": round(phase.rate, 1), "achieved_rps": round(achieved, 1),
+            "scheduled": phase.scheduled, "completed": done, "errors": errors,
+            "p50_ms": phase.latency.percentile(0.50), "p90_ms": phase.latency.percentile(0.90),
+            "p99_ms": phase.latency.percentile(0.99), "p999_ms": phase.latency.percentile(0.999),
+            "max_ms": phase.latency.max / 1000, "send_lag_p99_ms": phase.send_lag.percentile(0.99),
+            "max_waiting": phase.max_waiting, "decision_drift": round(drift(phase, baseline), 3),
+            "statuses": json.dumps({str(k): v for k, v in phase.statuses.items()}),
+            "decisions": json.dumps({g: dict(c) for g, c in phase.decisions.items()}),
+        }
+        rows.append(row)
+        print(f"{row['phase']:<12}{row['target_rps']:>8.0f}{achieved:>10.0f}{row['p50_ms']:>9.2f}{row['p90_ms']:>9.2f}"
+              f"{row['p99_ms']:>9.2f}{row['p999_ms']:>9.2f}{row['max_ms']:>9.1f}{errors:>8}"
+              f"{row['send_lag_p99_ms']:>9.2f}{row['decision_drift']:>7.2f}")
+        if saturation is None and (achieved < 0.95 * phase.rate or errors > 0.01 * max(1, phase.scheduled)
+                                   or row["p99_ms"] > args.slo_ms):
+            saturation = phase
+
+    overall = LatencyHistogram()
+    for phase in phases:
+        overall.merge(phase.latency)
+    print(f"\noverall: {overall.total} requests  p50 {overall.percentile(0.5):.2f}  p90 {overall.percentile(0.9):.2f}"
+          f"  p99 {overall.percentile(0.99):.2f}  p99.9 {overall.percentile(0.999):.2f}  max {overall.max / 1000:.1f} ms")
+    if saturation is None:
+        print(f"saturation: not reached (p99 <= {args.slo_ms:g} ms, >= 95% of target rate, < 1% errors)")
+    else:
+        print(f"saturation: {saturation.label} (target {saturation.rate:.0f}/s; "
+              f"last healthy phase: {phases[phases.index(saturation) - 1].label if phases.index(saturation) else 'none'})")
+    drifted = [r["phase"] for r in rows if r["decision_drift"] > args.max_drift]
+    if drifted:
+        print(f"decision mix drifted more than {args.max_drift:g} from {baseline.label} in: {', '.join(drifted)}")
+    if max(r["send_lag_p99_ms"] for r in rows) > 10:
+        print("warning: send lag p99 > 10 ms, the generator itself is falling behind; use fewer rps per process")
+
+    os.makedirs(OUT_DIR, exist_ok=True)
+    with open(args.out, "w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=list(rows[0]))
+        w.writeheader()
+        w.writerows(rows)
+    print(f" - {args.out}")
+    if args.hgrm:
+        overall.write_hgrm(args.hgrm)
+        print(f" - {args.hgrm}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Open-loop load generator for the zero-trust gateway")
+    ap.add_argument("--url", default=API_URL)
+    ap.add_argument("--profile", choices=["constant", "step", "ramp", "soak"], default="constant")
+    ap.add_argument("--rate", type=float, default=200, help="requests/s (start rate for ramp)")
+    ap.add_argument("--to-rate", type=float, default=2000, help="ramp end rate")
+    ap.add_argument("--rates", default="100,250,500,1000,2000", help="step profile rates")
+    ap.add_argument("--steps", type=int, default=10, help="ramp steps")
+    ap.add_argument("--step-duration", type=float, default=15)
+    ap.add_argument("--duration", type=float, default=30, help="constant/soak duration (s)")
+    ap.add_argument("--interval", type=float, default=60, help="soak reporting interval (s)")
+    ap.add_argument("--arrivals", choices=["uniform", "poisson"], default="poisson")
+    ap.add_argument("-c", "--connections", type=int, default=256, help="keep-alive connection pool size")
+    ap.add_argument("--timeout", type=float, default=10)
+    ap.add_argument("--mix", help="group weights, e.g. OK=8,STEPUP=1,DENY=1 (default: run_all.GROUPS counts)")
+    ap.add_argument("--users", type=int, default=200, help="synthetic users to spread load over (synthetic_users.py)")
+    ap.add_argument("--token", default=os.getenv("TOKEN") or None)
+    ap.add_argument("--keycloak", action="store_true", help="use one Keycloak token (run_all.get_token)")
+    ap.add_argument("--slo-ms", type=float, default=250, help="p99 above this marks saturation")
+    ap.add_argument("--max-drift", type=float, default=0.1, help="allowed decision-mix drift vs first phase")
+    ap.add_argument("--seed", type=int)
+    ap.add_argument("--out", default=SUMMARY_CSV)
+    ap.add_argument("--hgrm", help="write the overall latency distribution here")
+    args = ap.parse_args()
+
+    phases = build_profile(args)
+    groups, weights = build_mix(args.mix)
+    gen = LoadGenerator(args.url, args.connections, args.timeout, make_users(args), groups, weights,
+                        args.arrivals, args.seed)
+    total = sum(p.duration for p in phases)
+    print(f"==> {args.profile}: {len(phases)} phase(s), {total:g}s, {args.connections} connections -> {args.url}")
+    asyncio.run(gen.run(phases))
+    report(phases, args)
+
+
+if __name__ == "__main__":
+    main()
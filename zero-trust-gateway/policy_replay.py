@@ -0,0 +1,536 @@
+"""Replay logged decisions under candidate weights and thresholds.
+
+Reads the decision logs written by ``decision_sink.py`` (CSV or JSONL,
+rotated and gzipped files included) in chunks and counts every distinct
+``(user, resource, via_ziti, network_score, app_score, logged action)``
+into a compact histogram.  Every decision is a function of exactly those
+fields, so each candidate is evaluated once per histogram entry with NumPy
+rather than once per log line: the log is parsed once and a sweep of
+hundreds of candidates costs seconds on top.
+
+A candidate is the policy file (``POLICY_FILE``, default policy_ziti.json)
+with the ``min_score`` of every band of an action replaced, plus the
+network-layer weight of the combined score (app_ziti.py: 0.3, the app
+layer gets the rest).  The weight applies to decisions logged with
+``via_ziti`` (``--assume-ziti``: to all of them); the others score the app
+layer alone, as the gateway does.
+
+For each candidate: the transition matrix logged action -> replayed action,
+the same per resource, and per user the decisions made stricter or looser
+(by band order in the policy file).  The first candidate is the unchanged
+policy; its diagonal shows how much of the log the replay reproduces.
+
+    python policy_replay.py out/decisions_ziti.csv
+    python policy_replay.py out/ --network-weight 0.2,0.3,0.4 --threshold allow=75,80,85 --threshold require_mfa=35,40
+    python policy_replay.py out/ --save out/replay.npz            # keep the histogram ...
+    python policy_replay.py out/replay.npz --policy candidate.json --json out/whatif.json   # ... and sweep from it
+"""
+import os
+import sys
+import glob
+import json
+import copy
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from policy_table import PolicyError, PolicyTable
+
+CHUNK_ROWS = 1_000_000
+COMPACT_ENTRIES = 4_000_000
+SPLIT_MIN_BYTES = 64 * 1024 * 1024
+NETWORK_WEIGHT = 0.3
+
+COLUMNS = ["user_id", "network_score", "app_score", "resource", "action", "via_ziti"]
+LOG_PATTERNS = ("*.csv", "*.csv.gz", "*.jsonl", "*.jsonl.gz")
+
+# Histogram key, low bits first: action 8, via_ziti 1, network score 8, app score 8, resource 15, user 24.
+# Scores are clipped to [-128, 127], beyond every threshold in use.
+_FIELDS = (("action", 8), ("via", 1), ("network", 8), ("app", 8), ("resource", 15), ("user", 24))
+_SCORE_OFFSET = 128
+
+
+def _layout():
+    shifts, shift = {}, 0
+    for name, bits in _FIELDS:
+        shifts[name] = (shift, bits)
+        shift += bits
+    return shifts
+
+
+_SHIFTS = _layout()
+
+
+def _pack(**fields):
+    key = np.zeros(len(next(iter(fields.values()))), dtype=np.uint64)
+    for name, values in fields.items():
+        shift, _ = _SHIFTS[name]
+        key |= values.astype(np.uint64) << np.uint64(shift)
+    return key
+
+
+def _unpack(keys, name):
+    shift, bits = _SHIFTS[name]
+    return ((keys >> np.uint64(shift)) & np.uint64((1 << bits) - 1)).astype(np.int64)
+
+
+class Names:
+    """String <-> dense id, for one histogram field."""
+
+    def __init__(self, field, names=()):
+        self.field = field
+        self.names = list(names)
+        self.ids = {n: i for i, n in enumerate(self.names)}
+        self.limit = 1 << _SHIFTS[field][1]
+
+    def __len__(self):
+        return len(self.names)
+
+    def encode(self, column):
+        """Dense ids of a Series (one dict lookup per distinct value)."""
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            codes, uniques = column.cat.codes.to_numpy(), column.cat.categories
+        else:
+            codes, uniques = pd.factorize(column.to_numpy(), use_na_sentinel=False)
+        ids = np.fromiter((self._id(str(u)) for u in uniques), dtype=np.int64, count=len(uniques))
+        return ids[codes]
+
+    def _id(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            if len(self.names) >= self.limit:
+                raise ValueError(f"more than {self.limit} distinct {self.field} values")
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+
+class _ByteRange:
+    """Read-only view of the next ``size`` bytes of a file."""
+
+    def __init__(self, f, size):
+        self.f = f
+        self.left = size
+
+    def read(self, n=-1):
+        n = self.left if n is None or n < 0 else min(n, self.left)
+        data = self.f.read(n)
+        self.left -= len(data)
+        return data
+
+    def __iter__(self):
+        # pandas only checks that file handles are iterable
+        return iter(self.read().splitlines(keepends=True))
+
+
+class DecisionHistogram:
+    """Counts of distinct ``(user, resource, via_ziti, scores, action)`` over a decision log."""
+
+    def __init__(self):
+        self.users = Names("user")
+        self.resources = Names("resource")
+        self.actions = Names("action")
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.rows = 0
+        self._pending = []
+
+    # ---------- building ----------
+    def add(self, frame):
+        """Count one chunk of log rows (a DataFrame with ``COLUMNS``)."""
+        app = pd.to_numeric(frame["app_score"], errors="coerce")
+        network = pd.to_numeric(frame["network_score"], errors="coerce").fillna(app)
+        frame = frame[app.notna() & frame["user_id"].notna() & frame["action"].notna()]
+        if frame.empty:
+            return
+        app, network = app[frame.index].to_numpy(), network[frame.index].to_numpy()
+        via = frame["via_ziti"]
+        if via.dtype != bool:
+            via = via.astype(str).str.lower() == "true"
+        resource = frame["resource"]
+        if resource.hasnans:
+            resource = resource.astype(str).where(resource.notna(), "/")
+        keys = _pack(
+            action=self.actions.encode(frame["action"]),
+            via=via.to_numpy(),
+            network=np.clip(network, -_SCORE_OFFSET, _SCORE_OFFSET - 1).astype(np.int64) + _SCORE_OFFSET,
+            app=np.clip(app, -_SCORE_OFFSET, _SCORE_OFFSET - 1).astype(np.int64) + _SCORE_OFFSET,
+            resource=self.resources.encode(resource),
+            user=self.users.encode(frame["user_id"]),
+        )
+        keys, counts = np.unique(keys, return_counts=True)
+        self._pending.append((keys, counts))
+        self.rows += int(counts.sum())
+        if sum(len(k) for k, _ in self._pending) > COMPACT_ENTRIES:
+            self._compact()
+
+    def _compact(self):
+        if not self._pending:
+            return
+        keys = np.concatenate([self.keys] + [k for k, _ in self._pending])
+        counts = np.concatenate([self.counts] + [c for _, c in self._pending])
+        self._pending = []
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(self.keys)).astype(np.int64)
+
+    def read(self, path, chunk_rows=CHUNK_ROWS, start=0, end=None):
+        """Add the rows of one decision log file (of a plain CSV, those in bytes ``[start, end)``)."""
+        if path.endswith((".jsonl", ".jsonl.gz")):
+            for chunk in pd.read_json(path, lines=True, chunksize=chunk_rows, dtype=False):
+                self.add(chunk.reindex(columns=COLUMNS))
+            return
+        options = dict(usecols=lambda c: c in COLUMNS, chunksize=chunk_rows,
+                       dtype={c: "category" for c in ("user_id", "resource", "action", "via_ziti")})
+        if not start and end is None:
+            for chunk in pd.read_csv(path, **options):
+                self.add(chunk.reindex(columns=COLUMNS))
+            return
+        with open(path, "rb") as f:
+            header = f.readline().decode("utf-8").strip().split(",")
+            f.seek(start)
+            for chunk in pd.read_csv(_ByteRange(f, end - start), header=None, names=header, **options):
+                self.add(chunk.reindex(columns=COLUMNS))
+
+    # ---------- persistence ----------
+    def save(self, path):
+        self._compact()
+        np.savez_compressed(path, keys=self.keys, counts=self.counts, rows=self.rows,
+                            users=np.array(self.users.names, dtype=object),
+                            resources=np.array(self.resources.names, dtype=object),
+                            actions=np.array(self.actions.names, dtype=object))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path, allow_pickle=True)
+        h = cls()
+        h.keys, h.counts, h.rows = data["keys"], data["counts"], int(data["rows"])
+        h.users = Names("user", data["users"].tolist())
+        h.resources = Names("resource", data["resources"].tolist())
+        h.actions = Names("action", data["actions"].tolist())
+        return h
+
+    def merge(self, other):
+        """Add another histogram's counts (ids are remapped)."""
+        other._compact()
+        remap = {}
+        for field in ("users", "resources", "actions"):
+            mine, theirs = getattr(self, field), getattr(other, field)
+            remap[mine.field] = np.fromiter((mine._id(n) for n in theirs.names), dtype=np.int64, count=len(theirs))
+        fields = {name: _unpack(other.keys, name) for name, _ in _FIELDS}
+        for name, ids in remap.items():
+            fields[name] = ids[fields[name]] if len(ids) else fields[name]
+        self._pending.append((_pack(**fields), other.counts))
+        self.rows += other.rows
+        self._compact()
+
+    def columns(self):
+        """Decoded key fields (scores back in their own range) plus counts."""
+        self._compact()
+        cols = {name: _unpack(self.keys, name) for name, _ in _FIELDS}
+        cols["network"] -= _SCORE_OFFSET
+        cols["app"] -= _SCORE_OFFSET
+        cols["via"] = cols["via"].astype(bool)
+        cols["count"] = self.counts
+        return cols
+
+
+class VectorPolicy:
+    """``PolicyTable.decide`` over arrays: action ids for ``(resource id, score, network, app)``."""
+
+    def __init__(self, table, resources, actions):
+        rules, self._rule_of = [], np.zeros(len(resources), dtype=np.int64)
+        by_id = {}
+        for i, resource in enumerate(resources.names):
+            rule = table.match(resource)
+            if id(rule) not in by_id:
+                by_id[id(rule)] = len(rules)
+                rules.append(rule)
+            self._rule_of[i] = by_id[id(rule)]
+        self._rules = []
+        for rule in rules:
+            bands = [[(np.array(bounds, dtype=float), actions._id(policy["action"])) for bounds, policy in variants]
+                     for variants in rule.bands]
+            self._rules.append((np.array(rule.thresholds, dtype=float), bands))
+
+    def decide(self, resource, score, network, app):
+        out = np.full(len(score), -1, dtype=np.int64)
+        rule_of = self._rule_of[resource]
+        for r, (thresholds, bands) in enumerate(self._rules):
+            in_rule = np.flatnonzero(rule_of == r)
+            if not len(in_rule):
+                continue
+            band = np.maximum(np.searchsorted(thresholds, score[in_rule], side="right") - 1, 0)
+            for b, variants in enumerate(bands):
+                rows = in_rule[band == b]
+                n, a = network[rows], app[rows]
+                undecided = np.ones(len(rows), dtype=bool)
+                for (nmin, nmax, amin, amax), action in variants:
+                    hit = undecided & (n >= nmin) & (n <= nmax) & (a >= amin) & (a <= amax)
+                    out[rows[hit]] = action
+                    undecided &= ~hit
+        return out
+
+
+# ========== Candidates ==========
+def with_thresholds(document, thresholds):
+    """Copy of a policy document with ``min_score`` replaced for every band of the given actions."""
+    doc = copy.deepcopy(document)
+    band_lists = [doc.get("bands", [])] + [r["bands"] for r in doc.get("resources", []) if "bands" in r]
+    for bands in band_lists:
+        for band in bands:
+            if band.get("action") in thresholds:
+                band["min_score"] = thresholds[band["action"]]
+    return doc
+
+
+def strictness(document):
+    """Action -> rank, loosest first, from the order of the default bands."""
+    bands = sorted(document.get("bands", []), key=lambda b: -b["min_score"])
+    return {b["action"]: i for i, b in enumerate(bands)}
+
+
+def candidates(document, weights, threshold_grid):
+    """``[(label, weight, document)]``; the unchanged policy at ``NETWORK_WEIGHT`` comes first."""
+    out = [("current", NETWORK_WEIGHT, document)]
+    actions = sorted(threshold_grid)
+    for weight in weights:
+        for values in itertools.product(*(threshold_grid[a] for a in actions)):
+            thresholds = dict(zip(actions, values))
+            if weight == NETWORK_WEIGHT and not thresholds:
+                continue
+            label = " ".join([f"w={weight:g}"] + [f"{a}>={v:g}" for a, v in thresholds.items()])
+            out.append((label, weight, with_thresholds(document, thresholds)))
+    return out
+
+
+class Replay:
+    """Evaluates candidates against one histogram.
+
+    A decision depends on ``(resource, via_ziti, scores)`` only, so each
+    candidate decides the distinct ones of those and the result is spread to
+    the histogram entries by index.
+    """
+
+    def __init__(self, histogram, document, assume_ziti=False):
+        self.h = histogram
+        self.entries = histogram.columns()
+        decision_mask = np.uint64(0)
+        for name in ("via", "network", "app", "resource"):
+            shift, bits = _SHIFTS[name]
+            decision_mask |= np.uint64(((1 << bits) - 1) << shift)
+        action_mask = np.uint64(((1 << _SHIFTS["action"][1]) - 1) << _SHIFTS["action"][0])
+
+        # entries -> (decision inputs, logged action) -> decision inputs
+        keys, self._to_logged = np.unique(histogram.keys & (decision_mask | action_mask), return_inverse=True)
+        self.logged = {"action": _unpack(keys, "action"), "resource": _unpack(keys, "resource"),
+                       "count": np.bincount(self._to_logged, weights=histogram.counts).astype(np.int64)}
+        keys, self._to_inputs = np.unique(keys & decision_mask, return_inverse=True)
+        self.inputs = {name: _unpack(keys, name) for name in ("resource", "network", "app")}
+        self.inputs["network"] -= _SCORE_OFFSET
+        self.inputs["app"] -= _SCORE_OFFSET
+        self.weighted = np.ones(len(keys), dtype=bool) if assume_ziti else _unpack(keys, "via").astype(bool)
+        self.rank = strictness(document)
+        self._scores = {}
+
+    def combined(self, weight):
+        # int(n * w + a * (1 - w)) as in app_ziti.py; float64 rounding matches Python's
+        if weight not in self._scores:
+            n, a = self.inputs["network"].astype(float), self.inputs["app"].astype(float)
+            self._scores[weight] = np.where(self.weighted, np.trunc(n * weight + a * (1 - weight)), a)
+        return self._scores[weight]
+
+    def run(self, label, weight, document, top=10):
+        policy = VectorPolicy(PolicyTable(document), self.h.resources, self.h.actions)
+        i = self.inputs
+        replayed = policy.decide(i["resource"], self.combined(weight), i["network"], i["app"])[self._to_inputs]
+        logged, counts = self.logged["action"], self.logged["count"]
+        names = self.h.actions.names
+        k = len(names)
+        matrix = np.bincount(logged * k + replayed, weights=counts, minlength=k * k).reshape(k, k)
+        per_resource = np.bincount((self.logged["resource"] * k + logged) * k + replayed, weights=counts,
+                                   minlength=len(self.h.resources) * k * k).reshape(-1, k, k)
+
+        # Stricter/looser by band order; actions the policy does not know count as changed only
+        rank = np.array([self.rank.get(a, -1) for a in names])
+        direction = np.where((rank[logged] >= 0) & (rank[replayed] >= 0), np.sign(rank[replayed] - rank[logged]), 0)
+
+        # Per user, over the changed entries only
+        e = self.entries
+        changed = np.flatnonzero(replayed[self._to_logged] != e["action"])
+        users, weights = e["user"][changed], e["count"][changed]
+        user_direction = direction[self._to_logged[changed]]
+        n_users = len(self.h.users)
+        user_changed = np.bincount(users, weights=weights, minlength=n_users)
+        user_stricter = np.bincount(users, weights=weights * (user_direction > 0), minlength=n_users)
+        user_looser = np.bincount(users, weights=weights * (user_direction < 0), minlength=n_users)
+        top_users = np.argsort(-user_changed, kind="stable")[:top]
+
+        return {
+            "label": label,
+            "network_weight": weight,
+            "decisions": int(counts.sum()),
+            "changed": int(matrix.sum() - np.trace(matrix)),
+            "stricter": int(counts[direction > 0].sum()),
+            "looser": int(counts[direction < 0].sum()),
+            "users_affected": int((user_changed > 0).sum()),
+            "transitions": _transitions(matrix, names),
+            "resources": {self.h.resources.names[r]: _transitions(m, names)
+                          for r, m in enumerate(per_resource) if m.sum() > np.trace(m)},
+            "top_users": [{"user_id": self.h.users.names[u], "changed": int(user_changed[u]),
+                           "stricter": int(user_stricter[u]), "looser": int(user_looser[u])}
+                          for u in top_users if user_changed[u] > 0],
+        }
+
+
+def _transitions(matrix, names):
+    """``{"from->to": count}`` for every nonzero cell."""
+    out = {}
+    for i, j in zip(*np.nonzero(matrix)):
+        out[f"{names[i]}->{names[j]}"] = int(matrix[i, j])
+    return out
+
+
+# ========== CLI ==========
+def log_files(paths):
+    out = []
+    for p in paths:
+        if os.path.isdir(p):
+            out += sorted(f for pattern in LOG_PATTERNS for f in glob.glob(os.path.join(p, pattern)))
+        else:
+            out.append(p)
+    return out
+
+
+def split(path, parts):
+    """``[(start, end)]`` byte ranges of a plain CSV, cut at line ends; ``[(0, None)]`` for other files."""
+    size = os.path.getsize(path)
+    if parts < 2 or not path.endswith(".csv") or size < SPLIT_MIN_BYTES:
+        return [(0, None)]
+    cuts = []
+    with open(path, "rb") as f:
+        f.readline()
+        cuts.append(f.tell())
+        for i in range(1, parts):
+            f.seek(max(size * i // parts, cuts[-1]))
+            f.readline()
+            cuts.append(f.tell())
+    cuts.append(size)
+    return [(a, b) for a, b in zip(cuts, cuts[1:]) if b > a]
+
+
+def _read_part(task):
+    path, start, end, chunk_rows = task
+    if path.endswith(".npz"):
+        return DecisionHistogram.load(path)
+    h = DecisionHistogram()
+    h.read(path, chunk_rows, start, end)
+    return h
+
+
+def build_histogram(paths, chunk_rows=CHUNK_ROWS, workers=1):
+    """One histogram over every file; with ``workers`` > 1, files and large CSVs are read in parallel."""
+    tasks = []
+    for path in log_files(paths):
+        ranges = [(0, None)] if path.endswith(".npz") else split(path, workers)
+        tasks += [(path, start, end, chunk_rows) for start, end in ranges]
+    h = DecisionHistogram()
+    if workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            for part in pool.imap_unordered(_read_part, tasks):
+                h.merge(part)
+    else:
+        for path, start, end, _ in tasks:
+            if path.endswith(".npz"):
+                h.merge(DecisionHistogram.load(path))
+            else:
+                h.read(path, chunk_rows, start, end)
+    h._compact()
+    return h
+
+
+def _floats(text):
+    return [float(v) for v in text.split(",") if v.strip()]
+
+
+def _threshold(text):
+    action, _, values = text.partition("=")
+    if not values:
+        raise argparse.ArgumentTypeError("expected ACTION=V1,V2,...")
+    return action, _floats(values)
+
+
+def _moves(transitions):
+    """The off-diagonal part of ``transitions``."""
+    return {t: n for t, n in transitions.items() if len(set(t.split("->"))) == 2}
+
+
+def print_report(results, top):
+    """Summary row per candidate; matrices too when there is a single candidate to compare."""
+    width = max(len("candidate"), *(len(r["label"]) for r in results)) + 2
+    print(f"{'candidate':<{width}}{'changed':>10}{'%':>8}{'stricter':>10}{'looser':>10}{'users':>8}")
+    for r in results:
+        pct = 100 * r["changed"] / r["decisions"] if r["decisions"] else 0.0
+        print(f"{r['label']:<{width}}{r['changed']:>10}{pct:>8.2f}{r['stricter']:>10}{r['looser']:>10}"
+              f"{r['users_affected']:>8}")
+    for r in results[-1:] if len(results) <= 2 else ():
+        print(f"\n{r['label']}: {r['decisions']} decisions")
+        for t, n in sorted(r["transitions"].items(), key=lambda kv: -kv[1]):
+            print(f"  {t:<40}{n:>10}")
+        by_resource = sorted(r["resources"].items(), key=lambda kv: -sum(_moves(kv[1]).values()))
+        for resource, transitions in by_resource[:top]:
+            print(f"  resource {resource}: " + ", ".join(f"{t} {n}" for t, n in _moves(transitions).items()))
+        for u in r["top_users"]:
+            print(f"  user {u['user_id']}: {u['changed']} changed ({u['stricter']} stricter, {u['looser']} looser)")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="What-if replay of decision logs under candidate policies")
+    ap.add_argument("paths", nargs="+", help="decision logs, directories of them, or saved .npz histograms")
+    ap.add_argument("--policy", default=os.getenv("POLICY_FILE", "policy_ziti.json"), help="base policy file")
+    ap.add_argument("--network-weight", type=_floats, default=[NETWORK_WEIGHT],
+                    help=f"network-layer weights to try (default {NETWORK_WEIGHT})")
+    ap.add_argument("--threshold", type=_threshold, action="append", default=[],
+                    help="ACTION=V1,V2,...: min_score values to try for that action's bands (repeatable)")
+    ap.add_argument("--assume-ziti", action="store_true", help="weight every decision, not only via_ziti ones")
+    ap.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processes reading the logs")
+    ap.add_argument("--top", type=int, default=10, help="resources and users listed per candidate")
+    ap.add_argument("--save", help="write the histogram to this .npz for later sweeps")
+    ap.add_argument("--json", help="write every candidate's matrices to this file")
+    args = ap.parse_args()
+
+    path = args.policy
+    if not os.path.isabs(path) and not os.path.exists(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    try:
+        document = PolicyTable.load(path).document
+    except (OSError, PolicyError) as e:
+        sys.exit(f"policy: {e}")
+    grid = dict(args.threshold)
+    unknown = set(grid) - set(strictness(document))
+    if unknown:
+        sys.exit(f"no bands for action(s): {', '.join(sorted(unknown))}")
+
+    h = build_histogram(args.paths, args.chunk_rows, args.workers)
+    if args.save:
+        h.save(args.save)
+    print(f"{h.rows} decisions, {len(h.keys)} distinct, {len(h.users)} users, {len(h.resources)} resources",
+          file=sys.stderr)
+
+    replay = Replay(h, document, assume_ziti=args.assume_ziti)
+    try:
+        results = [replay.run(label, w, doc, top=args.top) for label, w, doc in candidates(document, args.network_weight, grid)]
+    except PolicyError as e:
+        sys.exit(f"candidate policy: {e}")
+    print_report(results, args.top)
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"policy": args.policy, "decisions": h.rows, "candidates": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""Access policies compiled from a JSON file.
+
+The file lists score bands (highest ``min_score`` first, each with action,
+restrictions, monitoring level and reason, plus optional ``variants`` keyed
+on the network/application scores) and per-resource-prefix rules that can
+mark a prefix sensitive or override its bands:
+
+    {"bands": [{"min_score": 80, "action": "allow", ...}, ...],
+     "resources": [{"prefix": "/admin", "sensitive": true},
+                   {"prefix": "/finance", "bands": [...]}]}
+
+Loading compiles it into a character trie over the prefixes and, per rule,
+an ascending array of band thresholds, so a decision costs one walk along
+the resource path plus a binary search and returns a shared read-only
+policy mapping.  ``PolicyStore`` swaps in a freshly compiled table when the
+file changes or a message arrives on the reload channel:
+
+    python policy_table.py check policy_ziti.json
+    python policy_table.py reload
+"""
+import os
+import sys
+import json
+import bisect
+import argparse
+import threading
+from types import MappingProxyType
+from collections import namedtuple
+
+import redis
+from prometheus_client import Counter, Gauge
+
+import redis_layout
+
+POLICY_CHANNEL = os.getenv("POLICY_CHANNEL", "policy:reload")
+POLICY_RELOAD_SECONDS = float(os.getenv("POLICY_RELOAD_SECONDS", "2"))
+
+POLICY_RELOADS = Counter("zt_policy_reloads_total", "Policy table reloads", ["result"])
+POLICY_LOADED_AT = Gauge("zt_policy_loaded_timestamp_seconds", "When the active policy table was loaded",
+                         multiprocess_mode="max")
+
+_POLICY_FIELDS = ("action", "restrictions", "monitoring_level", "reason")
+_CONDITIONS = ("network_score_min", "network_score_max", "app_score_min", "app_score_max")
+_UNBOUNDED = (float("-inf"), float("inf"), float("-inf"), float("inf"))
+
+Rule = namedtuple("Rule", ["prefix", "sensitive", "thresholds", "bands"])
+
+
+class PolicyError(ValueError):
+    pass
+
+
+def _freeze(fields):
+    restrictions = fields.get("restrictions")
+    return MappingProxyType({
+        "action": fields["action"],
+        "restrictions": tuple(restrictions) if restrictions is not None else None,
+        "monitoring_level": fields["monitoring_level"],
+        "reason": fields["reason"],
+    })
+
+
+# A score below a rule's lowest band matches no band and is denied
+BELOW_LOWEST_BAND = _freeze({"action": "deny", "restrictions": ["blocked"], "monitoring_level": "alert",
+                             "reason": "below_lowest_band"})
+
+
+def _compile_bands(bands, where):
+    """Ascending thresholds plus, per band, ``((bounds, policy), ...)`` tried in order."""
+    if not bands:
+        raise PolicyError(f"{where}: at least one band is required")
+    compiled = []
+    for band in bands:
+        missing = [f for f in ("min_score",) + _POLICY_FIELDS if f not in band]
+        if missing:
+            raise PolicyError(f"{where}: band is missing {', '.join(missing)}")
+        variants = []
+        for v in band.get("variants", []):
+            when = v.get("when", {})
+            unknown = set(when) - set(_CONDITIONS)
+            if unknown:
+                raise PolicyError(f"{where}: unknown condition {sorted(unknown)}")
+            bounds = (
+                when.get("network_score_min", _UNBOUNDED[0]), when.get("network_score_max", _UNBOUNDED[1]),
+                when.get("app_score_min", _UNBOUNDED[2]), when.get("app_score_max", _UNBOUNDED[3]),
+            )
+            variants.append((bounds, _freeze(dict(band, **{k: v[k] for k in _POLICY_FIELDS if k in v}))))
+        variants.append((_UNBOUNDED, _freeze(band)))
+        compiled.append((band["min_score"], tuple(variants)))
+    compiled.sort(key=lambda b: b[0])
+    return tuple(b[0] for b in compiled), tuple(b[1] for b in compiled)
+
+
+class PolicyTable:
+    """Immutable compiled policy; share it freely between threads."""
+
+    _VALUE = ""  # trie node key holding the rule; never a path character
+
+    def __init__(self, document, source=None):
+        self.source = source
+        self.document = document
+        default = Rule("", False, *_compile_bands(document.get("bands"), "bands"))
+        self._root = {self._VALUE: default}
+
+        # Longer prefixes inherit bands and sensitivity from the nearest configured parent
+        for res in sorted(document.get("resources", []), key=lambda r: len(r.get("prefix", ""))):
+            prefix = res.get("prefix")
+            if not isinstance(prefix, str) or not prefix.startswith("/"):
+                raise PolicyError(f"resources: prefix must start with '/': {prefix!r}")
+            parent = self.match(prefix)
+            if "bands" in res:
+                thresholds, bands = _compile_bands(res["bands"], prefix)
+            else:
+                thresholds, bands = parent.thresholds, parent.bands
+            node = self._root
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node[self._VALUE] = Rule(prefix, bool(res.get("sensitive", parent.sensitive)), thresholds, bands)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            try:
+                document = json.load(f)
+            except json.JSONDecodeError as e:
+                raise PolicyError(f"{path}: {e}") from e
+        return cls(document, source=path)
+
+    def match(self, resource):
+        """Rule of the longest configured prefix of ``resource``."""
+        node = self._root
+        rule = node[self._VALUE]
+        for ch in resource or "/":
+            node = node.get(ch)
+            if node is None:
+                break
+            rule = node.get(self._VALUE, rule)
+        return rule
+
+    def is_sensitive(self, resource):
+        return self.match(resource).sensitive
+
+    def decide(self, resource, score, network_score=None, app_score=None):
+        rule = self.match(resource)
+        i = bisect.bisect_right(rule.thresholds, score) - 1
+        if i < 0:
+            return BELOW_LOWEST_BAND
+        n = network_score if network_score is not None else score
+        a = app_score if app_score is not None else score
+        for (nmin, nmax, amin, amax), policy in rule.bands[i]:
+            if nmin <= n <= nmax and amin <= a <= amax:
+                return policy
+
+
+class PolicyStore:
+    """Holds the active ``PolicyTable`` and replaces it on change.
+
+    A reload compiles the new table completely before the reference is
+    swapped, so in-flight requests finish on the old table and a broken file
+    leaves the old table in place.
+    """
+
+    def __init__(self, path, client=None, channel=POLICY_CHANNEL, poll_interval=POLICY_RELOAD_SECONDS):
+        self.path = path
+        self.client = client
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.table = PolicyTable.load(path)
+        self._mtime = self._stat()
+        self._stop = threading.Event()
+        self._thread = None
+        POLICY_LOADED_AT.set_to_current_time()
+
+    def decide(self, resource, score, network_score=None, app_score=None):
+        return self.table.decide(resource, score, network_score, app_score)
+
+    def is_sensitive(self, resource):
+        return self.table.is_sensitive(resource)
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload(self):
+        try:
+            table = PolicyTable.load(self.path)
+        except (OSError, PolicyError) as e:
+            POLICY_RELOADS.labels(result="error").inc()
+            print(f"policy reload failed, keeping previous table: {e}", file=sys.stderr)
+            return False
+        self.table = table
+        POLICY_RELOADS.labels(result="ok").inc()
+        POLICY_LOADED_AT.set_to_current_time()
+        return True
+
+    def _check_file(self):
+        mtime = self._stat()
+        if mtime is not None and mtime != self._mtime:
+            self._mtime = mtime
+            self.reload()
+
+    # ---------- watcher ----------
+    def start(self):
+        if self._thread is None and self.poll_interval > 0:
+            self._thread = threading.Thread(target=self._watch, name="policy-reload", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def _watch(self):
+        while not self._stop.is_set():
+            pubsub = None
+            try:
+                if self.client is not None:
+                    pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(self.channel)
+                while not self._stop.is_set():
+                    if pubsub is not None:
+                        if pubsub.get_message(timeout=self.poll_interval) is not None:
+                            self._mtime = self._stat()
+                            self.reload()
+                            continue
+                    else:
+                        self._stop.wait(self.poll_interval)
+                    self._check_file()
+            except (redis.exceptions.RedisError, OSError):
+                # No signal channel for now: keep watching the file and retry
+                self._check_file()
+                self._stop.wait(self.poll_interval)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+
+def from_env(default_path, client=None):
+    path = os.getenv("POLICY_FILE", default_path)
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    return PolicyStore(path, client=client)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Policy table tools")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    c = sub.add_parser("check", help="compile a policy file and print its decisions")
+    c.add_argument("path")
+    c.add_argument("--resource", action="append", help="resource to show (repeatable)")
+    sub.add_parser("reload", help="ask every gateway to reload its policy file")
+    args = ap.parse_args()
+
+    if args.cmd == "check":
+        try:
+            table = PolicyTable.load(args.path)
+        except PolicyError as e:
+            sys.exit(f"invalid: {e}")
+        for resource in args.resource or ["/"]:
+            rule = table.match(resource)
+            print(f"{resource}  (rule {rule.prefix or '<default>'}, sensitive={rule.sensitive})")
+            for score in reversed(rule.thresholds):
+                p = table.decide(resource, score)
+                print(f"  >= {score:<4}{p['action']:<18}{p['reason']}")
+    else:
+        client = redis_layout.connect()
+        print(f"{client.publish(POLICY_CHANNEL, 'reload')} gateway(s) notified")
+
+
+if __name__ == "__main__":
+    main()
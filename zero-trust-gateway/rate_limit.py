@@ -0,0 +1,288 @@
+"""Access-rate signals: sliding-window counters and token buckets.
+
+Rules are read from a JSON file (``RATE_LIMIT_FILE``, default
+``rate_limits.json``).  Each rule counts requests per user or per client IP,
+optionally only for resources under given prefixes (a "resource class"),
+and subtracts ``penalty`` from the trust score while the rule is exceeded:
+
+    {"rules": [
+      {"name": "user", "scope": "user", "algorithm": "sliding_window", "limit": 30, "window": 60, "penalty": 30},
+      {"name": "ip", "scope": "ip", "algorithm": "sliding_window", "limit": 300, "window": 60, "penalty": 20},
+      {"name": "admin", "scope": "user", "resources": ["/admin"], "algorithm": "token_bucket",
+       "rate": 0.2, "burst": 5, "penalty": 25}
+    ]}
+
+Both algorithms keep one small hash per rule and subject (O(1) memory) and
+run inside the trust scoring script, so every rule that applies to a
+request is checked in the same single round trip (see ``trust_state.py``).
+The sliding window weights the previous fixed window by how much of it
+still overlaps the last ``window`` seconds; the token bucket refills at
+``rate`` tokens per second up to ``burst``.  Time comes from Redis, so all
+replicas agree on it.
+
+``LocalRateLimiter`` applies the same rules in process memory, per replica,
+for use when the rate state cannot live in Redis (``RATE_LIMIT_MODE=local``).
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict, namedtuple
+
+RATE_LIMIT_MODE = os.getenv("RATE_LIMIT_MODE", "redis").lower()
+
+SLIDING_WINDOW = "sliding_window"
+TOKEN_BUCKET = "token_bucket"
+
+RateRule = namedtuple("RateRule", ["name", "scope", "algorithm", "limit", "window", "rate", "burst", "penalty", "resources"])
+
+# The per-user rule the gateways have always applied: more than 30 requests a minute
+DEFAULT_RULES = (RateRule("user", "user", SLIDING_WINDOW, 30, 60, None, None, 30, ()),)
+
+# Lua used by the scoring scripts.  RULES is rendered from the rule list as
+# {algorithm, a, b, penalty} with a/b = limit/window_ms or rate_per_ms/burst.
+RATE_LUA = """
+local RULES = {__RULES__}
+local now = redis.call('TIME')
+local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+
+local function sliding_window(key, limit, window_ms)
+    local idx = math.floor(now_ms / window_ms)
+    local h = redis.call('HMGET', key, 'w', 'c', 'p')
+    local w, cur, prev = tonumber(h[1]), tonumber(h[2]) or 0, tonumber(h[3]) or 0
+    if w ~= idx then
+        if w == idx - 1 then prev = cur else prev = 0 end
+        cur = 0
+    end
+    cur = cur + 1
+    redis.call('HSET', key, 'w', idx, 'c', cur, 'p', prev)
+    redis.call('PEXPIRE', key, window_ms * 2)
+    local level = prev * (1 - (now_ms % window_ms) / window_ms) + cur
+    return level, level > limit
+end
+
+local function token_bucket(key, rate_per_ms, burst)
+    local h = redis.call('HMGET', key, 't', 'ts')
+    local tokens = tonumber(h[1]) or burst
+    local ts = tonumber(h[2]) or now_ms
+    tokens = math.min(burst, tokens + math.max(0, now_ms - ts) * rate_per_ms)
+    local over = tokens < 1
+    if not over then
+        tokens = tokens - 1
+    end
+    redis.call('HSET', key, 't', tostring(tokens), 'ts', now_ms)
+    redis.call('PEXPIRE', key, math.ceil(burst / rate_per_ms) + 1000)
+    return burst - tokens, over
+end
+
+-- rate keys are KEYS[first..#KEYS]; their rule numbers follow ARGV[argv_offset]
+local function check_rates(first, argv_offset)
+    local level, penalty = 0, 0
+    for i = first, #KEYS do
+        local rule = RULES[tonumber(ARGV[argv_offset + i - first])]
+        local l, over
+        if rule[1] == 1 then
+            l, over = sliding_window(KEYS[i], rule[2], rule[3])
+        else
+            l, over = token_bucket(KEYS[i], rule[2], rule[3])
+        end
+        if i == first then
+            level = math.floor(l + 0.5)
+        end
+        if over then
+            penalty = penalty + rule[4]
+        end
+    end
+    return level, penalty
+end
+"""
+
+
+class RateLimitError(ValueError):
+    pass
+
+
+def _rule(spec):
+    name = spec.get("name")
+    scope = spec.get("scope", "user")
+    algorithm = spec.get("algorithm", SLIDING_WINDOW)
+    if not name:
+        raise RateLimitError("every rule needs a name")
+    if scope not in ("user", "ip"):
+        raise RateLimitError(f"{name}: scope must be 'user' or 'ip'")
+    if algorithm == SLIDING_WINDOW:
+        if spec.get("limit", 0) <= 0 or spec.get("window", 0) <= 0:
+            raise RateLimitError(f"{name}: sliding_window needs a positive limit and window")
+    elif algorithm == TOKEN_BUCKET:
+        if spec.get("rate", 0) <= 0 or spec.get("burst", 0) < 1:
+            raise RateLimitError(f"{name}: token_bucket needs a positive rate and burst >= 1")
+    else:
+        raise RateLimitError(f"{name}: unknown algorithm {algorithm!r}")
+    return RateRule(name, scope, algorithm, spec.get("limit"), spec.get("window"), spec.get("rate"),
+                    spec.get("burst"), int(spec.get("penalty", 0)), tuple(spec.get("resources", ())))
+
+
+class RateLimits:
+    """An ordered, immutable set of rules.
+
+    ``keys`` picks the rules that apply to a request; the first applicable
+    rule's level is what ``TrustSignals.access_count`` reports.
+    """
+
+    def __init__(self, rules=DEFAULT_RULES):
+        self.rules = tuple(rules)
+        names = [r.name for r in self.rules]
+        if len(set(names)) != len(names):
+            raise RateLimitError("rule names must be unique")
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(_rule(spec) for spec in json.load(f).get("rules", []))
+
+    @classmethod
+    def from_env(cls, default_path="rate_limits.json"):
+        path = os.getenv("RATE_LIMIT_FILE", default_path)
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+        return cls.load(path) if os.path.exists(path) else cls()
+
+    @staticmethod
+    def key(rule, subject):
+        # Hash-tagged like the user's other keys (redis_layout.py)
+        return f"rate:{rule.name}:{{{subject}}}"
+
+    def keys(self, user_id, ip, resource="/"):
+        """``[(rule_number, key)]`` for the rules that apply; rule numbers start at 1 (Lua)."""
+        out = []
+        for n, rule in enumerate(self.rules, 1):
+            if rule.resources and not (resource or "/").startswith(rule.resources):
+                continue
+            out.append((n, self.key(rule, user_id if rule.scope == "user" else ip)))
+        return out
+
+    def user_key(self, user_id):
+        """Key of the first unconditional per-user rule, for read-only views."""
+        for rule in self.rules:
+            if rule.scope == "user" and not rule.resources:
+                return rule, self.key(rule, user_id)
+        return None, None
+
+    # ---------- MULTI/EXEC fallback (no scripting) ----------
+    # Plain fixed-window counters, one key per window, combined the same way as
+    # the Lua sliding window; token buckets are approximated as a window of
+    # burst/rate seconds allowing ``burst`` requests.
+    def _window(self, rule):
+        if rule.algorithm == SLIDING_WINDOW:
+            return rule.limit, int(rule.window * 1000)
+        return rule.burst, int(rule.burst / rule.rate * 1000)
+
+    def queue_fallback(self, pipe, keys, now_ms):
+        """Queue the counter commands for ``keys``; returns the number of replies."""
+        for n, key in keys:
+            _, window_ms = self._window(self.rules[n - 1])
+            idx = now_ms // window_ms
+            pipe.incr(f"{key}:{idx}")
+            pipe.pexpire(f"{key}:{idx}", window_ms * 2)
+            pipe.get(f"{key}:{idx - 1}")
+        return 3 * len(keys)
+
+    def fallback_check(self, replies, keys, now_ms):
+        level, penalty = 0, 0
+        for i, (n, _) in enumerate(keys):
+            rule = self.rules[n - 1]
+            limit, window_ms = self._window(rule)
+            cur, prev = int(replies[3 * i]), int(replies[3 * i + 2] or 0)
+            l = prev * (1 - (now_ms % window_ms) / window_ms) + cur
+            if i == 0:
+                level = int(l + 0.5)
+            if l > limit:
+                penalty += rule.penalty
+        return level, penalty
+
+    def render_lua(self):
+        entries = []
+        for r in self.rules:
+            if r.algorithm == SLIDING_WINDOW:
+                entries.append(f"{{1, {r.limit}, {int(r.window * 1000)}, {r.penalty}}}")
+            else:
+                entries.append(f"{{2, {r.rate / 1000!r}, {r.burst}, {r.penalty}}}")
+        return RATE_LUA.replace("__RULES__", ", ".join(entries))
+
+
+def sliding_level(rule, fields, now_ms=None):
+    """Current sliding-window level from a rule hash, without counting a request."""
+    if rule is None or rule.algorithm != SLIDING_WINDOW or not fields or fields.get("w") is None:
+        return 0
+    window_ms = int(rule.window * 1000)
+    now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+    idx = now_ms // window_ms
+    w, cur, prev = int(fields["w"]), int(fields.get("c") or 0), int(fields.get("p") or 0)
+    if w == idx - 1:
+        prev, cur = cur, 0
+    elif w != idx:
+        return 0
+    return round(prev * (1 - (now_ms % window_ms) / window_ms) + cur)
+
+
+def current_level(client, limits, user_id):
+    """Requests counted for ``user_id`` by its per-user rule (read-only)."""
+    rule, key = limits.user_key(user_id)
+    return sliding_level(rule, client.hgetall(key)) if key else 0
+
+
+class LocalRateLimiter:
+    """Per-process approximation of the Redis rules (bounded LRU of subjects)."""
+
+    def __init__(self, limits, maxsize=100000):
+        self.limits = limits
+        self.maxsize = maxsize
+        self._state = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, user_id, ip, resource="/"):
+        """Count one request; returns ``(level, penalty)`` like the Lua ``check_rates``."""
+        now_ms = time.time() * 1000
+        level, penalty = 0, 0
+        with self._lock:
+            for i, (n, key) in enumerate(self.limits.keys(user_id, ip, resource)):
+                rule = self.limits.rules[n - 1]
+                if rule.algorithm == SLIDING_WINDOW:
+                    l, over = self._sliding(key, rule.limit, rule.window * 1000, now_ms)
+                else:
+                    l, over = self._bucket(key, rule.rate / 1000, rule.burst, now_ms)
+                if i == 0:
+                    level = int(l + 0.5)
+                if over:
+                    penalty += rule.penalty
+        return level, penalty
+
+    def _get(self, key, default):
+        state = self._state.get(key)
+        if state is None:
+            state = self._state[key] = default
+            if len(self._state) > self.maxsize:
+                self._state.popitem(last=False)
+        else:
+            self._state.move_to_end(key)
+        return state
+
+    def _sliding(self, key, limit, window_ms, now_ms):
+        state = self._get(key, [None, 0, 0])
+        idx = now_ms // window_ms
+        if state[0] != idx:
+            state[2] = state[1] if state[0] == idx - 1 else 0
+            state[1] = 0
+            state[0] = idx
+        state[1] += 1
+        level = state[2] * (1 - (now_ms % window_ms) / window_ms) + state[1]
+        return level, level > limit
+
+    def _bucket(self, key, rate_per_ms, burst, now_ms):
+        state = self._get(key, [float(burst), now_ms])
+        tokens = min(burst, state[0] + max(0.0, now_ms - state[1]) * rate_per_ms)
+        over = tokens < 1
+        if not over:
+            tokens -= 1
+        state[0], state[1] = tokens, now_ms
+        return burst - tokens, over
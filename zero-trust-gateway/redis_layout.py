@@ -0,0 +1,259 @@
+"""Redis key layout and connections.
+
+Per-user state:
+
+    user:{<id>}                hash   last_ip, trust_score
+    user:{<id>}:devices        zset   device fingerprint -> last seen (see device_registry.py)
+    user:{<id>}:devices:first  hash   device fingerprint -> first seen
+    user:{<id>}:baseline       string behavioral baseline record (see behavior_baseline.py)
+    user:{<id>}:stepup         hash   step-up grants and challenges per device (see step_up.py)
+    rate:<rule>:{<subject>}    hash   rate-rule state (see rate_limit.py)
+
+The braces are a Redis Cluster hash tag: only the text inside them is
+hashed, so every key of a user lands on the same slot and the scoring
+script can read and write them together on any deployment.  Scalar fields
+share one hash, so a profile read is a single HGETALL.
+
+``connect`` builds the client for the deployment named by ``REDIS_MODE``:
+
+    REDIS_MODE=standalone  REDIS_HOST, REDIS_PORT (default)
+    REDIS_MODE=sentinel    REDIS_SENTINELS=host:26379,host2:26379  REDIS_SENTINEL_MASTER=mymaster
+    REDIS_MODE=cluster     REDIS_CLUSTER_NODES=host:7000,host2:7000 (default REDIS_HOST:REDIS_PORT)
+
+Moving existing data from the old ``user:<id>:last_ip`` / ``:trust_score`` /
+``:devices`` keys, and measuring the memory per user of both layouts:
+
+    python redis_layout.py migrate [--delete]
+    python redis_layout.py memory --users 2000
+"""
+import os
+import argparse
+import asyncio
+import uuid
+
+import redis
+from redis.crc import key_slot
+from redis.asyncio import BlockingConnectionPool
+from redis.asyncio.cluster import RedisCluster as AsyncRedisCluster
+from redis.asyncio.connection import async_timeout
+
+REDIS_MODE = os.getenv("REDIS_MODE", "standalone").lower()
+
+FIELD_LAST_IP = "last_ip"
+FIELD_TRUST_SCORE = "trust_score"
+
+_OLD_SUFFIXES = (":last_ip", ":trust_score", ":devices")
+
+
+def tag(subject):
+    return f"{{{subject}}}"
+
+
+def state_key(user_id):
+    return f"user:{tag(user_id)}"
+
+
+def devices_key(user_id):
+    return f"user:{tag(user_id)}:devices"
+
+
+def device_first_key(user_id):
+    return f"user:{tag(user_id)}:devices:first"
+
+
+def baseline_key(user_id):
+    return f"user:{tag(user_id)}:baseline"
+
+
+def step_up_key(user_id):
+    return f"user:{tag(user_id)}:stepup"
+
+
+def is_cluster(client):
+    return isinstance(client, (redis.cluster.RedisCluster, AsyncRedisCluster))
+
+
+def _nodes(spec):
+    out = []
+    for item in spec.split(","):
+        host, _, port = item.strip().rpartition(":")
+        out.append((host, int(port)))
+    return out
+
+
+class _BlockingPool(BlockingConnectionPool):
+    """``BlockingConnectionPool`` that connects outside the pool's lock.
+
+    In redis-py 5.0.1 a connection that fails to connect is released while
+    the lock is still held, which deadlocks the caller until the pool's
+    ``timeout`` (20 s) whenever Redis is unreachable.
+    """
+
+    async def get_connection(self, command_name, *keys, **options):
+        try:
+            async with async_timeout(self.timeout):
+                async with self._condition:
+                    await self._condition.wait_for(self.can_get_connection)
+                    try:
+                        connection = self._available_connections.pop()
+                    except IndexError:
+                        connection = self.make_connection()
+                    self._in_use_connections.add(connection)
+        except asyncio.TimeoutError as err:
+            raise redis.exceptions.ConnectionError("No connection available.") from err
+        try:
+            await self.ensure_connection(connection)
+        except BaseException:
+            await self.release(connection)
+            raise
+        return connection
+
+
+def connect(decode_responses=True, asyncio=False, **kwargs):
+    """Client for ``REDIS_MODE``; ``asyncio=True`` returns the ``redis.asyncio`` equivalent."""
+    host = os.getenv("REDIS_HOST", "localhost")
+    port = int(os.getenv("REDIS_PORT", "6379"))
+    if REDIS_MODE == "sentinel":
+        from redis.asyncio.sentinel import Sentinel as AsyncSentinel
+        sentinel_class = AsyncSentinel if asyncio else redis.sentinel.Sentinel
+        sentinel = sentinel_class(_nodes(os.getenv("REDIS_SENTINELS", f"{host}:26379")), socket_timeout=0.5)
+        return sentinel.master_for(os.getenv("REDIS_SENTINEL_MASTER", "mymaster"),
+                                   decode_responses=decode_responses, **kwargs)
+    if REDIS_MODE == "cluster":
+        if asyncio:
+            from redis.asyncio.cluster import RedisCluster as cluster_class, ClusterNode as node_class
+        else:
+            from redis.cluster import RedisCluster as cluster_class, ClusterNode as node_class
+        nodes = [node_class(h, p) for h, p in _nodes(os.getenv("REDIS_CLUSTER_NODES", f"{host}:{port}"))]
+        return cluster_class(startup_nodes=nodes, decode_responses=decode_responses, **kwargs)
+    if asyncio:
+        import redis.asyncio as aioredis
+        pool = _BlockingPool(host=host, port=port, decode_responses=decode_responses, **kwargs)
+        return aioredis.Redis(connection_pool=pool)
+    return redis.Redis(host=host, port=port, decode_responses=decode_responses, **kwargs)
+
+
+# ---------- migration from the old layout ----------
+def _old_user(key):
+    """``(user_id, suffix)`` for an old per-user key, else ``None``."""
+    if "{" in key or not key.startswith("user:"):
+        return None
+    for suffix in _OLD_SUFFIXES:
+        if key.endswith(suffix):
+            return key[len("user:"):-len(suffix)], suffix
+    return None
+
+
+def migrated_key(key):
+    """The new-layout key that ``migrate`` copies an old key into, else ``None``."""
+    old = _old_user(key)
+    if old is None:
+        return None
+    user_id, suffix = old
+    return devices_key(user_id) if suffix == ":devices" else state_key(user_id)
+
+
+def migrate(client, delete=False, batch=500):
+    """Copy old-layout keys into the new one; newer data already in place is kept.
+
+    Returns ``{"users": n, "deleted": n}``.
+    """
+    from device_registry import DeviceRegistry
+
+    registry = DeviceRegistry()
+    done = {"users": 0, "deleted": 0}
+    for key in client.scan_iter(match="user:*", count=batch):
+        old = _old_user(key)
+        if old is None:
+            continue
+        user_id, suffix = old
+        if suffix == ":devices":
+            registry.convert(client, user_id, client.smembers(key))
+        else:
+            value = client.get(key)
+            if value is not None:
+                client.hsetnx(state_key(user_id), suffix[1:], value)
+            done["users"] += suffix == ":last_ip"
+        if delete:
+            done["deleted"] += client.delete(key)
+    return done
+
+
+# ---------- memory comparison ----------
+def _used_memory(client):
+    if is_cluster(client):
+        return sum(info["used_memory"] for info in client.info("memory", target_nodes="primaries").values())
+    return client.info("memory")["used_memory"]
+
+
+def memory_report(client, users=1000, devices=2):
+    """Bytes per user for the old and the new layout, from MEMORY USAGE and INFO."""
+    run = uuid.uuid4().hex[:8]
+    layouts = {
+        "old": lambda u: [
+            ("set", f"user:{u}:last_ip", "203.0.113.7"),
+            ("set", f"user:{u}:trust_score", "85"),
+            ("sadd", f"user:{u}:devices", [f"{d:064x}" for d in range(devices)]),
+        ],
+        "new": lambda u: [
+            ("hset", state_key(u), {FIELD_LAST_IP: "203.0.113.7", FIELD_TRUST_SCORE: "85"}),
+            ("zadd", devices_key(u), {f"{d:064x}": 1700000000000 + d for d in range(devices)}),
+            ("hset", device_first_key(u), {f"{d:064x}": 1700000000000 for d in range(devices)}),
+        ],
+    }
+    report = {}
+    for name, build in layouts.items():
+        before = _used_memory(client)
+        keys = []
+        pipe = client.pipeline(transaction=False)
+        for i in range(users):
+            for op, key, value in build(f"memcmp-{run}-{i}"):
+                if op == "set":
+                    pipe.set(key, value)
+                elif op == "hset":
+                    pipe.hset(key, mapping=value)
+                elif op == "zadd":
+                    pipe.zadd(key, value)
+                else:
+                    pipe.sadd(key, *value)
+                keys.append(key)
+        pipe.execute()
+        after = _used_memory(client)
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.memory_usage(key)
+        usage = sum(pipe.execute())
+        for i in range(0, len(keys), 1000):
+            client.delete(*keys[i:i + 1000])
+        report[name] = {"keys_per_user": len(keys) / users, "memory_usage_per_user": usage / users,
+                        "used_memory_per_user": (after - before) / users}
+    return report
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Redis key layout tools")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    m = sub.add_parser("migrate", help="copy old-layout user keys into the hash-tagged layout")
+    m.add_argument("--delete", action="store_true", help="delete each old key once copied")
+    r = sub.add_parser("memory", help="compare memory per user of the old and new layouts")
+    r.add_argument("--users", type=int, default=1000)
+    r.add_argument("--devices", type=int, default=2)
+    sub.add_parser("slot", help="print the cluster slot of a user's keys").add_argument("user_id")
+    args = ap.parse_args()
+
+    if args.cmd == "slot":
+        for key in (state_key(args.user_id), devices_key(args.user_id), device_first_key(args.user_id)):
+            print(f"{key:<40}{key_slot(key.encode())}")
+        return
+    client = connect()
+    if args.cmd == "migrate":
+        print(migrate(client, delete=args.delete))
+    else:
+        report = memory_report(client, args.users, args.devices)
+        print(f"{'layout':<8}{'keys/user':>10}{'MEMORY USAGE B/user':>22}{'used_memory B/user':>20}")
+        for name, row in report.items():
+            print(f"{name:<8}{row['keys_per_user']:>10.0f}{row['memory_usage_per_user']:>22.0f}{row['used_memory_per_user']:>20.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+"""Retention of per-user state in Redis.
+
+Idle TTLs per data type:
+
+    user state hash    RETAIN_USER_STATE seconds (default 30 days), pushed back by every decision
+    device registry    DEVICE_MAX_AGE seconds (see device_registry.py)
+    behavior baseline  RETAIN_USER_STATE seconds, pushed back by every flush (see behavior_baseline.py)
+    step-up grants     STEP_UP_TTL seconds, pushed back by every change (see step_up.py)
+    rate-rule state    a couple of windows, set by the rate scripts (RETAIN_RATE if missing)
+    access log         ACCESS_LOG_MAXLEN entries, and RETAIN_ACCESS_LOG seconds if set
+    old-layout keys    RETAIN_LEGACY seconds (default RETAIN_USER_STATE)
+
+New writes carry their TTL.  ``Compactor`` takes care of what was written
+before.  It walks the keyspace with SCAN (one cursor per primary on a
+Cluster), a small batch at a time and for at most ``RETENTION_BUDGET_MS``
+per step, and:
+
+- gives keys without an expiry the TTL of their type;
+- drops old-layout keys the new layout has superseded (old device sets are
+  merged into the registry first);
+- trims the access log by age at the end of each pass.
+
+Only one gateway compacts at a time (a lock key), and the cursor is kept in
+Redis so a pass resumes where the last step stopped.
+
+    RETENTION_COMPACT=true RETENTION_BUDGET_MS=20 RETENTION_INTERVAL=1 python app_ziti.py
+    python retention.py compact --budget-ms 50
+    python retention.py report --sample 0.1 --top 20
+"""
+import os
+import time
+import uuid
+import heapq
+import random
+import argparse
+import threading
+from collections import Counter as Tally
+
+import redis
+from prometheus_client import Counter
+
+import redis_layout
+from access_log import ACCESS_LOG_STREAM
+from device_registry import DEVICE_MAX_AGE, DeviceRegistry
+from rate_limit import RateLimits
+from step_up import STEP_UP_TTL
+from redis_layout import state_key, devices_key, device_first_key, baseline_key, step_up_key, is_cluster
+
+RETAIN_USER_STATE = int(os.getenv("RETAIN_USER_STATE", str(30 * 86400)))
+RETAIN_RATE = int(os.getenv("RETAIN_RATE", "86400"))
+RETAIN_LEGACY = int(os.getenv("RETAIN_LEGACY", str(RETAIN_USER_STATE)))
+RETAIN_ACCESS_LOG = int(os.getenv("RETAIN_ACCESS_LOG", "0"))
+RETENTION_BUDGET_MS = float(os.getenv("RETENTION_BUDGET_MS", "20"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "1"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "200"))
+
+CURSOR_KEY = "retention:cursor"
+LOCK_KEY = "retention:lock"
+
+RETENTION_ACTIONS = Counter("zt_retention_actions_total", "Keys changed by the retention compactor", ["action"])
+RETENTION_PASSES = Counter("zt_retention_passes_total", "Completed retention passes over the keyspace")
+
+
+def default_ttls():
+    """Idle TTL in seconds per key category (0: keep)."""
+    return {"user_state": RETAIN_USER_STATE, "devices": DEVICE_MAX_AGE, "baseline": RETAIN_USER_STATE,
+            "step_up": STEP_UP_TTL, "rate": RETAIN_RATE, "legacy": RETAIN_LEGACY}
+
+
+def classify(key, stream=ACCESS_LOG_STREAM):
+    """``(category, subject)``; the subject is the text in the key's hash tag."""
+    if key == stream:
+        return "access_log", None
+    head, brace, rest = key.partition("{")
+    if brace:
+        subject, _, suffix = rest.partition("}")
+        if head == "user:":
+            if suffix == "":
+                return "user_state", subject
+            if suffix in (":devices", ":devices:first"):
+                return "devices", subject
+            if suffix == ":baseline":
+                return "baseline", subject
+            if suffix == ":stepup":
+                return "step_up", subject
+        elif head.startswith("rate:"):
+            return "rate", subject
+        return "other", subject
+    if key.startswith("user:"):
+        return "legacy", None
+    if key.startswith(("retention:", "policy:")):
+        return "gateway", None
+    return "other", None
+
+
+def primaries(client):
+    """``[(name, client)]`` to SCAN: the client itself, or one connection per Cluster primary."""
+    if is_cluster(client):
+        return sorted(((n.name, client.get_redis_connection(n)) for n in client.get_primaries()), key=lambda x: x[0])
+    return [("standalone", client)]
+
+
+class Compactor:
+    def __init__(self, client, ttls=None, batch=RETENTION_BATCH, budget_ms=RETENTION_BUDGET_MS,
+                 interval=RETENTION_INTERVAL, log_age=RETAIN_ACCESS_LOG, stream=ACCESS_LOG_STREAM):
+        self.client = client
+        self.ttls = ttls if ttls is not None else default_ttls()
+        self.batch = batch
+        self.budget = budget_ms / 1000
+        self.interval = interval
+        self.log_age_ms = max(0, log_age) * 1000
+        self.stream = stream
+        self.devices = DeviceRegistry()
+        self.node_id = uuid.uuid4().hex[:12]
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, client):
+        """``None`` unless ``RETENTION_COMPACT=true``."""
+        if os.getenv("RETENTION_COMPACT", "false").lower() != "true":
+            return None
+        return cls(client)
+
+    # ---------- one step ----------
+    def step(self):
+        """Compact for up to the time budget; returns counts of what was done.
+
+        Ends early when a pass over every primary completes, so a pass runs
+        at most once per step.
+        """
+        deadline = time.perf_counter() + self.budget
+        nodes = primaries(self.client)
+        state = self.client.hgetall(CURSOR_KEY)
+        index = min(int(state.get("node", 0)), len(nodes) - 1)
+        cursor = int(state.get("cursor", 0))
+        done = Tally()
+        while True:
+            _, conn = nodes[index]
+            cursor, keys = conn.scan(cursor, count=self.batch)
+            done["scanned"] += len(keys)
+            if keys:
+                self._compact(conn, keys, done)
+            if cursor == 0:
+                index += 1
+                if index == len(nodes):
+                    index = 0
+                    self._trim_log(done)
+                    done["passes"] += 1
+                    RETENTION_PASSES.inc()
+                    break
+            if time.perf_counter() >= deadline:
+                break
+        self.client.hset(CURSOR_KEY, mapping={"node": index, "cursor": cursor})
+        return done
+
+    def _compact(self, conn, keys, done):
+        pipe = conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.pttl(key)
+        ttls = pipe.execute()
+        legacy = [k for k in keys if classify(k, self.stream)[0] == "legacy"]
+        migrated = self._migrated(legacy)
+
+        actions = Tally()
+        pipe = conn.pipeline(transaction=False)
+        for key, pttl in zip(keys, ttls):
+            if key in migrated:
+                if key.endswith(":devices"):
+                    # The new registry exists but may predate these devices
+                    self.devices.convert(self.client, key[len("user:"):-len(":devices")], conn.smembers(key))
+                pipe.delete(key)
+                actions["legacy_deleted"] += 1
+                continue
+            ttl = self.ttls.get(classify(key, self.stream)[0])
+            if pttl == -1 and ttl:
+                pipe.pexpire(key, ttl * 1000)
+                actions["ttl_set"] += 1
+        if actions:
+            pipe.execute()
+        for action, n in actions.items():
+            RETENTION_ACTIONS.labels(action=action).inc(n)
+        done.update(actions)
+
+    def _migrated(self, keys):
+        """Old-layout keys whose data already sits in the new layout."""
+        targets = [(k, redis_layout.migrated_key(k)) for k in keys]
+        targets = [(k, t) for k, t in targets if t is not None]
+        if not targets:
+            return set()
+        pipe = self.client.pipeline(transaction=False)
+        for _, target in targets:
+            pipe.exists(target)
+        return {k for (k, _), exists in zip(targets, pipe.execute()) if exists}
+
+    def _trim_log(self, done):
+        if not self.log_age_ms:
+            return
+        min_id = int(time.time() * 1000) - self.log_age_ms
+        try:
+            trimmed = self.client.xtrim(self.stream, minid=min_id, approximate=True, limit=self.batch * 10)
+        except redis.exceptions.ResponseError:
+            return  # MINID needs Redis 6.2
+        done["log_trimmed"] += trimmed
+        RETENTION_ACTIONS.labels(action="log_trimmed").inc(trimmed)
+
+    # ---------- background loop ----------
+    def _acquire(self):
+        ttl_ms = int(max(self.interval, 1) * 5000)
+        if self.client.set(LOCK_KEY, self.node_id, nx=True, px=ttl_ms):
+            return True
+        if self.client.get(LOCK_KEY) == self.node_id:
+            self.client.pexpire(LOCK_KEY, ttl_ms)
+            return True
+        return False
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="retention-compactor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if self._acquire():
+                    self.step()
+            except (redis.exceptions.RedisError, OSError):
+                pass
+
+
+# ---------- memory report ----------
+def user_keys(user_id, limits):
+    """Every key holding state for ``user_id`` (per-user rate rules included)."""
+    keys = [state_key(user_id), devices_key(user_id), device_first_key(user_id), baseline_key(user_id),
+            step_up_key(user_id)]
+    return keys + [f"rate:{r.name}:{redis_layout.tag(user_id)}" for r in limits.rules if r.scope == "user"]
+
+
+def memory_report(client, sample=1.0, top=10, max_keys=0, batch=500, limits=None):
+    """Key counts and estimated bytes per category, and the users holding the most memory.
+
+    ``MEMORY USAGE`` is asked for a ``sample`` fraction of the keys and scaled
+    up per category.  ``max_keys`` stops the scan early (``complete`` is then
+    false).  Top users are picked from the largest sampled keys and then
+    measured exactly over all of their keys.
+    """
+    limits = limits if limits is not None else RateLimits.from_env()
+    user_rules = {r.name for r in limits.rules if r.scope == "user"}
+    counts, sampled, sampled_bytes = Tally(), Tally(), Tally()
+    candidates = []
+    scanned, complete = 0, True
+    for _, conn in primaries(client):
+        cursor = 0
+        while True:
+            cursor, keys = conn.scan(cursor, count=batch)
+            scanned += len(keys)
+            measured = [k for k in keys if sample >= 1 or random.random() < sample]
+            pipe = conn.pipeline(transaction=False)
+            for key in measured:
+                pipe.memory_usage(key)
+            sizes = dict(zip(measured, pipe.execute()))
+            for key in keys:
+                category, subject = classify(key)
+                counts[category] += 1
+                size = sizes.get(key)
+                if size is None:
+                    continue
+                sampled[category] += 1
+                sampled_bytes[category] += size
+                is_user = category in ("user_state", "devices", "baseline", "step_up") or (
+                    category == "rate" and key.split(":", 2)[1] in user_rules)
+                if is_user and subject:
+                    entry = (size, subject)
+                    if len(candidates) < top * 4:
+                        heapq.heappush(candidates, entry)
+                    elif entry > candidates[0]:
+                        heapq.heapreplace(candidates, entry)
+            if cursor == 0:
+                break
+            if max_keys and scanned >= max_keys:
+                complete = False
+                break
+        if not complete:
+            break
+
+    categories = {}
+    for category, n in counts.items():
+        per_key = sampled_bytes[category] / sampled[category] if sampled[category] else 0
+        categories[category] = {"keys": n, "bytes": int(per_key * n)}
+
+    users = []
+    for user_id in {u for _, u in candidates}:
+        keys = user_keys(user_id, limits)
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.memory_usage(key)
+        sizes = [s for s in pipe.execute() if s is not None]
+        users.append({"user_id": user_id, "keys": len(sizes), "bytes": sum(sizes)})
+    users.sort(key=lambda u: u["bytes"], reverse=True)
+    return {"categories": categories, "top_users": users[:top], "scanned": scanned,
+            "sampled": sum(sampled.values()), "complete": complete}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Retention of per-user Redis state")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    c = sub.add_parser("compact", help="run compaction steps until one full pass completes")
+    c.add_argument("--budget-ms", type=float, default=RETENTION_BUDGET_MS)
+    c.add_argument("--batch", type=int, default=RETENTION_BATCH)
+    c.add_argument("--pause", type=float, default=0.05, help="seconds between steps")
+    r = sub.add_parser("report", help="key counts and memory by category, and the top users by memory")
+    r.add_argument("--sample", type=float, default=1.0, help="fraction of keys measured with MEMORY USAGE")
+    r.add_argument("--top", type=int, default=10)
+    r.add_argument("--max-keys", type=int, default=0, help="stop after scanning this many keys (0: all)")
+    args = ap.parse_args()
+
+    client = redis_layout.connect()
+    if args.cmd == "compact":
+        compactor = Compactor(client, batch=args.batch, budget_ms=args.budget_ms)
+        total = Tally()
+        while not total["passes"]:
+            total.update(compactor.step())
+            time.sleep(args.pause)
+        print(dict(total))
+        return
+    report = memory_report(client, sample=args.sample, top=args.top, max_keys=args.max_keys)
+    print(f"{'category':<12}{'keys':>10}{'est. bytes':>14}")
+    for category, row in sorted(report["categories"].items(), key=lambda x: -x[1]["bytes"]):
+        print(f"{category:<12}{row['keys']:>10}{row['bytes']:>14}")
+    print(f"\nscanned {report['scanned']} keys, measured {report['sampled']}"
+          + ("" if report["complete"] else " (stopped at --max-keys)"))
+    print(f"\n{'user':<32}{'keys':>6}{'bytes':>10}")
+    for u in report["top_users"]:
+        print(f"{u['user_id']:<32}{u['keys']:>6}{u['bytes']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Per-user risk metrics with bounded cardinality.
+
+The alert rules (monitoring/rules/alerts.yml) use
+
+    zero_trust_score{user}                  LowTrustScore
+    zero_trust_access_total{scope, subject} HighAccessRate (scope "user" or "ip")
+
+A series per user would be unbounded, so only the ``SKETCH_TOP`` lowest
+trust scores and the ``SKETCH_TOP`` most active users and IPs are exported.
+
+Each process summarises the decisions it sees since its last flush in
+constant memory: a Space-Saving sketch of ``SKETCH_CAPACITY`` counters per
+scope, and the latest score of the ``SKETCH_CAPACITY`` lowest-scoring
+users.  Every ``SKETCH_FLUSH`` seconds a script merges the summaries into
+sorted sets capped at ``SKETCH_CAPACITY`` members (Space-Saving again for the
+counts), so all workers and replicas report the same top K.  Scores older
+than ``SKETCH_WINDOW`` seconds are dropped, which is how a user whose score
+recovered on another replica leaves the list.  ``/metrics`` reads the top K
+with one pipeline.
+
+Counts are Space-Saving estimates (never below the true count).  They are
+exported as a counter, so a subject's value must never fall: a subject
+that drops out of the capped set and comes back restarts from the smallest
+tracked count plus its new accesses, and since the smallest count of a full
+set only grows, that is above whatever it had when it was evicted.  Only
+losing the sorted sets themselves (a flushed or restarted Redis) resets the
+series, which ``rate()`` handles like a process restart.
+
+    SKETCH_TOP=20 SKETCH_CAPACITY=200 SKETCH_FLUSH=5 SKETCH_WINDOW=300 python app_ziti.py
+"""
+import os
+import heapq
+import threading
+
+import redis
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+SKETCH_TOP = int(os.getenv("SKETCH_TOP", "20"))
+SKETCH_CAPACITY = int(os.getenv("SKETCH_CAPACITY", "200"))
+SKETCH_FLUSH = float(os.getenv("SKETCH_FLUSH", "5"))
+SKETCH_WINDOW = int(os.getenv("SKETCH_WINDOW", "300"))
+
+SCORES_KEY = "risk:{sketch}:scores"
+SEEN_KEY = "risk:{sketch}:seen"
+ACCESS_KEYS = {"user": "risk:{sketch}:access:user", "ip": "risk:{sketch}:access:ip"}
+
+# KEYS: access zset  ARGV: capacity, subject, count, subject, count...
+# A newcomer replaces the smallest member and starts above its count, which keeps
+# every subject's count monotonic across evictions (it is exported as a counter)
+MERGE_COUNTS_LUA = """
+local cap = tonumber(ARGV[1])
+for i = 2, #ARGV, 2 do
+    local subject, n = ARGV[i], tonumber(ARGV[i + 1])
+    if redis.call('ZSCORE', KEYS[1], subject) or redis.call('ZCARD', KEYS[1]) < cap then
+        redis.call('ZINCRBY', KEYS[1], n, subject)
+    else
+        local least = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+        redis.call('ZREM', KEYS[1], least[1])
+        redis.call('ZADD', KEYS[1], tonumber(least[2]) + n, subject)
+    end
+end
+"""
+
+# KEYS: scores zset, seen zset  ARGV: capacity, window_ms, user, score, user, score...
+MERGE_SCORES_LUA = """
+if redis.replicate_commands then redis.replicate_commands() end
+local t = redis.call('TIME')
+local now_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+for i = 3, #ARGV, 2 do
+    redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+    redis.call('ZADD', KEYS[2], now_ms, ARGV[i])
+end
+local old = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now_ms - tonumber(ARGV[2]))
+if #old > 0 then
+    redis.call('ZREM', KEYS[1], unpack(old))
+    redis.call('ZREM', KEYS[2], unpack(old))
+end
+local cap = tonumber(ARGV[1])
+if redis.call('ZCARD', KEYS[1]) > cap then
+    local drop = redis.call('ZRANGE', KEYS[1], cap, -1)
+    redis.call('ZREMRANGEBYRANK', KEYS[1], cap, -1)
+    redis.call('ZREM', KEYS[2], unpack(drop))
+end
+"""
+
+
+class SpaceSaving:
+    """Top-k counts over a stream in ``capacity`` counters (Metwally et al.)."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self._heap = []  # (count, key); entries go stale as counts grow
+
+    def offer(self, key, n=1):
+        count = self.counts.get(key)
+        if count is None and len(self.counts) >= self.capacity:
+            count = self._evict_min()
+        self.counts[key] = (count or 0) + n
+        heapq.heappush(self._heap, (self.counts[key], key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(c, k) for k, c in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def _evict_min(self):
+        while True:
+            count, key = heapq.heappop(self._heap)
+            if self.counts.get(key) == count:
+                del self.counts[key]
+                return count
+
+
+class LowestScores:
+    """Latest score of the ``capacity`` lowest-scoring users."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.scores = {}
+        self._heap = []  # (-score, user); max score on top, entries go stale
+
+    def update(self, user, score):
+        if user not in self.scores and len(self.scores) >= self.capacity:
+            top = self._max()
+            if score >= -top[0]:
+                return
+            heapq.heappop(self._heap)
+            del self.scores[top[1]]
+        self.scores[user] = score
+        heapq.heappush(self._heap, (-score, user))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(-s, u) for u, s in self.scores.items()]
+            heapq.heapify(self._heap)
+
+    def _max(self):
+        while self.scores.get(self._heap[0][1]) != -self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0]
+
+
+class RiskTracker:
+    def __init__(self, client, top=SKETCH_TOP, capacity=SKETCH_CAPACITY, flush_interval=SKETCH_FLUSH,
+                 window=SKETCH_WINDOW):
+        self.client = client
+        self.top = top
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.window_ms = window * 1000
+        self._lock = threading.Lock()
+        self._reset()
+        self._merge_counts = client.register_script(MERGE_COUNTS_LUA)
+        self._merge_scores = client.register_script(MERGE_SCORES_LUA)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, client):
+        """``None`` if ``RISK_SKETCH=false``."""
+        if os.getenv("RISK_SKETCH", "true").lower() != "true":
+            return None
+        return cls(client)
+
+    def _reset(self):
+        self._access = {scope: SpaceSaving(self.capacity) for scope in ACCESS_KEYS}
+        self._scores = LowestScores(self.capacity)
+
+    def observe(self, user_id, ip, score):
+        """Record one decision (in memory; merged into Redis by ``flush``)."""
+        with self._lock:
+            self._access["user"].offer(user_id)
+            if ip:
+                self._access["ip"].offer(ip)
+            self._scores.update(user_id, score)
+
+    def flush(self):
+        with self._lock:
+            access, scores = self._access, self._scores
+            self._reset()
+        # Separate calls rather than a pipeline: Cluster pipelines refuse EVALSHA
+        for scope, sketch in access.items():
+            if sketch.counts:
+                args = [self.capacity] + [x for kv in sketch.counts.items() for x in kv]
+                self._merge_counts(keys=[ACCESS_KEYS[scope]], args=args)
+        # Runs even with nothing new, to age out old scores
+        args = [self.capacity, self.window_ms] + [x for kv in scores.scores.items() for x in kv]
+        self._merge_scores(keys=[SCORES_KEY, SEEN_KEY], args=args)
+
+    def read(self):
+        """``(lowest scores, {scope: highest counts})``, each a list of ``(subject, value)``."""
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zrange(SCORES_KEY, 0, self.top - 1, withscores=True)
+        for key in ACCESS_KEYS.values():
+            pipe.zrevrange(key, 0, self.top - 1, withscores=True)
+        lowest, *counts = pipe.execute()
+        return lowest, dict(zip(ACCESS_KEYS, counts))
+
+    def collect(self):
+        """Prometheus collector interface: the top-K series, read from Redis."""
+        score = GaugeMetricFamily("zero_trust_score", "Trust score of the lowest-scoring users", labels=["user"])
+        access = CounterMetricFamily("zero_trust_access", "Access decisions of the most active users and IPs",
+                                     labels=["scope", "subject"])
+        try:
+            lowest, counts = self.read()
+        except (redis.exceptions.RedisError, OSError):
+            return []
+        for user, value in lowest:
+            score.add_metric([user], value)
+        for scope, rows in counts.items():
+            for subject, value in rows:
+                access.add_metric([scope, subject], value)
+        return [score, access]
+
+    # ---------- background flush ----------
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="risk-sketch-flush", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+        try:
+            self.flush()
+        except (redis.exceptions.RedisError, OSError):
+            pass
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except (redis.exceptions.RedisError, OSError):
+                pass
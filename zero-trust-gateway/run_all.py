@@ -1,9 +1,14 @@
 # run_all.py — Get token → Run 3 request groups → Generate out/decisions.csv & out/summary.csv
+# (decisions.csv is archived into ARCHIVE_DIR after each run; summary.csv is a
+#  streaming aggregation over this run's archived rows, see decision_archive.py.)
+# (Functional smoke run, one request at a time; for rates, tail latency and the
+#  saturation point use loadgen.py, which replays the same GROUPS open-loop.)
 import os, time, csv, json
 import requests
-from collections import Counter, defaultdict
 from datetime import datetime
 
+from decision_archive import DecisionArchive, Summary
+
 # ====== Configuration ======
 KC_BASE    = os.getenv("KC_BASE", "http://localhost:8080")
 REALM      = os.getenv("KC_REALM", "my-company")
@@ -13,6 +18,8 @@ PASSWORD   = os.getenv("KC_PASSWORD", "alicepwd")
 
 # Optional client secret (for confidential clients)
 CLIENT_SECRET = os.getenv("KC_CLIENT_SECRET", None)
+# "local": sign the token with the dev key instead (see jwks_dev.py / synthetic_users.py), no Keycloak needed
+TOKEN_SOURCE = os.getenv("TOKEN_SOURCE", "keycloak")
 
 API_URL    = os.getenv("GATEWAY_URL", "http://localhost:5000/api/access-request")
 OUT_DIR    = "out"
@@ -30,6 +37,9 @@ GROUPS = [
 
 # ====== Helper functions ======
 def get_token():
+    if TOKEN_SOURCE == "local":
+        from jwks_dev import load_or_create_key, mint_token
+        return mint_token(load_or_create_key(), USERNAME, ("user",))
     url = f"{KC_BASE}/realms/{REALM}/protocol/openid-connect/token"
     data = {
         "client_id": CLIENT_ID,
@@ -72,8 +82,7 @@ def post_once(token, resource, extra_headers=None):
 def main():
     token = get_token()
     ensure_csv_header(DETAIL_CSV)
-
-    summary = defaultdict(Counter)
+    started = datetime.now()
 
     with open(DETAIL_CSV, "a", newline="", encoding="utf-8") as f:
         w = csv.writer(f)
@@ -87,20 +96,25 @@ def main():
                 user_id = data.get("user_id") or ""
                 trust   = data.get("trust_score") if isinstance(data.get("trust_score"), int) else ""
                 w.writerow([datetime.now().isoformat(), name, user_id, trust, resource, action, reason, latency_ms, code])
-                summary[name][code] += 1
                 if sleep_s > 0:
                     time.sleep(sleep_s)
 
+    archive = DecisionArchive()
+    archive.ingest([DETAIL_CSV])
+    summary = Summary(by=("group", "http_status"), means=(), latency=None)
+    for block in archive.scan(start=started, columns=["group", "http_status"]):
+        summary.add(block)
+
     with open(SUMMARY_CSV, "w", newline="", encoding="utf-8") as f:
         w = csv.writer(f)
         w.writerow(["group","http_status","count"])
-        for g, cnt in summary.items():
-            for code, n in sorted(cnt.items(), key=lambda x: str(x[0])):
-                w.writerow([g, code, n])
+        for row in summary.rows():
+            w.writerow([row["group"], row["http_status"], row["count"]])
 
     print("\n✅ Completed.")
     print(f" - {DETAIL_CSV} (Detailed results: action/reason/latency_ms)")
     print(f" - {SUMMARY_CSV} (Per-group HTTP status summary)")
+    print(f" - {archive.root} (Decision archive: python decision_archive.py query/summary)")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,148 @@
+"""Production server for the gateways.
+
+Runs a Flask gateway under gunicorn with preforked workers (one per CPU by
+default, each with ``WEB_THREADS`` threads for requests waiting on Redis):
+
+    python server.py app_ziti --bind 0.0.0.0:5001
+    WEB_WORKERS=8 WEB_THREADS=4 python server.py app
+    kill -HUP <master pid>     # graceful reload: new workers start, old ones finish in-flight requests
+
+The gateway module is imported in each worker after the fork, so every
+worker has its own Redis connection pool and background threads (policy
+watcher, near-cache listener, decision log writer).  Prometheus metrics are
+kept per worker in ``PROMETHEUS_MULTIPROC_DIR`` and summed by ``/metrics``
+(``metrics_payload``); with several workers each one writes its own decision
+log (``decisions.w0.csv``, ...).
+
+``python app.py`` / ``python app_ziti.py`` start this server too;
+``SERVER_MODE=dev`` keeps Flask's single-process server (``FLASK_DEBUG=true``
+for the reloader).
+"""
+import os
+import sys
+import glob
+import argparse
+import importlib
+import tempfile
+
+SERVER_MODE = os.getenv("SERVER_MODE", "production").lower()
+
+
+def default_workers():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def metrics_payload(*collectors):
+    """``/metrics`` body: this process's registry, or every worker's under the production server.
+
+    ``collectors`` are appended as they are (e.g. ones that read shared state
+    from Redis and so are the same in every worker).
+    """
+    from prometheus_client import CollectorRegistry, generate_latest, multiprocess
+
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        body = generate_latest(registry)
+    else:
+        body = generate_latest()
+    for collector in collectors:
+        if collector is not None:
+            extra = CollectorRegistry(auto_describe=False)
+            extra.register(collector)
+            body += generate_latest(extra)
+    return body
+
+
+def run(module, app, port):
+    """``__main__`` of the gateway modules."""
+    if SERVER_MODE == "dev":
+        app.run(host="0.0.0.0", port=port, debug=os.getenv("FLASK_DEBUG", "false").lower() == "true")
+        return
+    # Restart as a clean server process: metrics must be set up before
+    # prometheus_client is imported, which this module already did.
+    script = os.path.abspath(__file__)
+    os.execv(sys.executable, [sys.executable, script, module, "--bind", f"0.0.0.0:{port}"] + sys.argv[1:])
+
+
+# ---------- gunicorn ----------
+_slots = set()
+
+
+def _pre_fork(server, worker):
+    # Slot numbers name the per-worker decision logs; a slot is reused once its worker has exited
+    worker.slot = min(set(range(len(_slots) + 1)) - _slots)
+    _slots.add(worker.slot)
+
+
+def _post_fork(server, worker):
+    if server.cfg.workers > 1:
+        os.environ["WORKER_SLOT"] = str(worker.slot)
+
+
+def _child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    _slots.discard(getattr(worker, "slot", None))
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def _prepare_metrics_dir():
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR") or os.path.join(tempfile.gettempdir(), f"zt-metrics-{os.getpid()}")
+    os.makedirs(path, exist_ok=True)
+    # Files left by a previous run would be added to this one's counters
+    for stale in glob.glob(os.path.join(path, "*.db")):
+        os.remove(stale)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+    return path
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Run a gateway with preforked workers")
+    ap.add_argument("module", choices=["app", "app_ziti"])
+    ap.add_argument("--bind", default=os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '5000')}"))
+    ap.add_argument("--workers", type=int, default=int(os.getenv("WEB_WORKERS", "0")) or default_workers())
+    ap.add_argument("--threads", type=int, default=int(os.getenv("WEB_THREADS", "4")))
+    ap.add_argument("--timeout", type=int, default=int(os.getenv("WEB_TIMEOUT", "30")))
+    ap.add_argument("--graceful-timeout", type=int, default=int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30")))
+    ap.add_argument("--max-requests", type=int, default=int(os.getenv("WEB_MAX_REQUESTS", "0")),
+                    help="recycle a worker after this many requests (0: never)")
+    args = ap.parse_args()
+
+    metrics_dir = _prepare_metrics_dir()
+    # Imported only now: gunicorn must not pull in prometheus_client before the directory is set
+    from gunicorn.app.base import BaseApplication
+
+    class GatewayServer(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": args.bind,
+                "workers": args.workers,
+                "threads": args.threads,
+                "worker_class": "gthread",
+                "timeout": args.timeout,
+                "graceful_timeout": args.graceful_timeout,
+                "keepalive": 5,
+                "max_requests": args.max_requests,
+                "max_requests_jitter": args.max_requests // 10,
+                "preload_app": False,
+                "pre_fork": _pre_fork,
+                "post_fork": _post_fork,
+                "child_exit": _child_exit,
+                "proc_name": f"zt-{args.module}",
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return importlib.import_module(args.module).app
+
+    print(f"{args.module}: {args.workers} workers x {args.threads} threads on {args.bind} (metrics in {metrics_dir})")
+    GatewayServer().run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Per-stage timing of the access-decision hot path.
+
+With ``STAGE_TIMING=true`` each gateway reports, labelled by gateway
+(``standard`` for app.py, ``ziti`` for app_ziti.py):
+
+    zt_stage_latency_seconds{layer, stage}   token_decode, signal_*, policy,
+                                             step_up, access_log, decision_log,
+                                             serialize and request (the whole
+                                             handler)
+    zt_redis_round_trips{layer}              Redis round trips per request
+
+Stages are timed with ``with stage_timer.stage("policy"): ...``.  When timing
+is off, ``stage`` returns one shared no-op context manager, ``request``
+returns the view unchanged, and the Redis client is not wrapped, so the
+disabled cost is a method call per stage.
+"""
+import os
+from time import perf_counter
+from functools import wraps
+from contextlib import nullcontext
+from contextvars import ContextVar
+
+from prometheus_client import Histogram
+
+STAGE_TIMING = os.getenv("STAGE_TIMING", "false").lower() == "true"
+
+# Most stages take microseconds; a Redis round trip a few hundred
+STAGE_BUCKETS = (.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1.0)
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16)
+
+STAGE_LATENCY = Histogram("zt_stage_latency_seconds", "Time spent per access-decision stage",
+                          ["layer", "stage"], buckets=STAGE_BUCKETS)
+REDIS_ROUND_TRIPS = Histogram("zt_redis_round_trips", "Redis round trips per access request",
+                              ["layer"], buckets=ROUND_TRIP_BUCKETS)
+
+_NOOP = nullcontext()
+_round_trips = ContextVar("zt_round_trips", default=None)
+
+
+class _Stage:
+    __slots__ = ("observe", "started")
+
+    def __init__(self, observe):
+        self.observe = observe
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.observe(perf_counter() - self.started)
+        return False
+
+
+class StageTimer:
+    def __init__(self, layer, enabled=STAGE_TIMING):
+        self.layer = layer
+        self.enabled = enabled
+        self._observers = {}
+        self._round_trips = REDIS_ROUND_TRIPS.labels(layer=layer)
+
+    def _observer(self, name):
+        observe = self._observers.get(name)
+        if observe is None:
+            observe = self._observers[name] = STAGE_LATENCY.labels(layer=self.layer, stage=name).observe
+        return observe
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NOOP
+        return _Stage(self._observer(name))
+
+    def request(self, view):
+        """Decorator for a view: times it as stage ``request`` and counts its Redis round trips."""
+        if not self.enabled:
+            return view
+        observe = self._observer("request")
+
+        @wraps(view)
+        def timed(*args, **kwargs):
+            counter = [0]
+            token = _round_trips.set(counter)
+            started = perf_counter()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                observe(perf_counter() - started)
+                _round_trips.reset(token)
+                self._round_trips.observe(counter[0])
+        return timed
+
+    def count_round_trips(self, client):
+        """Count commands and pipeline executions made through ``client`` inside timed requests."""
+        if not self.enabled:
+            return client
+        execute_command = client.execute_command
+        make_pipeline = client.pipeline
+
+        def counted_execute(*args, **kwargs):
+            counter = _round_trips.get()
+            if counter is not None:
+                counter[0] += 1
+            return execute_command(*args, **kwargs)
+
+        def counted_pipeline(*args, **kwargs):
+            pipe = make_pipeline(*args, **kwargs)
+            pipe_execute = pipe.execute
+
+            def execute(*a, **kw):
+                counter = _round_trips.get()
+                if counter is not None:
+                    counter[0] += 1
+                return pipe_execute(*a, **kw)
+            pipe.execute = execute
+            return pipe
+
+        client.execute_command = counted_execute
+        client.pipeline = counted_pipeline
+        return client
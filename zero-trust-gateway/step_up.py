@@ -0,0 +1,293 @@
+"""Step-up (MFA) elevation grants.
+
+A score in the ``require_mfa`` band answers 428.  Once the user has stepped
+up, the token says so with an ``acr`` in ``STEP_UP_ACR`` or an ``amr``
+method in ``STEP_UP_AMR``; a password-only login proves nothing.  Only for an
+identity provider that enforces MFA on every re-login but names it in neither
+claim, ``STEP_UP_REAUTH=true`` also accepts an ``auth_time`` later than the
+first challenge sent to that device.  The proof counts while ``auth_time`` is
+at most ``STEP_UP_MAX_AGE`` seconds old.  A verified proof becomes a grant
+for the user and device fingerprint, kept in the user's slot:
+
+    user:{<id>}:stepup   hash   g:<device> -> "<expires ms>:<score at grant>:<auth_time>"
+                                c:<device> -> first unanswered challenge (ms)
+                                r:<device> -> auth_time of the last revoked grant
+
+While the grant holds, a ``require_mfa`` decision is re-decided at
+``STEP_UP_TRUST`` (the reported trust score stays the real one).  It ends
+``STEP_UP_TTL`` seconds after the authentication, or as soon as the score
+falls more than ``STEP_UP_MAX_DROP`` below the score at grant time (checked
+on ``deny`` decisions too); the revoked proof cannot grant again, so the
+user has to step up anew.  Only ``require_mfa`` and ``deny`` decisions touch
+Redis (one read, plus one write when something changes; a batch reads all
+its items in one round trip and queues the writes on its own pipeline), and
+if Redis does not answer the challenge stands.  A caller that cannot wait
+for the score may ``read`` the device's fields alongside the scoring call and
+``resolve`` them afterwards.
+
+    STEP_UP_TTL=900 STEP_UP_MAX_AGE=300 STEP_UP_TRUST=80 python app_ziti.py
+    python step_up.py show alice
+    python step_up.py revoke alice
+"""
+import os
+import time
+import argparse
+from types import MappingProxyType
+from collections import namedtuple
+
+import redis
+from prometheus_client import Counter
+
+import redis_layout
+from redis_layout import step_up_key
+
+REQUIRE_MFA = "require_mfa"
+DENY = "deny"
+
+STEP_UP_TTL = int(os.getenv("STEP_UP_TTL", "900"))
+STEP_UP_MAX_AGE = int(os.getenv("STEP_UP_MAX_AGE", "300"))
+STEP_UP_TRUST = int(os.getenv("STEP_UP_TRUST", "80"))
+STEP_UP_MAX_DROP = int(os.getenv("STEP_UP_MAX_DROP", "15"))
+STEP_UP_ACR = os.getenv("STEP_UP_ACR", "2,3,mfa,gold")
+STEP_UP_AMR = os.getenv("STEP_UP_AMR", "mfa,otp,totp,hwk,swk,fido,webauthn,sms")
+STEP_UP_REAUTH = os.getenv("STEP_UP_REAUTH", "false").lower() == "true"
+CLOCK_SKEW = 60
+
+STEP_UP = Counter("zt_step_up_total", "Step-up grant lookups on require_mfa and deny decisions", ["outcome"])
+
+Grant = namedtuple("Grant", ["score", "base_score", "expires_at", "auth_time"])
+
+
+def _split(values):
+    return frozenset(v.strip() for v in values.split(",") if v.strip())
+
+
+def _device(fingerprint):
+    return (fingerprint or "")[:16]
+
+
+def _parse_grant(raw):
+    try:
+        expires_ms, base, auth_time = raw.split(":")
+        return int(expires_ms), int(base), int(auth_time)
+    except (AttributeError, ValueError):
+        return None
+
+
+class StepUpStore:
+    def __init__(self, client, ttl=STEP_UP_TTL, max_age=STEP_UP_MAX_AGE, trust=STEP_UP_TRUST,
+                 max_drop=STEP_UP_MAX_DROP, acr=STEP_UP_ACR, amr=STEP_UP_AMR, reauth=STEP_UP_REAUTH):
+        self.client = client
+        self.ttl_ms = max(1, ttl) * 1000
+        self.max_age = max_age
+        self.trust = trust
+        self.max_drop = max_drop
+        self.acr = _split(acr)
+        self.amr = _split(amr)
+        self.reauth = reauth
+
+    @classmethod
+    def from_env(cls, client):
+        """``None`` when ``STEP_UP_CACHE=false``."""
+        if os.getenv("STEP_UP_CACHE", "true").lower() != "true":
+            return None
+        return cls(client)
+
+    # ---------- proof ----------
+    def proof(self, claims, challenged_ms=None, now=None):
+        """``auth_time`` of a fresh step-up the token proves, else ``None``."""
+        now = time.time() if now is None else now
+        auth_time = claims.get("auth_time", claims.get("iat"))
+        if not isinstance(auth_time, (int, float)) or not -CLOCK_SKEW <= now - auth_time <= self.max_age:
+            return None
+        amr = claims.get("amr") or ()
+        if isinstance(amr, str):
+            amr = (amr,)
+        if str(claims.get("acr", "")) in self.acr or self.amr.intersection(amr):
+            return int(auth_time)
+        # Re-authenticated after this device was challenged
+        if self.reauth and "auth_time" in claims and challenged_ms is not None and auth_time * 1000 >= challenged_ms:
+            return int(auth_time)
+        return None
+
+    # ---------- grants ----------
+    def elevated(self, policy):
+        """``policy`` decided at the grant's score, marked as such in its reason."""
+        return MappingProxyType(dict(policy, reason=f"{policy['reason']}_step_up"))
+
+    def _fields(self, fingerprint):
+        d = _device(fingerprint)
+        return f"g:{d}", f"c:{d}", f"r:{d}"
+
+    def _resolve(self, user_id, fingerprint, score, claims, replies, now, challenge):
+        """``(grant or None, outcome, writes)`` from the stored fields; ``writes`` are ``(method, args)``."""
+        key = step_up_key(user_id)
+        grant_field, challenge_field, revoked_field = self._fields(fingerprint)
+        stored, challenged, revoked = replies
+        now_ms = int(now * 1000)
+        writes = []
+
+        outcome = None
+        parsed = _parse_grant(stored)
+        if parsed is not None:
+            expires_ms, base, auth_time = parsed
+            if expires_ms <= now_ms:
+                outcome = "expired"
+                writes.append(("hdel", (key, grant_field)))
+            elif score < base - self.max_drop:
+                outcome = "revoked"
+                revoked = auth_time
+                writes += [("hdel", (key, grant_field)), ("hset", (key, revoked_field, auth_time))]
+            else:
+                if challenge:
+                    STEP_UP.labels("hit").inc()
+                return Grant(max(score, self.trust), base, expires_ms / 1000, auth_time), "hit", writes
+
+        grant = None
+        if challenge:  # a deny only expires or revokes what is there
+            auth_time = self.proof(claims, int(challenged) if challenged else None, now)
+            if auth_time is not None and (revoked is None or auth_time > int(revoked)):
+                expires_ms = min(auth_time * 1000 + self.ttl_ms, now_ms + self.ttl_ms)
+                writes += [("hset", (key, grant_field, f"{expires_ms}:{score}:{auth_time}")),
+                           ("hdel", (key, challenge_field))]
+                grant, outcome = Grant(max(score, self.trust), score, expires_ms / 1000, auth_time), "granted"
+            else:
+                outcome = outcome or "challenged"
+                if not challenged:
+                    writes.append(("hsetnx", (key, challenge_field, now_ms)))
+        if writes:
+            writes.append(("pexpire", (key, self.ttl_ms)))
+        if outcome is not None:
+            STEP_UP.labels(outcome).inc()
+        return grant, outcome, writes
+
+    def _queue(self, requests, replies, now, pipe):
+        """Grants from the stored fields; the writes they need are queued on ``pipe``."""
+        grants = []
+        for (user_id, fingerprint, score, claims, action), stored in zip(requests, replies):
+            grant, _, writes = self._resolve(user_id, fingerprint, score, claims, stored, now, action == REQUIRE_MFA)
+            for method, args in writes:
+                getattr(pipe, method)(*args)
+            grants.append(grant)
+        return grants
+
+    def check(self, user_id, fingerprint, score, claims, action=REQUIRE_MFA, now=None):
+        """Grant covering this ``require_mfa`` decision, or ``None`` (the 428 stands).
+
+        For a ``deny`` the grant is only checked against the score, never created.
+        """
+        return self.check_many([(user_id, fingerprint, score, claims, action)], now=now)[0]
+
+    def check_many(self, requests, pipe=None, now=None):
+        """``check`` for ``(user_id, fingerprint, score, claims, action)`` tuples, read in one round trip.
+
+        The writes are queued on ``pipe`` for the caller to execute, or sent in one more round trip.
+        """
+        if not requests:
+            return []
+        now = time.time() if now is None else now
+        try:
+            reads = self.client.pipeline(transaction=False)
+            for user_id, fingerprint, *_ in requests:
+                reads.hmget(step_up_key(user_id), self._fields(fingerprint))
+            if pipe is not None:
+                return self._queue(requests, reads.execute(), now, pipe)
+            writes = self.client.pipeline(transaction=False)
+            grants = self._queue(requests, reads.execute(), now, writes)
+            if len(writes):
+                writes.execute()
+            return grants
+        except (redis.exceptions.RedisError, OSError):
+            STEP_UP.labels("unavailable").inc(len(requests))
+            return [None] * len(requests)
+
+    def read(self, user_id, fingerprint):
+        """The device's stored fields, to ``resolve`` once the score is known; ``None`` if Redis does not answer."""
+        try:
+            return self.client.hmget(step_up_key(user_id), self._fields(fingerprint))
+        except (redis.exceptions.RedisError, OSError):
+            return None
+
+    def resolve(self, user_id, fingerprint, score, claims, action, stored, pipe, now=None):
+        """``check`` on fields already ``read``; the writes are queued on ``pipe``."""
+        if stored is None:
+            STEP_UP.labels("unavailable").inc()
+            return None
+        now = time.time() if now is None else now
+        return self._queue([(user_id, fingerprint, score, claims, action)], [stored], now, pipe)[0]
+
+    def grants(self, user_id, now=None):
+        """``{device: Grant}`` of the user's live grants."""
+        now_ms = int((time.time() if now is None else now) * 1000)
+        out = {}
+        for field, raw in self.client.hgetall(step_up_key(user_id)).items():
+            parsed = _parse_grant(raw) if field.startswith("g:") else None
+            if parsed is not None and parsed[0] > now_ms:
+                out[field[2:]] = Grant(self.trust, parsed[1], parsed[0] / 1000, parsed[2])
+        return out
+
+    def revoke(self, user_id):
+        """Drop every grant of the user; their proofs cannot grant again."""
+        key = step_up_key(user_id)
+        fields = self.client.hgetall(key)
+        pipe = self.client.pipeline(transaction=False)
+        for field, raw in fields.items():
+            parsed = _parse_grant(raw) if field.startswith("g:") else None
+            if parsed is not None:
+                pipe.hdel(key, field)
+                pipe.hset(key, f"r:{field[2:]}", parsed[2])
+        pipe.execute()
+        return sum(1 for f in fields if f.startswith("g:"))
+
+
+class AsyncStepUpStore(StepUpStore):
+    """The same grants over a ``redis.asyncio`` client."""
+
+    async def check(self, user_id, fingerprint, score, claims, action=REQUIRE_MFA, now=None):
+        return (await self.check_many([(user_id, fingerprint, score, claims, action)], now=now))[0]
+
+    async def check_many(self, requests, pipe=None, now=None):
+        if not requests:
+            return []
+        now = time.time() if now is None else now
+        try:
+            async with self.client.pipeline(transaction=False) as reads:
+                for user_id, fingerprint, *_ in requests:
+                    reads.hmget(step_up_key(user_id), self._fields(fingerprint))
+                replies = await reads.execute()
+            if pipe is not None:
+                return self._queue(requests, replies, now, pipe)
+            async with self.client.pipeline(transaction=False) as writes:
+                grants = self._queue(requests, replies, now, writes)
+                if len(writes):
+                    await writes.execute()
+            return grants
+        except (redis.exceptions.RedisError, OSError):
+            STEP_UP.labels("unavailable").inc(len(requests))
+            return [None] * len(requests)
+
+    async def read(self, user_id, fingerprint):
+        try:
+            return await self.client.hmget(step_up_key(user_id), self._fields(fingerprint))
+        except (redis.exceptions.RedisError, OSError):
+            return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Step-up grants")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("show", help="list a user's live grants").add_argument("user_id")
+    sub.add_parser("revoke", help="drop a user's grants").add_argument("user_id")
+    args = ap.parse_args()
+
+    store = StepUpStore(redis_layout.connect())
+    if args.cmd == "show":
+        for device, g in sorted(store.grants(args.user_id).items()):
+            print(f"{device}  expires {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(g.expires_at))}  "
+                  f"score at grant {g.base_score}  auth_time {g.auth_time}")
+    else:
+        print(f"{store.revoke(args.user_id)} grant(s) revoked")
+
+
+if __name__ == "__main__":
+    main()
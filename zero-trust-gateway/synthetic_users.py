@@ -0,0 +1,241 @@
+"""Synthetic identities and locally signed tokens for Keycloak-free testing.
+
+``Population(n)`` is n deterministic users.  For a given seed, user i is
+the same for any n apart from its activity weight, so a 1k run and a 50k
+run share their first thousand users.  Each user has:
+- realm roles that follow their department, as Keycloak would issue them;
+- one to three devices (User-Agent, Accept-Language, platform and
+  timezone of their region);
+- a work pattern (office, remote or mobile) that decides where requests
+  come from: the office egress /28, a fixed home address in a regional
+  ISP range, a VPN address, or a fresh carrier-NAT address per request
+  (sent as X-Forwarded-For, which the gateway honours with TRUSTED_PROXIES=1);
+- optionally an OpenZiti identity;
+- a Zipf-distributed activity weight, so a few users are busy and most
+  are not.
+
+``TokenFactory`` mints RS256 tokens for them with the dev key in dev-keys/
+(see jwks_dev.py).  The gateway trusts that key with either
+``JWKS_URL=http://127.0.0.1:8099/realms/my-company/protocol/openid-connect/certs``
+and ``python jwks_dev.py serve``, or ``JWKS_URL=file://$PWD/dev-keys/jwks.json``
+after ``python jwks_dev.py jwks``.
+
+    python synthetic_users.py --users 50000 --out out/synthetic/users.jsonl --tokens
+    python synthetic_users.py --users 1000 --requests 5
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import ipaddress
+import itertools
+from collections import Counter, namedtuple
+
+REALM = os.getenv("REALM", "my-company")
+SYNTHETIC_SEED = int(os.getenv("SYNTHETIC_SEED", "7"))
+
+Identity = namedtuple("Identity", ["username", "roles", "department", "region", "devices", "pattern",
+                                   "home_ip", "office_ip", "vpn_ip", "ziti_identity", "weight"])
+Device = namedtuple("Device", ["user_agent", "accept_language", "platform", "timezone"])
+
+# (department, share, extra realm roles, resources weighted towards the department's own)
+DEPARTMENTS = [
+    ("engineering", 0.35, [], ["/", "/docs", "/code", "/deploy"]),
+    ("sales", 0.20, ["crm"], ["/", "/crm", "/docs"]),
+    ("support", 0.17, ["crm"], ["/", "/crm", "/tickets"]),
+    ("finance", 0.10, ["finance"], ["/", "/finance/report", "/finance/ledger"]),
+    ("operations", 0.10, ["it-ops"], ["/", "/deploy", "/admin/panel"]),
+    ("hr", 0.06, ["hr"], ["/", "/hr/records"]),
+    ("executive", 0.02, ["finance", "hr"], ["/", "/finance/report", "/hr/records"]),
+]
+BASE_ROLES = [f"default-roles-{REALM}", "offline_access", "uma_authorization", "user"]
+
+# (region, share, Accept-Language, timezone, ISP ranges for home addresses, office egress)
+# Office egress /28s come from a dedicated block outside every range in lists/, so the
+# default runs carry no IP reputation penalty
+REGIONS = [
+    ("us-east", 0.30, "en-US,en;q=0.9", "America/New_York", ["73.0.0.0/10", "98.192.0.0/10"], "172.20.0.0/28"),
+    ("us-west", 0.15, "en-US,en;q=0.9", "America/Los_Angeles", ["24.4.0.0/14", "67.160.0.0/11"], "172.20.0.16/28"),
+    ("uk", 0.12, "en-GB,en;q=0.9", "Europe/London", ["86.128.0.0/10", "81.96.0.0/12"], "172.20.0.32/28"),
+    ("de", 0.12, "de-DE,de;q=0.9,en;q=0.8", "Europe/Berlin", ["79.192.0.0/10", "91.0.0.0/12"], "172.20.0.48/28"),
+    ("fr", 0.08, "fr-FR,fr;q=0.9,en;q=0.8", "Europe/Paris", ["90.0.0.0/9"], "172.20.0.64/28"),
+    ("in", 0.13, "en-IN,en;q=0.9,hi;q=0.8", "Asia/Kolkata", ["117.192.0.0/10", "49.32.0.0/11"], "172.20.0.80/28"),
+    ("cn", 0.05, "zh-CN,zh;q=0.9", "Asia/Shanghai", ["114.240.0.0/12", "123.112.0.0/12"], "172.20.0.96/28"),
+    ("jp", 0.05, "ja-JP,ja;q=0.9,en;q=0.8", "Asia/Tokyo", ["126.0.0.0/9"], "172.20.0.112/28"),
+]
+
+# (platform, share, User-Agent template; {v} is a browser version)
+BROWSERS = [
+    ("Windows", 0.38, "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                      "Chrome/{v}.0.0.0 Safari/537.36"),
+    ("Windows", 0.10, "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                      "Chrome/{v}.0.0.0 Safari/537.36 Edg/{v}.0.0.0"),
+    ("macOS", 0.14, "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+                    "Version/17.{m} Safari/605.1.15"),
+    ("macOS", 0.12, "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) "
+                    "Chrome/{v}.0.0.0 Safari/537.36"),
+    ("Linux", 0.06, "Mozilla/5.0 (X11; Linux x86_64; rv:{v}.0) Gecko/20100101 Firefox/{v}.0"),
+    ("iOS", 0.11, "Mozilla/5.0 (iPhone; CPU iPhone OS 17_{m} like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+                  "Version/17.{m} Mobile/15E148 Safari/604.1"),
+    ("Android", 0.09, "Mozilla/5.0 (Linux; Android 14; K) AppleWebKit/537.36 (KHTML, like Gecko) "
+                      "Chrome/{v}.0.0.0 Mobile Safari/537.36"),
+]
+
+# Work pattern -> where requests come from (location, weight)
+PATTERNS = {
+    "office": [("office", 0.80), ("home", 0.12), ("mobile", 0.08)],
+    "remote": [("home", 0.70), ("vpn", 0.20), ("mobile", 0.10)],
+    "mobile": [("mobile", 0.60), ("home", 0.25), ("office", 0.15)],
+}
+PATTERN_SHARES = [("office", 0.50), ("remote", 0.35), ("mobile", 0.15)]
+CGNAT = ipaddress.ip_network("100.64.0.0/10")
+VPN = ipaddress.ip_network("10.8.0.0/16")
+ZITI_SHARE = 0.3
+ZIPF_EXPONENT = 0.9
+
+
+def _pick(rng, table, share=1):
+    return rng.choices(table, [row[share] for row in table])[0]
+
+
+def _address(rng, network):
+    network = ipaddress.ip_network(network)
+    return str(network[rng.randrange(1, network.num_addresses - 1)])
+
+
+def make_identity(i, seed=SYNTHETIC_SEED):
+    """User ``i`` of the population; the same for every population size."""
+    rng = random.Random(seed * 1_000_003 + i)
+    department, _, extra_roles, _ = _pick(rng, DEPARTMENTS)
+    roles = BASE_ROLES + extra_roles
+    if (department == "operations" and rng.random() < 0.2) or rng.random() < 0.005:
+        roles = roles + ["admin"]
+    if rng.random() < 0.01:
+        roles = roles + ["auditor"]
+    region, _, language, tz, isps, office = _pick(rng, REGIONS)
+    devices = []
+    for _ in range(rng.choices((1, 2, 3), (0.55, 0.33, 0.12))[0]):
+        platform, _, template = _pick(rng, BROWSERS)
+        devices.append(Device(template.format(v=rng.randint(118, 125), m=rng.randint(0, 5)), language, platform, tz))
+    pattern = _pick(rng, PATTERN_SHARES)[0]
+    username = f"syn{i:06d}.{department[:3]}"
+    return Identity(
+        username=username,
+        roles=roles,
+        department=department,
+        region=region,
+        devices=devices,
+        pattern=pattern,
+        home_ip=_address(rng, rng.choice(isps)),
+        office_ip=_address(rng, office),
+        vpn_ip=_address(rng, VPN),
+        ziti_identity=f"{username}@openziti" if rng.random() < ZITI_SHARE else None,
+        weight=0.0,
+    )
+
+
+class Population:
+    def __init__(self, size, seed=SYNTHETIC_SEED):
+        self.seed = seed
+        rng = random.Random(seed)
+        # Zipf activity over a random ranking of the users
+        ranks = list(range(1, size + 1))
+        rng.shuffle(ranks)
+        self.identities = [make_identity(i, seed)._replace(weight=r ** -ZIPF_EXPONENT) for i, r in enumerate(ranks)]
+        self._cum = list(itertools.accumulate(u.weight for u in self.identities))
+
+    def __len__(self):
+        return len(self.identities)
+
+    def __iter__(self):
+        return iter(self.identities)
+
+    def pick(self, rng):
+        """A user, busy users more often."""
+        return rng.choices(self.identities, cum_weights=self._cum)[0]
+
+    @staticmethod
+    def request(identity, rng, resource=None):
+        """``(headers, body)`` for one access request by ``identity``; no Authorization header."""
+        # The first device is the usual one
+        device = identity.devices[0] if rng.random() < 0.8 else rng.choice(identity.devices)
+        location = rng.choices(*zip(*PATTERNS[identity.pattern]))[0]
+        ip = {"office": identity.office_ip, "home": identity.home_ip, "vpn": identity.vpn_ip}.get(location) \
+            or _address(rng, CGNAT)
+        headers = {"User-Agent": device.user_agent, "Accept-Language": device.accept_language, "X-Forwarded-For": ip}
+        if identity.ziti_identity:
+            headers.update({"X-Via-Ziti": "true", "X-Openziti-Identity": identity.ziti_identity})
+        if resource is None:
+            resources = next(d[3] for d in DEPARTMENTS if d[0] == identity.department)
+            resource = rng.choice(resources) if rng.random() < 0.9 else rng.choice(("/", "/admin/panel", "/docs"))
+        return headers, {"resource": resource, "platform": device.platform, "timezone": device.timezone}
+
+
+class TokenFactory:
+    """Locally signed tokens per synthetic user, re-minted shortly before they expire."""
+
+    def __init__(self, key=None, ttl=3600):
+        from jwks_dev import load_or_create_key, mint_token
+        self.key = key or load_or_create_key()
+        self._mint = mint_token
+        self.ttl = ttl
+        self._tokens = {}  # username -> (token, exp)
+
+    def token(self, identity):
+        cached = self._tokens.get(identity.username)
+        if cached is not None and cached[1] - 60 > time.time():
+            return cached[0]
+        now = int(time.time())
+        token = self._mint(self.key, identity.username, identity.roles, ttl=self.ttl, extra={
+            "email": f"{identity.username}@example.com",
+            "auth_time": now,
+            "acr": "1",
+            "department": identity.department,
+        })
+        self._tokens[identity.username] = (token, now + self.ttl)
+        return token
+
+    def mint_all(self, identities):
+        return [self.token(u) for u in identities]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Generate synthetic users (and tokens) for load and scale tests")
+    ap.add_argument("--users", type=int, default=10000)
+    ap.add_argument("--seed", type=int, default=SYNTHETIC_SEED)
+    ap.add_argument("--out", help="write the users as JSONL here")
+    ap.add_argument("--tokens", action="store_true", help="include a signed token per user")
+    ap.add_argument("--ttl", type=int, default=3600, help="token lifetime (s)")
+    ap.add_argument("--requests", type=int, default=0, help="print this many example requests")
+    args = ap.parse_args()
+
+    started = time.perf_counter()
+    population = Population(args.users, args.seed)
+    factory = TokenFactory(ttl=args.ttl) if args.tokens else None
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            for u in population:
+                row = {**u._asdict(), "devices": [d._asdict() for d in u.devices]}
+                if factory is not None:
+                    row["token"] = factory.token(u)
+                f.write(json.dumps(row) + "\n")
+    print(f"{len(population)} users in {time.perf_counter() - started:.1f}s"
+          + (f" -> {args.out}" if args.out else ""), file=sys.stderr)
+    for name, values in (("department", [u.department for u in population]),
+                         ("pattern", [u.pattern for u in population]),
+                         ("region", [u.region for u in population]),
+                         ("role", [r for u in population for r in u.roles if r not in BASE_ROLES]),
+                         ("devices", [len(u.devices) for u in population]),
+                         ("ziti", [u.ziti_identity is not None for u in population])):
+        print(f"  {name:<11}" + "  ".join(f"{k}={v}" for k, v in Counter(values).most_common()), file=sys.stderr)
+    rng = random.Random(args.seed)
+    for _ in range(args.requests):
+        u = population.pick(rng)
+        print(json.dumps({"user": u.username, **dict(zip(("headers", "body"), Population.request(u, rng)))}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import time
+
+import pytest
+import redis
+
+import policy_table
+from access_log import AccessLog
+from degraded_mode import CircuitBreaker, RedisGuard, ResilientTrustStore
+from trust_state import TrustStateStore
+from ziti_gateway import EnhancedZeroTrustGateway
+
+fakeredis = pytest.importorskip("fakeredis")
+
+BUDGET_MS = 30
+FAILURES = 3
+RESOURCES = ("/", "/finance/report", "/admin/panel", "/hr/records")
+
+
+def inject(client, budget):
+    """Put a switchable fault under ``client.execute_command``; returns the switch."""
+    fault = {"mode": None, "calls": 0}
+    execute = client.execute_command
+
+    def execute_command(*args, **kwargs):
+        if fault["mode"] is None:
+            return execute(*args, **kwargs)
+        fault["calls"] += 1
+        if fault["mode"] == "stall":
+            # A stalled Redis: the socket timeout from client_options ends the wait at the budget
+            time.sleep(budget)
+            raise redis.exceptions.TimeoutError("Timeout reading from socket")
+        raise redis.exceptions.ConnectionError("Connection refused")
+
+    client.execute_command = execute_command
+    return fault
+
+
+def gateway_for(mode):
+    client = fakeredis.FakeRedis(decode_responses=True)
+    fault = inject(client, BUDGET_MS / 1000)
+    guard = RedisGuard("test", budget_ms=BUDGET_MS, breaker=CircuitBreaker("test", failures=FAILURES, reset=60))
+    guard.wrap(client)
+    access_log = AccessLog(client)
+    trust_store = ResilientTrustStore(TrustStateStore(client), guard, access_log, mode=mode)
+    gateway = EnhancedZeroTrustGateway(client, trust_store, access_log, policy_table.from_env("policy_ziti.json"),
+                                       None, use_ziti=False)
+
+    @guard.request
+    def decide(i):
+        """One /api/access-request decision, as app_ziti.py makes it."""
+        resource = RESOURCES[i % len(RESOURCES)]
+        ctx = gateway.build_request_context({"User-Agent": "pytest"}, f"10.3.0.{i % 8}", {"resource": resource})
+        combined_score, network_score, app_score = gateway.calculate_combined_trust_score(f"u{i % 8}", ctx)
+        return gateway.enforce_policy_with_layers(f"u{i % 8}", combined_score, network_score, app_score, resource,
+                                                  degraded=ctx["degraded"])
+
+    return decide, guard, fault
+
+
+def run(decide, n):
+    timings, policies = [], []
+    for i in range(n):
+        started = time.perf_counter()
+        policies.append(decide(i))
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return timings[int(0.99 * (len(timings) - 1))] * 1000, [p["action"] for p in policies]
+
+
+@pytest.mark.parametrize("fault_mode", ["stall", "drop"])
+@pytest.mark.parametrize("failure_mode, allowed", [
+    ("restricted", {"allow_restricted", "require_mfa", "deny"}),
+    ("closed", {"deny"}),
+])
+def test_decisions_stay_within_budget_while_redis_is_gone(fault_mode, failure_mode, allowed):
+    decide, guard, fault = gateway_for(failure_mode)
+    _, healthy = run(decide, 40)
+    assert "allow" in healthy and guard.breaker.state_name == "closed"
+
+    fault["mode"] = fault_mode
+    p99_ms, actions = run(decide, 400)
+
+    assert p99_ms <= BUDGET_MS
+    assert guard.breaker.state_name == "open"
+    # Once open, the breaker keeps every later call away from Redis
+    assert fault["calls"] == FAILURES
+    assert set(actions) <= allowed
+    if failure_mode == "restricted":
+        assert "allow_restricted" in actions
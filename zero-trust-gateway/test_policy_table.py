@@ -0,0 +1,31 @@
+from policy_table import BELOW_LOWEST_BAND, PolicyTable
+
+DOCUMENT = {
+    "bands": [
+        {"min_score": 80, "action": "allow", "restrictions": None, "monitoring_level": "standard",
+         "reason": "low_risk"},
+        {"min_score": 40, "action": "require_mfa", "restrictions": ["minimal_access"],
+         "monitoring_level": "strict", "reason": "high_risk_stepup"},
+    ],
+    "resources": [
+        {"prefix": "/finance", "bands": [
+            {"min_score": 90, "action": "allow", "restrictions": None, "monitoring_level": "standard",
+             "reason": "finance_ok"},
+        ]},
+    ],
+}
+
+
+def test_bands_by_score():
+    table = PolicyTable(DOCUMENT)
+    assert table.decide("/", 95)["action"] == "allow"
+    assert table.decide("/", 80)["action"] == "allow"
+    assert table.decide("/", 40)["action"] == "require_mfa"
+
+
+def test_score_below_lowest_band_is_denied():
+    table = PolicyTable(DOCUMENT)
+    assert table.decide("/", 39) is BELOW_LOWEST_BAND
+    assert table.decide("/", -5)["action"] == "deny"
+    assert table.decide("/finance/reports", 85) is BELOW_LOWEST_BAND
+    assert table.decide("/finance/reports", 90)["reason"] == "finance_ok"
@@ -0,0 +1,25 @@
+import random
+
+import pytest
+
+from risk_sketch import ACCESS_KEYS, RiskTracker
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def test_access_counts_never_fall_across_evictions():
+    client = fakeredis.FakeRedis(decode_responses=True)
+    tracker = RiskTracker(client, top=5, capacity=8)
+    rng = random.Random(3)
+    last, previous, reentered = {}, set(), 0
+    for _ in range(300):
+        for _ in range(rng.randint(1, 20)):
+            tracker.observe(f"u{int(rng.paretovariate(1.2)) % 40}", None, 50)
+        tracker.flush()
+        for subject, value in client.zrange(ACCESS_KEYS["user"], 0, -1, withscores=True):
+            if subject in last and subject not in previous:
+                reentered += 1
+            assert value >= last.get(subject, 0)
+            last[subject] = value
+        previous = set(client.zrange(ACCESS_KEYS["user"], 0, -1))
+    assert reentered > 0
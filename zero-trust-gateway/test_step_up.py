@@ -0,0 +1,91 @@
+import time
+
+from step_up import StepUpStore
+
+
+class FakeRedis:
+    """The hash commands ``StepUpStore`` uses, kept in a dict."""
+
+    def __init__(self):
+        self.hashes = {}
+
+    def hmget(self, key, fields):
+        h = self.hashes.get(key, {})
+        return [h.get(f) for f in fields]
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field] = str(value)
+
+    def hsetnx(self, key, field, value):
+        self.hashes.setdefault(key, {}).setdefault(field, str(value))
+
+    def hdel(self, key, field):
+        self.hashes.get(key, {}).pop(field, None)
+
+    def pexpire(self, key, ms):
+        pass
+
+    def pipeline(self, transaction=False):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, method):
+        return lambda *args: self.calls.append((method, args))
+
+    def __len__(self):
+        return len(self.calls)
+
+    def execute(self):
+        return [getattr(self.client, method)(*args) for method, args in self.calls]
+
+
+def _challenged_then_login(store, claims):
+    """Challenge the device, then present a token issued after the challenge."""
+    now = time.time()
+    assert store.check("alice", "device-1", 50, {"acr": "1", "auth_time": int(now) - 60}, now=now) is None
+    return store.check("alice", "device-1", 50, dict(claims, auth_time=int(now) + 1), now=now + 2)
+
+
+def test_password_login_after_challenge_gets_no_grant():
+    store = StepUpStore(FakeRedis())
+    assert _challenged_then_login(store, {"acr": "1"}) is None
+    assert _challenged_then_login(store, {"acr": "1", "amr": ["pwd"]}) is None
+
+
+def test_mfa_login_after_challenge_is_granted():
+    assert _challenged_then_login(StepUpStore(FakeRedis()), {"acr": "1", "amr": ["otp"]}) is not None
+    assert _challenged_then_login(StepUpStore(FakeRedis()), {"acr": "2"}) is not None
+
+
+def test_reauth_only_when_enabled():
+    assert _challenged_then_login(StepUpStore(FakeRedis(), reauth=True), {"acr": "1"}) is not None
+
+
+def test_batch_queues_writes_on_the_callers_pipeline():
+    client, now = FakeRedis(), time.time()
+    store = StepUpStore(client)
+    pipe = client.pipeline()
+    requests = [("alice", "device-1", 50, {"acr": "1", "amr": ["otp"], "auth_time": int(now)}, "require_mfa"),
+                ("bob", "device-2", 50, {"acr": "1", "auth_time": int(now)}, "require_mfa")]
+    grants = store.check_many(requests, pipe=pipe, now=now)
+    assert grants[0] is not None and grants[1] is None
+    assert client.hashes == {}
+    pipe.execute()
+    assert store.check("alice", "device-1", 50, {"acr": "1"}, now=now) is not None
+
+
+def test_fields_read_ahead_of_the_score_resolve_like_check():
+    client, now = FakeRedis(), time.time()
+    store = StepUpStore(client)
+    claims = {"acr": "1", "amr": ["otp"], "auth_time": int(now)}
+    stored = store.read("alice", "device-1")
+    pipe = client.pipeline()
+    assert store.resolve("alice", "device-1", 50, claims, "require_mfa", stored, pipe, now=now) is not None
+    pipe.execute()
+    assert store.check("alice", "device-1", 50, {"acr": "1"}, now=now) is not None
+    assert store.resolve("alice", "device-1", 50, claims, "require_mfa", None, client.pipeline(), now=now) is None
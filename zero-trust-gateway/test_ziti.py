@@ -1,29 +1,54 @@
 import os
+import csv
 import time
 import json
 import requests
 from datetime import datetime
-import pandas as pd
 import matplotlib.pyplot as plt
 
+from decision_archive import Summary
+
 # Configuration
 KC_BASE = os.getenv("KC_BASE", "http://localhost:8080")
 REALM = os.getenv("KC_REALM", "my-company")
 CLIENT_ID = os.getenv("KC_CLIENT_ID", "my-app")
 USERNAME = os.getenv("KC_USERNAME", "alice")
 PASSWORD = os.getenv("KC_PASSWORD", "alicepwd")
+# "local": sign the token with the dev key instead of asking Keycloak (see jwks_dev.py)
+TOKEN_SOURCE = os.getenv("TOKEN_SOURCE", "keycloak")
 
 STANDARD_GATEWAY = "http://localhost:5000/api/access-request"
 ZITI_GATEWAY = "http://localhost:5001/api/access-request"
+RESULTS_CSV = "out/reports/ziti_results.csv"
+RESULT_FIELDS = ["ts", "mode", "resource", "trust_score", "app_score", "network_score",
+                 "action", "reason", "latency_ms", "status_code"]
 
 
 class ZitiTester:
     def __init__(self):
         self.token = None
-        self.results = {"standard": [], "ziti": []}
+        # Results are appended to RESULTS_CSV and aggregated as they arrive, not kept in memory
+        self.summaries = {"standard": Summary(), "ziti": Summary()}
+        os.makedirs(os.path.dirname(RESULTS_CSV), exist_ok=True)
+        self._results = open(RESULTS_CSV, "a", newline="", encoding="utf-8")
+        self._writer = csv.DictWriter(self._results, fieldnames=RESULT_FIELDS)
+        if self._results.tell() == 0:
+            self._writer.writeheader()
+
+    def record(self, mode, row):
+        """Append one result to RESULTS_CSV and to the mode's running summary"""
+        row = {"ts": datetime.now().isoformat(), "mode": mode, **row}
+        self._writer.writerow(row)
+        self._results.flush()
+        self.summaries[mode].add_records([row])
 
     def get_token(self):
         """Obtain token from Keycloak"""
+        if TOKEN_SOURCE == "local":
+            from jwks_dev import load_or_create_key, mint_token
+            self.token = mint_token(load_or_create_key(), USERNAME, ("user",))
+            print("✅ Token signed locally")
+            return self.token
         url = f"{KC_BASE}/realms/{REALM}/protocol/openid-connect/token"
         data = {
             "client_id": CLIENT_ID,
@@ -49,13 +74,12 @@ class ZitiTester:
                 resp = requests.post(STANDARD_GATEWAY, headers=headers, json=body, timeout=10)
                 latency_ms = int((time.perf_counter() - t0) * 1000)
                 data = resp.json()
-                self.results["standard"].append({
-                    "timestamp": datetime.now().isoformat(),
+                self.record("standard", {
                     "resource": resource,
                     "trust_score": data.get("trust_score", 0),
                     "app_score": data.get("app_trust_score", 0),
                     "network_score": data.get("network_trust_score", 0),
-                    "decision": data.get("access_decision", ""),
+                    "action": data.get("access_decision", ""),
                     "reason": data.get("reason", ""),
                     "latency_ms": latency_ms,
                     "status_code": resp.status_code
@@ -82,13 +106,12 @@ class ZitiTester:
                 resp = requests.post(ZITI_GATEWAY, headers=headers, json=body, timeout=10)
                 latency_ms = int((time.perf_counter() - t0) * 1000)
                 data = resp.json()
-                self.results["ziti"].append({
-                    "timestamp": datetime.now().isoformat(),
+                self.record("ziti", {
                     "resource": resource,
                     "trust_score": data.get("trust_score", 0),
                     "app_score": data.get("app_trust_score", 0),
                     "network_score": data.get("network_trust_score", 0),
-                    "decision": data.get("access_decision", ""),
+                    "action": data.get("access_decision", ""),
                     "reason": data.get("reason", ""),
                     "latency_ms": latency_ms,
                     "status_code": resp.status_code
@@ -179,24 +202,25 @@ class ZitiTester:
         print("\n📈 Generating comparison report")
 
         os.makedirs("out/reports", exist_ok=True)
-        df_standard = pd.DataFrame(self.results["standard"])
-        df_ziti = pd.DataFrame(self.results["ziti"])
+        standard = self.summaries["standard"].rows()
+        ziti = self.summaries["ziti"].rows()
 
-        if not df_standard.empty and not df_ziti.empty:
+        if standard and ziti:
+            standard, ziti = standard[0], ziti[0]
             stats = {
                 "Standard Mode": {
-                    "Avg Trust Score": df_standard["trust_score"].mean(),
-                    "Avg Latency (ms)": df_standard["latency_ms"].mean(),
-                    "Allow Rate": (df_standard["decision"] == "allow").mean() * 100,
-                    "Deny Rate": (df_standard["decision"] == "deny").mean() * 100
+                    "Avg Trust Score": standard["avg_trust_score"],
+                    "Avg Latency (ms)": standard["avg_latency_ms"],
+                    "Allow Rate": standard["allow_rate"],
+                    "Deny Rate": standard["deny_rate"]
                 },
                 "OpenZiti Mode": {
-                    "Avg Trust Score": df_ziti["trust_score"].mean(),
-                    "Avg Network Score": df_ziti["network_score"].mean(),
-                    "Avg App Score": df_ziti["app_score"].mean(),
-                    "Avg Latency (ms)": df_ziti["latency_ms"].mean(),
-                    "Allow Rate": (df_ziti["decision"] == "allow").mean() * 100,
-                    "Deny Rate": (df_ziti["decision"] == "deny").mean() * 100
+                    "Avg Trust Score": ziti["avg_trust_score"],
+                    "Avg Network Score": ziti["avg_network_score"],
+                    "Avg App Score": ziti["avg_app_score"],
+                    "Avg Latency (ms)": ziti["avg_latency_ms"],
+                    "Allow Rate": ziti["allow_rate"],
+                    "Deny Rate": ziti["deny_rate"]
                 }
             }
 
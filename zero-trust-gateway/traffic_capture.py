@@ -0,0 +1,133 @@
+"""Sampled, anonymised capture of /api/access-request inputs for replay.
+
+With ``TRAFFIC_CAPTURE=true`` the gateways hand every decided request to
+``TrafficCapture.record``; a sampled subset is queued to a background
+JSONL writer (a ``DecisionSink``, so a full queue drops records instead of
+slowing requests).  Each line holds what the decision depended on and what
+the gateway answered:
+
+    {"ts": 1760670000.123456, "user": "u-6f1c...", "ip": "93.41.7.200",
+     "headers": {"User-Agent": "...", "Accept-Language": "..."},
+     "resource": "/finance/report", "platform": "", "timezone": "",
+     "claims": {"roles": ["user"]}, "action": "allow", "trust_score": 85,
+     "status": 200, "latency_ms": 3.1}
+
+Sampling is per user (``CAPTURE_SAMPLE`` is the fraction of users), so a
+captured user's requests are all there, in order.  User names and OpenZiti
+identities become keyed hashes, IPv4/IPv6 addresses are mapped
+prefix-preservingly (two addresses in one /24 stay in one /24), and of the
+token only the realm roles and the step-up claims are kept.  The mapping
+is keyed by ``CAPTURE_SALT``, or else by a random salt kept in
+``.capture-salt`` next to the capture (shared by the workers of one host;
+set ``CAPTURE_SALT`` for several replicas).  ``traffic_replay.py`` re-issues
+a capture against a gateway.
+"""
+import os
+import hashlib
+import ipaddress
+from functools import lru_cache
+
+from decision_sink import DecisionSink
+
+CAPTURE_HEADERS = ("User-Agent", "Accept-Language", "X-Via-Ziti", "X-Openziti-Identity")
+CAPTURE_CLAIMS = ("acr", "amr", "azp")
+BODY_FIELDS = ("resource", "platform", "timezone")
+
+
+def shared_salt(path):
+    """Read the salt file at ``path``, creating it first if needed (atomically, as workers race)."""
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(os.urandom(16).hex())
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    with open(path) as f:
+        return f.read().strip()
+
+
+class TrafficCapture:
+    def __init__(self, path, sample=1.0, salt=None, anonymize=True, max_queue=10000,
+                 rotate_bytes=0, compress=False):
+        self.sample = sample
+        self.anonymize = anonymize
+        self._salt = (salt or os.urandom(16).hex()).encode()[:64]
+        self._threshold = int(min(max(sample, 0.0), 1.0) * 2 ** 64)
+        self._user = lru_cache(maxsize=65536)(self._user_uncached)
+        self._ip = lru_cache(maxsize=65536)(self._ip_uncached)
+        self.sink = DecisionSink(path, [], fmt="jsonl", max_queue=max_queue,
+                                 rotate_bytes=rotate_bytes, compress=compress)
+
+    @classmethod
+    def from_env(cls, path="out/captures/requests.jsonl"):
+        if os.getenv("TRAFFIC_CAPTURE", "false").lower() != "true":
+            return None
+        path = os.getenv("CAPTURE_PATH", path)
+        salt = os.getenv("CAPTURE_SALT") or shared_salt(os.path.join(os.path.dirname(path), ".capture-salt"))
+        slot = os.getenv("WORKER_SLOT")
+        if slot is not None:
+            stem, ext = os.path.splitext(path)
+            path = f"{stem}.w{slot}{ext}"
+        return cls(
+            path,
+            sample=float(os.getenv("CAPTURE_SAMPLE", "1.0")),
+            salt=salt,
+            anonymize=os.getenv("CAPTURE_ANONYMIZE", "true").lower() == "true",
+            max_queue=int(os.getenv("CAPTURE_QUEUE", "10000")),
+            rotate_bytes=int(float(os.getenv("CAPTURE_ROTATE_MB", "0")) * 1024 * 1024),
+            compress=os.getenv("CAPTURE_GZIP", "false").lower() == "true",
+        )
+
+    def _digest(self, kind, value):
+        return hashlib.blake2b(value.encode(), key=self._salt, person=kind, digest_size=16).digest()
+
+    def _user_uncached(self, user_id):
+        """``(name in the capture, sampled?)``; both derive from one keyed hash."""
+        d = self._digest(b"user", user_id)
+        name = f"u-{d[:8].hex()}" if self.anonymize else user_id
+        return name, int.from_bytes(d[8:], "big") < self._threshold
+
+    def _ip_uncached(self, ip):
+        if not self.anonymize:
+            return ip
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return ip  # "ziti-network" and the like
+        # Each byte is XORed with a pad keyed by the bytes before it, so shared prefixes stay shared
+        raw = addr.packed
+        out = bytes(b ^ self._digest(b"ip", raw[:i].hex())[0] for i, b in enumerate(raw))
+        return str(ipaddress.ip_address(out))
+
+    def record(self, headers, ip, body, claims, action, trust_score, status, latency_s, ts):
+        """Queue one decided request if its user is sampled; ``headers`` needs a ``get``."""
+        user, sampled = self._user(claims.get("preferred_username", "unknown"))
+        if not sampled:
+            return False
+        captured = {h: headers.get(h) for h in CAPTURE_HEADERS if headers.get(h) is not None}
+        if self.anonymize and "X-Openziti-Identity" in captured:
+            captured["X-Openziti-Identity"] = f"z-{self._digest(b'ziti', captured['X-Openziti-Identity'])[:8].hex()}"
+        kept = {"roles": claims.get("realm_access", {}).get("roles", [])}
+        kept.update({c: claims[c] for c in CAPTURE_CLAIMS if c in claims})
+        if "auth_time" in claims:
+            kept["auth_age"] = round(ts - claims["auth_time"], 3)
+        return self.sink.submit({
+            "ts": round(ts, 6),
+            "user": user,
+            "ip": self._ip(ip),
+            "headers": captured,
+            **{f: body.get(f, "/" if f == "resource" else "") for f in BODY_FIELDS},
+            "claims": kept,
+            "action": action,
+            "trust_score": trust_score,
+            "status": status,
+            "latency_ms": round(latency_s * 1000, 3),
+        })
+
+    def close(self):
+        self.sink.close()
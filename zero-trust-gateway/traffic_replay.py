@@ -0,0 +1,242 @@
+# traffic_replay.py — Re-issue captured /api/access-request traffic at 1x, 10x or 100x its original rate
+#
+#   python traffic_replay.py out/captures/requests_ziti.jsonl --url http://localhost:5001/api/access-request
+#   python traffic_replay.py out/captures/ --speed 100 --max-idle 5 --json out/replay.json
+#   python traffic_replay.py out/captures/ --speed 10 --mismatches out/replay_mismatches.csv --min-match 0.95
+#
+# Captures come from the gateways' TRAFFIC_CAPTURE (see traffic_capture.py);
+# rotated, gzipped and per-worker files are merged by time.  Requests are
+# sent open-loop at (capture time / --speed), with the captured headers,
+# body and client IP (as X-Forwarded-For, so run the gateway with
+# TRUSTED_PROXIES=1).  A user's requests stay in order:
+# one is not sent before the user's previous one has been answered, and
+# latency is then measured from when it was released rather than from its
+# slot.  Tokens are re-signed with the dev key for the captured (pseudonymous)
+# user and roles, so run the gateway with JWKS_URL pointing at
+# `python jwks_dev.py serve` (or JWT_VERIFY=false).
+#
+# Reported: original vs replayed action per request (a confusion matrix),
+# original vs replayed latency, requests held back for ordering and send
+# lag.  Decisions depend on per-user state in Redis and on the time of day,
+# so replay against a flushed db to compare like with like.
+import os, csv, gzip, json, time, heapq, asyncio, argparse
+from collections import Counter
+from urllib.parse import urlsplit
+
+from bench_async import HTTPConnection
+from loadgen import LatencyHistogram
+
+API_URL = os.getenv("GATEWAY_URL", "http://localhost:5000/api/access-request")
+CAPTURE_SUFFIXES = (".jsonl", ".jsonl.gz")
+
+
+def capture_files(paths):
+    out = []
+    for p in paths:
+        if os.path.isdir(p):
+            out += [os.path.join(p, f) for f in sorted(os.listdir(p)) if f.endswith(CAPTURE_SUFFIXES)]
+        else:
+            out.append(p)
+    return out
+
+
+def read_capture(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def merged(paths):
+    """All captured requests in time order (each file is already close to it)."""
+    return heapq.merge(*(read_capture(p) for p in capture_files(paths)), key=lambda r: r["ts"])
+
+
+class TokenMinter:
+    """One token per captured user, claims and roles, signed with the dev key."""
+
+    def __init__(self, ttl):
+        from jwks_dev import load_or_create_key, mint_token
+        self.key, self.mint, self.ttl = load_or_create_key(), mint_token, ttl
+        self.tokens = {}
+
+    def token(self, entry):
+        claims = dict(entry.get("claims") or {})
+        roles = tuple(claims.pop("roles", ("user",)))
+        auth_age = claims.pop("auth_age", None)
+        key = (entry["user"], roles, json.dumps(claims, sort_keys=True), auth_age is not None)
+        if key not in self.tokens:
+            if auth_age is not None:
+                claims["auth_time"] = int(time.time() - auth_age)
+            self.tokens[key] = self.mint(self.key, entry["user"], roles, ttl=self.ttl, extra=claims or None)
+        return self.tokens[key]
+
+
+class Replay:
+    def __init__(self, url, connections, timeout, minter, speed, max_idle=None, mismatches=None):
+        u = urlsplit(url)
+        self.host, self.port, self.path = u.hostname, u.port or 80, u.path
+        self.timeout = timeout
+        self.minter = minter
+        self.speed = speed
+        self.max_idle = max_idle
+        self.pool = asyncio.Queue()
+        for _ in range(connections):
+            self.pool.put_nowait(HTTPConnection(self.host, self.port))
+        self.tails = {}  # user -> task of the user's latest request
+        self.pending = set()
+        self.outcomes = Counter()  # (captured action, replayed action)
+        self.original = LatencyHistogram()
+        self.latency = LatencyHistogram()
+        self.send_lag = LatencyHistogram()
+        self.held = 0
+        self.errors = Counter()
+        self.mismatches = mismatches
+
+    def _request(self, entry):
+        headers = {**(entry.get("headers") or {}), "Authorization": f"Bearer {self.minter.token(entry)}",
+                   "Content-Type": "application/json", "X-Forwarded-For": entry.get("ip") or "0.0.0.0"}
+        body = {f: entry.get(f, "") for f in ("resource", "platform", "timezone")}
+        return headers, json.dumps(body).encode()
+
+    async def _send(self, entry, intended, previous):
+        loop = asyncio.get_running_loop()
+        released = intended
+        if previous is not None and not previous.done():
+            self.held += 1
+            await asyncio.wait([previous])
+            released = max(intended, loop.time())
+        self.send_lag.record(max(0.0, loop.time() - released))
+        headers, body = self._request(entry)
+        conn = await self.pool.get()
+        try:
+            status, payload = await asyncio.wait_for(conn.request("POST", self.path, headers, body), self.timeout)
+            try:
+                data = json.loads(payload)
+            except ValueError:
+                data = {}
+            action = data.get("access_decision") or f"http_{status}"
+        except asyncio.TimeoutError:
+            await conn.close()
+            self.errors["timeout"] += 1
+            action, data = "ERR", {}
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            await conn.close()
+            self.errors[type(e).__name__] += 1
+            action, data = "ERR", {}
+        finally:
+            self.pool.put_nowait(conn)
+        self.latency.record(loop.time() - released)
+        if entry.get("latency_ms") is not None:
+            self.original.record(entry["latency_ms"] / 1000)
+        captured = entry.get("action") or f"http_{entry.get('status')}"
+        self.outcomes[(captured, action)] += 1
+        if self.mismatches is not None and captured != action:
+            self.mismatches.writerow([entry["ts"], entry["user"], entry.get("resource", ""), captured, action,
+                                      entry.get("trust_score", ""), data.get("trust_score", "")])
+
+    def _launch(self, entry, intended):
+        loop = asyncio.get_running_loop()
+        user = entry["user"]
+        task = loop.create_task(self._send(entry, intended, self.tails.get(user)))
+        self.tails[user] = task
+        self.pending.add(task)
+
+        def done(t):
+            self.pending.discard(t)
+            if self.tails.get(user) is t:
+                del self.tails[user]
+        task.add_done_callback(done)
+
+    async def run(self, entries, limit=None):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        offset = 0.0  # capture seconds since the first request, idle gaps capped at --max-idle
+        previous = None
+        for n, entry in enumerate(entries):
+            if limit is not None and n >= limit:
+                break
+            if previous is not None:
+                gap = max(0.0, entry["ts"] - previous)
+                offset += min(gap, self.max_idle) if self.max_idle is not None else gap
+            previous = entry["ts"] if previous is None else max(previous, entry["ts"])
+            intended = start + offset / self.speed
+            delay = intended - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._launch(entry, intended)
+        if self.pending:
+            await asyncio.wait(set(self.pending), timeout=self.timeout + 5)
+        while not self.pool.empty():
+            await self.pool.get_nowait().close()
+        return loop.time() - start
+
+
+def report(replay, elapsed, args):
+    total = sum(replay.outcomes.values())
+    matched = sum(n for (a, b), n in replay.outcomes.items() if a == b)
+    actions = sorted({a for pair in replay.outcomes for a in pair})
+    print(f"{total} requests replayed at {args.speed:g}x in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f}/s), "
+          f"{replay.held} held back for per-user order")
+    corner = "captured \\ replayed"
+    print(f"\n{corner:<22}" + "".join(f"{a:>18}" for a in actions))
+    for a in actions:
+        print(f"{a:<22}" + "".join(f"{replay.outcomes.get((a, b), 0):>18}" for b in actions))
+    match = matched / total if total else 1.0
+    print(f"\nsame decision: {matched}/{total} ({match:.1%})")
+    rows = []
+    for name, h in (("captured", replay.original), ("replayed", replay.latency)):
+        rows.append({"latency": name, "p50_ms": h.percentile(0.5), "p90_ms": h.percentile(0.9),
+                     "p99_ms": h.percentile(0.99), "max_ms": h.max / 1000, "mean_ms": h.mean()})
+        print(f"{name:<10} latency  p50 {rows[-1]['p50_ms']:.2f}  p90 {rows[-1]['p90_ms']:.2f}  "
+              f"p99 {rows[-1]['p99_ms']:.2f}  max {rows[-1]['max_ms']:.1f} ms")
+    print(f"send lag p99 {replay.send_lag.percentile(0.99):.2f} ms"
+          + (f", errors {dict(replay.errors)}" if replay.errors else ""))
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"speed": args.speed, "requests": total, "elapsed_s": elapsed, "held": replay.held,
+                       "same_decision": match, "errors": dict(replay.errors), "latency": rows,
+                       "send_lag_p99_ms": replay.send_lag.percentile(0.99),
+                       "outcomes": [{"captured": a, "replayed": b, "count": n}
+                                    for (a, b), n in sorted(replay.outcomes.items())]}, f, indent=2)
+    return match
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay captured gateway traffic")
+    ap.add_argument("paths", nargs="+", help="capture files or directories")
+    ap.add_argument("--url", default=API_URL)
+    ap.add_argument("--speed", type=float, default=1.0, help="rate multiplier, e.g. 1, 10, 100")
+    ap.add_argument("--max-idle", type=float, help="cap gaps between requests at this many capture seconds")
+    ap.add_argument("--limit", type=int, help="replay only the first N requests")
+    ap.add_argument("-c", "--connections", type=int, default=256, help="keep-alive connection pool size")
+    ap.add_argument("--timeout", type=float, default=10)
+    ap.add_argument("--token-ttl", type=int, default=86400)
+    ap.add_argument("--mismatches", help="write requests whose decision changed to this CSV")
+    ap.add_argument("--min-match", type=float, help="exit 1 if fewer than this fraction keep their decision")
+    ap.add_argument("--json", help="write the summary to this file")
+    args = ap.parse_args()
+    if args.speed <= 0:
+        raise SystemExit("--speed must be positive")
+
+    mismatch_file = writer = None
+    if args.mismatches:
+        os.makedirs(os.path.dirname(os.path.abspath(args.mismatches)), exist_ok=True)
+        mismatch_file = open(args.mismatches, "w", newline="", encoding="utf-8")
+        writer = csv.writer(mismatch_file)
+        writer.writerow(["ts", "user", "resource", "captured", "replayed", "captured_score", "replayed_score"])
+    replay = Replay(args.url, args.connections, args.timeout, TokenMinter(args.token_ttl), args.speed,
+                    args.max_idle, writer)
+    print(f"==> replaying {', '.join(args.paths)} at {args.speed:g}x -> {args.url}")
+    elapsed = asyncio.run(replay.run(merged(args.paths), args.limit))
+    if mismatch_file is not None:
+        mismatch_file.close()
+    match = report(replay, elapsed, args)
+    if args.min_match is not None and match < args.min_match:
+        raise SystemExit(f"only {match:.1%} of decisions unchanged (< {args.min_match:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,538 @@
+"""Per-user trust state kept in Redis.
+
+All of the Redis-backed trust signals (IP change, access rate, device
+fingerprint) are read and updated in a single round trip by a server-side
+Lua script.  If scripting is unavailable the store falls back to a MULTI/EXEC
+pipeline that gives the same answers in two round trips.
+
+The access-rate signal comes from the rules in ``rate_limit.py``; every rule
+that applies to a request is checked inside the same script.
+
+Devices are tracked by ``device_registry.py`` (bounded, with last-seen and
+first-seen times); the scripts update it and report the device's age.
+
+With a ``UserStateCache`` attached, a request from the user's current IP on
+a known device only needs the rate check and the device's last-seen time,
+which a smaller script updates and scores in one round trip.  If the device
+has meanwhile been evicted, that script changes nothing and the request
+takes the full path.
+
+The user's hash expires after ``RETAIN_USER_STATE`` seconds without a
+decision (see ``retention.py``); every script run pushes the expiry back.
+
+Keys follow ``redis_layout.py``: a user's hash, device set and per-user rate
+counters share one Cluster slot.  On a Cluster, rules keyed by something
+else (per-IP rules) are checked by a separate call before the scoring
+script.
+"""
+import time
+from collections import namedtuple
+
+import redis
+
+from rate_limit import RATE_LIMIT_MODE, RateLimits, LocalRateLimiter, sliding_level
+from device_registry import DeviceRegistry
+from retention import RETAIN_USER_STATE
+from redis_layout import FIELD_LAST_IP, FIELD_TRUST_SCORE, state_key, devices_key, device_first_key, is_cluster
+
+# ========== Scoring Constants ==========
+PENALTY_IP_CHANGE = 20
+PENALTY_NEW_DEVICE = 25
+
+_SCRIPT_UNAVAILABLE = ("unknown command", "noperm", "disabled")
+
+# device_age: seconds since the device was first seen for the user (0 if new)
+TrustSignals = namedtuple("TrustSignals", ["last_ip", "access_count", "known_device", "score", "device_age"])
+UserState = namedtuple("UserState", ["trust_score", "last_ip", "access_count", "devices"])
+
+# KEYS: user state hash, devices, device first-seen, rate keys...
+# ARGV: ip, fingerprint, base_score, ip_exempt, store_score, channel, message, rule numbers...
+# With a near-cache attached (channel non-empty), an IP or device change
+# (including evictions) is published to the invalidation channel from
+# inside the script.
+# Penalties and rate rules are baked into the script source when the store
+# is created, so each EVALSHA only carries per-request values.
+SCORE_STATE_LUA = """
+if redis.replicate_commands then redis.replicate_commands() end
+__RATE_LUA__
+__DEVICE_LUA__
+local ip = ARGV[1]
+local last_ip = redis.call('HGET', KEYS[1], 'last_ip')
+local count, rate_penalty = check_rates(4, 8)
+local added, age, removed = touch_device(KEYS[2], KEYS[3], ARGV[2])
+
+local score = tonumber(ARGV[3]) - rate_penalty
+if last_ip and last_ip ~= ip and (ARGV[4] == '' or ip ~= ARGV[4]) then
+    score = score - __PENALTY_IP__
+end
+if added == 1 then
+    score = score - __PENALTY_DEVICE__
+elseif age < __DEVICE_YOUNG_MS__ then
+    score = score - __PENALTY_YOUNG__
+end
+score = math.max(0, math.min(100, score))
+
+if ARGV[5] == '1' then
+    redis.call('HSET', KEYS[1], 'last_ip', ip, 'trust_score', score)
+else
+    redis.call('HSET', KEYS[1], 'last_ip', ip)
+end
+if __STATE_TTL_MS__ > 0 then
+    redis.call('PEXPIRE', KEYS[1], __STATE_TTL_MS__)
+end
+if ARGV[6] ~= '' and (last_ip ~= ip or added == 1 or removed > 0) then
+    redis.call('PUBLISH', ARGV[6], ARGV[7])
+end
+return {last_ip, count, 1 - added, score, age}
+"""
+
+# KEYS: user state hash, devices, device first-seen, rate keys...
+# ARGV: fingerprint, base_score, store_score, rule numbers...
+# Rate-only variant for requests whose IP and device are already known.
+# Returns {-1} without touching anything if the device is no longer
+# registered (evicted or expired since it was cached).
+RATE_ONLY_LUA = """
+if redis.replicate_commands then redis.replicate_commands() end
+__RATE_LUA__
+__DEVICE_LUA__
+local seen = tonumber(redis.call('ZSCORE', KEYS[2], ARGV[1]))
+if not seen or (DEVICE_MAX_AGE_MS > 0 and seen <= now_ms - DEVICE_MAX_AGE_MS) then
+    return {-1}
+end
+local added, age = touch_device(KEYS[2], KEYS[3], ARGV[1])
+local count, rate_penalty = check_rates(4, 4)
+local score = tonumber(ARGV[2]) - rate_penalty
+if age < __DEVICE_YOUNG_MS__ then
+    score = score - __PENALTY_YOUNG__
+end
+score = math.max(0, math.min(100, score))
+if ARGV[3] == '1' then
+    redis.call('HSET', KEYS[1], 'trust_score', score)
+end
+if __STATE_TTL_MS__ > 0 then
+    redis.call('PEXPIRE', KEYS[1], __STATE_TTL_MS__)
+end
+return {count, score, age}
+"""
+
+# KEYS: rate keys...  ARGV: rule numbers...
+# Rules whose keys live outside the user's Cluster slot.
+RATE_CHECK_LUA = """
+if redis.replicate_commands then redis.replicate_commands() end
+__RATE_LUA__
+return {check_rates(1, 1)}
+"""
+
+
+def render_script(limits, source=SCORE_STATE_LUA, devices=None, state_ttl=RETAIN_USER_STATE):
+    devices = devices if devices is not None else DeviceRegistry()
+    return (source
+            .replace("__RATE_LUA__", limits.render_lua())
+            .replace("__STATE_TTL_MS__", str(max(0, state_ttl) * 1000))
+            .replace("__DEVICE_LUA__", devices.render_lua())
+            .replace("__DEVICE_YOUNG_MS__", str(devices.young_age_ms))
+            .replace("__PENALTY_YOUNG__", str(devices.young_penalty))
+            .replace("__PENALTY_IP__", str(PENALTY_IP_CHANGE))
+            .replace("__PENALTY_DEVICE__", str(PENALTY_NEW_DEVICE)))
+
+
+def user_keys(user_id):
+    return state_key(user_id), devices_key(user_id), device_first_key(user_id)
+
+
+def apply_penalties(base_score, last_ip, ip, known_device, ip_exempt="", device_penalty=0):
+    """Python twin of the Lua scoring block, used by the fallback path.
+
+    ``base_score`` already has the rate penalty subtracted;
+    ``device_penalty`` is the young-device penalty for a known device.
+    """
+    score = base_score
+    if last_ip and last_ip != ip and (not ip_exempt or ip != ip_exempt):
+        score -= PENALTY_IP_CHANGE
+    if not known_device:
+        score -= PENALTY_NEW_DEVICE
+    return max(0, min(100, score - device_penalty))
+
+
+def _request(user_id, ip, fingerprint, base_score=100, ip_exempt="", store_score=True, resource="/"):
+    return {"user_id": user_id, "ip": ip, "fingerprint": fingerprint, "base_score": base_score,
+            "ip_exempt": ip_exempt or "", "store_score": store_score, "resource": resource or "/"}
+
+
+def _unavailable(e):
+    # Scripting disabled (e.g. managed Redis with EVAL blocked)
+    return any(m in str(e).lower() for m in _SCRIPT_UNAVAILABLE)
+
+
+class TrustStateStore:
+    def __init__(self, client, limits=None, use_script=True, cache=None, rate_mode=RATE_LIMIT_MODE, devices=None,
+                 state_ttl=RETAIN_USER_STATE):
+        self.client = client
+        self.limits = limits if limits is not None else RateLimits.from_env()
+        self.devices = devices if devices is not None else DeviceRegistry()
+        self.state_ttl_ms = max(0, state_ttl) * 1000
+        self.use_script = use_script
+        self.cache = cache
+        # RATE_LIMIT_MODE=local: rate state stays in this process, Redis keeps the rest
+        self.local_rates = LocalRateLimiter(self.limits) if rate_mode == "local" else None
+        self.cluster = is_cluster(client)
+        self._script = client.register_script(render_script(self.limits, devices=self.devices, state_ttl=state_ttl))
+        self._rate_script = client.register_script(render_script(self.limits, RATE_ONLY_LUA, self.devices, state_ttl))
+        self._check_script = client.register_script(render_script(self.limits, RATE_CHECK_LUA, self.devices, state_ttl))
+
+    def touch(self, user_id, ip, fingerprint, base_score=100, ip_exempt="", store_score=True, resource="/"):
+        """Record one access and return the signals plus the resulting score.
+
+        ``base_score`` already carries the penalties that do not depend on
+        Redis (time of day, sensitive operation); the Redis-backed penalties
+        are applied on top of it.  ``resource`` selects the per-resource
+        rate rules.
+        """
+        r = _request(user_id, ip, fingerprint, base_score, ip_exempt, store_score, resource)
+        if self.cache is None:
+            return self._touch(r)
+
+        if self.cache.matches(user_id, ip, fingerprint):
+            return self._touch_rates(r)
+        signals, leader = self.cache.load(user_id, lambda: self._touch(r), ip, fingerprint)
+        if not leader:
+            # Another request for this user just refreshed the entry
+            if self.cache.matches(user_id, ip, fingerprint):
+                return self._touch_rates(r)
+            signals = self._touch(r)
+            self.cache.remember(user_id, ip, fingerprint)
+        if not self.use_script:
+            self._announce([(r, signals)])
+        return signals
+
+    def _announce(self, touched):
+        # The scoring script publishes by itself; this covers the MULTI/EXEC fallback.
+        # Only IP and device changes affect what other replicas cache.
+        changed = {r["user_id"] for r, signals in touched
+                   if signals.last_ip != r["ip"] or not signals.known_device}
+        if changed:
+            pipe = self.client.pipeline(transaction=False)
+            for user_id in changed:
+                self.cache.publish(user_id, pipe=pipe)
+            pipe.execute()
+
+    def _touch(self, r):
+        if self.use_script:
+            try:
+                return self._touch_script(r)
+            except redis.exceptions.ResponseError as e:
+                if not _unavailable(e):
+                    raise
+                self.use_script = False
+        return self._touch_pipeline(r)
+
+    def touch_many(self, requests):
+        """Batch form of ``touch``: one round trip for the whole batch.
+
+        ``requests`` is a list of dicts with the keyword arguments of
+        ``touch``.  Requests for the same user are applied in list order.
+        """
+        if not requests:
+            return []
+        requests = [_request(**r) for r in requests]
+        if self.cluster and self.use_script:
+            # Cluster pipelines cannot carry EVALSHA; each user's script goes to its own node
+            return [self.touch(**r) for r in requests]
+        if self.cache is not None and self.use_script:
+            try:
+                return self._touch_many_cached(requests)
+            except redis.exceptions.ResponseError as e:
+                if not _unavailable(e):
+                    raise
+                self.use_script = False
+        results = self._touch_many(requests)
+        if self.cache is not None:
+            for r in requests:
+                self.cache.remember(r["user_id"], r["ip"], r["fingerprint"])
+            self._announce(list(zip(requests, results)))
+        return results
+
+    def _touch_many_cached(self, requests):
+        # Known IP and device: rate-only script; anything else: full scoring script
+        hits = [self.cache.matches(r["user_id"], r["ip"], r["fingerprint"]) for r in requests]
+        plans = [self._rate_plan(r) for r in requests]
+        pipe = self.client.pipeline(transaction=False)
+        for r, plan, hit in zip(requests, plans, hits):
+            if hit:
+                self._rate_call(pipe, r, plan)
+            else:
+                self._script_call(pipe, r, plan)
+        replies = pipe.execute()
+        results = []
+        for r, plan, hit, reply in zip(requests, plans, hits, replies):
+            if not hit:
+                self.cache.remember(r["user_id"], r["ip"], r["fingerprint"])
+                results.append(self._signals(reply, plan))
+            elif self._stale(r, reply):
+                results.append(self._touch_known(r))
+            else:
+                results.append(self._rate_signals(reply, r, plan))
+        return results
+
+    def _touch_many(self, requests):
+        plans = [self._rate_plan(r) for r in requests]
+        if self.use_script:
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                for r, plan in zip(requests, plans):
+                    self._script_call(pipe, r, plan)
+                return [self._signals(reply, plan) for reply, plan in zip(pipe.execute(), plans)]
+            except redis.exceptions.ResponseError as e:
+                if not _unavailable(e):
+                    raise
+                self.use_script = False
+
+        now_ms = int(time.time() * 1000)
+        pipe = self._pipeline()
+        spans = [self._queue_state_commands(pipe, r, plan, now_ms) for r, plan in zip(requests, plans)]
+        replies = pipe.execute()
+        results, scores, offset = [], self.client.pipeline(transaction=False), 0
+        for r, plan, n in zip(requests, plans, spans):
+            signals, repair = self._fallback_signals(replies[offset:offset + n], r, plan, now_ms)
+            offset += n
+            self._queue_after_fallback(scores, r, signals, repair)
+            results.append(signals)
+        scores.execute()
+        return results
+
+    def read(self, user_id):
+        """Score, last IP, rate level and live-device count in one round trip."""
+        rule, pipe = self._queue_read(self.client.pipeline(transaction=False), user_id)
+        return self._user_state(pipe.execute(), rule)
+
+    def _queue_read(self, pipe, user_id):
+        rule, rate_key = self.limits.user_key(user_id)
+        pipe.hmget(state_key(user_id), FIELD_TRUST_SCORE, FIELD_LAST_IP)
+        self.devices.queue_count(pipe, user_id)
+        if rate_key:
+            pipe.hgetall(rate_key)
+        return rule, pipe
+
+    @staticmethod
+    def _user_state(replies, rule):
+        (trust_score, last_ip), devices = replies[0], replies[1]
+        level = sliding_level(rule, replies[2]) if len(replies) > 2 else 0
+        return UserState(int(trust_score or 100), last_ip, level, int(devices))
+
+    # ---------- rate rules ----------
+    def _rate_plan(self, r):
+        """``(rule keys, base score, level)``; in local mode the rules run here instead."""
+        if self.local_rates is not None:
+            level, penalty = self.local_rates.check(r["user_id"], r["ip"], r["resource"])
+            return (), r["base_score"] - penalty, level
+        keys = self.limits.keys(r["user_id"], r["ip"], r["resource"])
+        local, foreign = self._split_slots(keys)
+        if not foreign:
+            return keys, r["base_score"], None
+        reply = self._check_script(keys=[k for _, k in foreign], args=[n for n, _ in foreign])
+        return self._merge_plan(r, keys, local, reply)
+
+    def _split_slots(self, keys):
+        """Rate keys that can join the user's script, and the rest (only on a Cluster)."""
+        if not self.cluster:
+            return keys, ()
+        local = [(n, k) for n, k in keys if self.limits.rules[n - 1].scope == "user"]
+        return local, [(n, k) for n, k in keys if self.limits.rules[n - 1].scope != "user"]
+
+    @staticmethod
+    def _merge_plan(r, keys, local, reply):
+        level, penalty = int(reply[0]), int(reply[1])
+        # The first applicable rule reports the level; keep the script's if it runs there
+        return local, r["base_score"] - penalty, None if local and local[0] == keys[0] else level
+
+    # ---------- scripted path ----------
+    def _script_call(self, client, r, plan):
+        rate_keys, base_score, _ = plan
+        keys = list(user_keys(r["user_id"])) + [key for _, key in rate_keys]
+        args = [r["ip"], r["fingerprint"], base_score, r["ip_exempt"], "1" if r["store_score"] else "0"]
+        if self.cache is not None:
+            args += [self.cache.channel, self.cache.message(r["user_id"])]
+        else:
+            args += ["", ""]
+        args += [n for n, _ in rate_keys]
+        return self._script(keys=keys, args=args, client=client)
+
+    @staticmethod
+    def _signals(reply, plan):
+        last_ip, count, known, score, age_ms = reply
+        return TrustSignals(last_ip, plan[2] if plan[2] is not None else int(count), bool(known), int(score),
+                            int(age_ms) // 1000)
+
+    def _touch_script(self, r):
+        plan = self._rate_plan(r)
+        return self._signals(self._script_call(self.client, r, plan), plan)
+
+    def _rate_call(self, client, r, plan):
+        rate_keys, base_score, _ = plan
+        keys = list(user_keys(r["user_id"])) + [key for _, key in rate_keys]
+        args = [r["fingerprint"], base_score, "1" if r["store_score"] else "0"] + [n for n, _ in rate_keys]
+        return self._rate_script(keys=keys, args=args, client=client)
+
+    @staticmethod
+    def _rate_signals(reply, r, plan):
+        count, score, age_ms = reply
+        return TrustSignals(r["ip"], plan[2] if plan[2] is not None else int(count), True, int(score),
+                            int(age_ms) // 1000)
+
+    def _stale(self, r, reply):
+        """True if the rate-only script found the cached device gone; drops the cache entry."""
+        if int(reply[0]) != -1:
+            return False
+        self.cache.invalidate(r["user_id"])
+        return True
+
+    def _touch_known(self, r):
+        # Full touch for a request the near-cache wrongly took as a known device
+        signals = self._touch(r)
+        self.cache.remember(r["user_id"], r["ip"], r["fingerprint"])
+        return signals
+
+    def _touch_rates(self, r):
+        if self.use_script:
+            try:
+                plan = self._rate_plan(r)
+                reply = self._rate_call(self.client, r, plan)
+                if self._stale(r, reply):
+                    # Rate rules were not counted, so the full touch counts them once
+                    return self._touch_known(r)
+                return self._rate_signals(reply, r, plan)
+            except redis.exceptions.ResponseError as e:
+                if not _unavailable(e):
+                    raise
+                self.use_script = False
+        return self._touch_pipeline(r)
+
+    # ---------- MULTI/EXEC fallback ----------
+    def _pipeline(self):
+        # Cluster pipelines cannot be transactions; a user's keys still share one node
+        return self.client.pipeline(transaction=not self.cluster)
+
+    def _queue_state_commands(self, pipe, r, plan, now_ms):
+        """Queue one request's commands; returns how many replies they produce."""
+        key_state = state_key(r["user_id"])
+        pipe.hget(key_state, FIELD_LAST_IP)
+        pipe.hset(key_state, FIELD_LAST_IP, r["ip"])
+        if self.state_ttl_ms:
+            pipe.pexpire(key_state, self.state_ttl_ms)
+        n = self._state_replies + self.devices.queue_fallback(pipe, r["user_id"], r["fingerprint"], now_ms)
+        return n + self.limits.queue_fallback(pipe, plan[0], now_ms)
+
+    @property
+    def _state_replies(self):
+        return 3 if self.state_ttl_ms else 2
+
+    def _fallback_signals(self, replies, r, plan, now_ms):
+        """``(signals, device repair)``; the latter goes to ``_queue_after_fallback``."""
+        last_ip, first, n = replies[0], self._state_replies, self.devices.fallback_replies
+        added, age_ms, repair = self.devices.fallback_result(replies[first:first + n], r["fingerprint"], now_ms)
+        count, penalty = self.limits.fallback_check(replies[first + n:], plan[0], now_ms)
+        if plan[2] is not None:
+            count = plan[2]
+        known = not added
+        score = apply_penalties(plan[1] - penalty, last_ip, r["ip"], known, r["ip_exempt"],
+                                self.devices.penalty(added, age_ms))
+        return TrustSignals(last_ip, int(count), known, score, age_ms // 1000), repair
+
+    def _queue_after_fallback(self, pipe, r, signals, repair):
+        if r["store_score"]:
+            pipe.hset(state_key(r["user_id"]), FIELD_TRUST_SCORE, signals.score)
+        self.devices.cleanup(pipe, r["user_id"], repair)
+
+    def _touch_pipeline(self, r):
+        plan = self._rate_plan(r)
+        now_ms = int(time.time() * 1000)
+        pipe = self._pipeline()
+        self._queue_state_commands(pipe, r, plan, now_ms)
+        signals, repair = self._fallback_signals(pipe.execute(), r, plan, now_ms)
+        if r["store_score"] or any(repair):
+            pipe = self.client.pipeline(transaction=False)
+            self._queue_after_fallback(pipe, r, signals, repair)
+            pipe.execute()
+        return signals
+
+
+class AsyncTrustStateStore(TrustStateStore):
+    """Same store for a ``redis.asyncio`` client; ``touch`` is a coroutine.
+
+    The near-cache is not used here: its single-flight loading blocks threads.
+    """
+
+    async def touch(self, user_id, ip, fingerprint, base_score=100, ip_exempt="", store_score=True, resource="/"):
+        r = _request(user_id, ip, fingerprint, base_score, ip_exempt, store_score, resource)
+        if self.use_script:
+            try:
+                return await self._touch_script(r)
+            except redis.exceptions.ResponseError as e:
+                if not _unavailable(e):
+                    raise
+                self.use_script = False
+        return await self._touch_pipeline(r)
+
+    async def touch_many(self, requests):
+        if not requests:
+            return []
+        requests = [_request(**r) for r in requests]
+        if self.cluster and self.use_script:
+            return [await self.touch(**r) for r in requests]
+        plans = [await self._rate_plan_async(r) for r in requests]
+        if self.use_script:
+            try:
+                async with self.client.pipeline(transaction=False) as pipe:
+                    for r, plan in zip(requests, plans):
+                        await self._script_call(pipe, r, plan)
+                    return [self._signals(reply, plan) for reply, plan in zip(await pipe.execute(), plans)]
+            except redis.exceptions.ResponseError as e:
+                if not _unavailable(e):
+                    raise
+                self.use_script = False
+
+        now_ms = int(time.time() * 1000)
+        async with self._pipeline() as pipe:
+            spans = [self._queue_state_commands(pipe, r, plan, now_ms) for r, plan in zip(requests, plans)]
+            replies = await pipe.execute()
+        results, offset = [], 0
+        async with self.client.pipeline(transaction=False) as scores:
+            for r, plan, n in zip(requests, plans, spans):
+                signals, repair = self._fallback_signals(replies[offset:offset + n], r, plan, now_ms)
+                offset += n
+                self._queue_after_fallback(scores, r, signals, repair)
+                results.append(signals)
+            await scores.execute()
+        return results
+
+    async def read(self, user_id):
+        async with self.client.pipeline(transaction=False) as pipe:
+            rule, _ = self._queue_read(pipe, user_id)
+            return self._user_state(await pipe.execute(), rule)
+
+    async def _rate_plan_async(self, r):
+        if self.local_rates is not None:
+            return self._rate_plan(r)
+        keys = self.limits.keys(r["user_id"], r["ip"], r["resource"])
+        local, foreign = self._split_slots(keys)
+        if not foreign:
+            return keys, r["base_score"], None
+        reply = await self._check_script(keys=[k for _, k in foreign], args=[n for n, _ in foreign])
+        return self._merge_plan(r, keys, local, reply)
+
+    async def _touch_script(self, r):
+        plan = await self._rate_plan_async(r)
+        return self._signals(await self._script_call(self.client, r, plan), plan)
+
+    async def _touch_pipeline(self, r):
+        plan = await self._rate_plan_async(r)
+        now_ms = int(time.time() * 1000)
+        async with self._pipeline() as pipe:
+            self._queue_state_commands(pipe, r, plan, now_ms)
+            replies = await pipe.execute()
+        signals, repair = self._fallback_signals(replies, r, plan, now_ms)
+        if r["store_score"] or any(repair):
+            async with self.client.pipeline(transaction=False) as pipe:
+                self._queue_after_fallback(pipe, r, signals, repair)
+                await pipe.execute()
+        return signals
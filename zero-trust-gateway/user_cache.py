@@ -0,0 +1,250 @@
+"""In-process near-cache of per-user trust state.
+
+Each replica remembers, per user, the last IP written to Redis and the device
+fingerprints known to be in the user's device registry.  When a request arrives
+from that same IP on a known device, the only Redis state that changes is the
+access counter, so ``TrustStateStore`` can skip the full scoring script and
+run a counter-only one (see ``trust_state.py``).  That script re-checks the
+device, so one evicted from the registry since it was cached is caught.
+
+Entries are bounded (LRU) and expire after a TTL.  A replica that changes a
+user's IP or device set publishes the user ID on a Redis channel (from the
+scoring script itself, so no extra round trip), and every other replica
+drops its entry.  While the subscription is down the cache
+reports misses, so a lost invalidation can never be served.
+
+    USER_CACHE=true USER_CACHE_SIZE=10000 USER_CACHE_TTL=30 USER_CACHE_WARM=500 python app_ziti.py
+"""
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict, Counter as Tally, namedtuple
+
+import redis
+from prometheus_client import Counter, Gauge
+
+from device_registry import DeviceRegistry
+from redis_layout import FIELD_LAST_IP, state_key
+
+USER_CACHE_CHANNEL = os.getenv("USER_CACHE_CHANNEL", "trust_state:invalidate")
+
+CACHE_HITS = Counter("zt_user_cache_hits_total", "Per-user state near-cache hits")
+CACHE_MISSES = Counter("zt_user_cache_misses_total", "Per-user state near-cache misses")
+CACHE_EVICTIONS = Counter("zt_user_cache_evictions_total", "Per-user state near-cache evictions", ["reason"])
+CACHE_COALESCED = Counter("zt_user_cache_coalesced_total", "Cache misses that waited on another request's load")
+CACHE_SIZE = Gauge("zt_user_cache_entries", "Per-user state near-cache entries", multiprocess_mode="livesum")
+
+CachedState = namedtuple("CachedState", ["last_ip", "devices", "expires_at"])
+
+
+class _Flight:
+    __slots__ = ("done", "stale")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.stale = False
+
+
+class UserStateCache:
+    def __init__(self, client, maxsize=10000, ttl=30.0, channel=USER_CACHE_CHANNEL, load_timeout=1.0, listener=None):
+        self.client = client
+        # Subscription and warm-up run in the background, on a client without the request budget
+        self.listener = listener if listener is not None else client
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.channel = channel
+        self.load_timeout = load_timeout
+        self.node_id = uuid.uuid4().hex[:12]
+
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._listening = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._warm = None
+
+    @classmethod
+    def from_env(cls, client, listener=None):
+        """``None`` unless ``USER_CACHE=true``."""
+        if os.getenv("USER_CACHE", "false").lower() != "true":
+            return None
+        return cls(
+            client,
+            maxsize=int(os.getenv("USER_CACHE_SIZE", "10000")),
+            ttl=float(os.getenv("USER_CACHE_TTL", "30")),
+            listener=listener,
+        )
+
+    # ---------- lookups ----------
+    def get(self, user_id):
+        if not self._listening:
+            CACHE_MISSES.inc()
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.expires_at <= now:
+                del self._entries[user_id]
+                CACHE_EVICTIONS.labels(reason="ttl").inc()
+                CACHE_SIZE.set(len(self._entries))
+                entry = None
+            if entry is None:
+                CACHE_MISSES.inc()
+                return None
+            self._entries.move_to_end(user_id)
+        CACHE_HITS.inc()
+        return entry
+
+    def matches(self, user_id, ip, fingerprint):
+        """True if a request from ``ip`` on ``fingerprint`` changes nothing but the counter."""
+        entry = self.get(user_id)
+        return entry is not None and entry.last_ip == ip and fingerprint in entry.devices
+
+    def load(self, user_id, loader, last_ip, fingerprint):
+        """Single-flight load: one caller runs ``loader``, concurrent callers wait for it.
+
+        ``loader`` performs the full touch, after which Redis holds ``last_ip``
+        and ``fingerprint`` for the user.  Returns ``(result, True)`` to the
+        caller that ran it; the others get ``(None, False)`` once it has
+        finished (or ``load_timeout`` has passed) and should re-check the cache.
+        """
+        with self._lock:
+            flight = self._flights.get(user_id)
+            leader = flight is None
+            if leader:
+                flight = self._flights[user_id] = _Flight()
+        if not leader:
+            CACHE_COALESCED.inc()
+            flight.done.wait(self.load_timeout)
+            return None, False
+
+        try:
+            result = loader()
+            with self._lock:
+                if not flight.stale:
+                    self._merge(user_id, last_ip, fingerprint)
+            return result, True
+        finally:
+            with self._lock:
+                self._flights.pop(user_id, None)
+            flight.done.set()
+
+    # ---------- writes ----------
+    def remember(self, user_id, last_ip, fingerprint):
+        """Record state this replica just wrote to Redis (after a full touch)."""
+        with self._lock:
+            if user_id not in self._flights:
+                self._merge(user_id, last_ip, fingerprint)
+
+    def _merge(self, user_id, last_ip, fingerprint):
+        # Evicted devices are published by the scoring script and re-checked by the counter-only one
+        entry = self._entries.get(user_id)
+        devices = entry.devices if entry is not None else frozenset()
+        self._store(user_id, last_ip, devices | {fingerprint})
+
+    def _store(self, user_id, last_ip, devices):
+        self._entries[user_id] = CachedState(last_ip, frozenset(devices), time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            CACHE_EVICTIONS.labels(reason="lru").inc()
+        CACHE_SIZE.set(len(self._entries))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            flight = self._flights.get(user_id)
+            if flight is not None:
+                flight.stale = True
+            if self._entries.pop(user_id, None) is not None:
+                CACHE_EVICTIONS.labels(reason="invalidated").inc()
+                CACHE_SIZE.set(len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            for flight in self._flights.values():
+                flight.stale = True
+            self._entries.clear()
+            CACHE_SIZE.set(0)
+
+    def message(self, user_id):
+        return f"{self.node_id}:{user_id}"
+
+    def publish(self, user_id, pipe=None):
+        """Tell the other replicas to drop ``user_id``; pass ``pipe`` to queue it."""
+        return (pipe or self.client).publish(self.channel, self.message(user_id))
+
+    # ---------- warm-up ----------
+    def warm(self, access_log, users=100, scan=5000):
+        """Preload the ``users`` most frequent users among the last ``scan`` decisions."""
+        if users <= 0:
+            return 0
+        counts = Tally(fields.get("user_id") for _, fields in self.listener.xrevrange(access_log.stream, count=scan))
+        top = [u for u, _ in counts.most_common(users) if u]
+        if not top:
+            return 0
+        devices = DeviceRegistry()
+        pipe = self.listener.pipeline(transaction=False)
+        for user_id in top:
+            pipe.hget(state_key(user_id), FIELD_LAST_IP)
+            devices.queue_fingerprints(pipe, user_id)
+        replies = pipe.execute()
+        with self._lock:
+            for i, user_id in enumerate(top):
+                last_ip, devices = replies[2 * i], replies[2 * i + 1]
+                if last_ip is not None and user_id not in self._entries:
+                    self._store(user_id, last_ip, devices)
+        return len(top)
+
+    # ---------- invalidation listener ----------
+    def start(self, warm_from=None, warm_users=0):
+        """Subscribe in the background; warm-up runs once the subscription is live."""
+        if self._thread is None:
+            self._warm = (warm_from, warm_users) if warm_from is not None and warm_users > 0 else None
+            self._thread = threading.Thread(target=self._listen, name="user-cache-invalidation", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def _listen(self):
+        backoff = 0.5
+        while not self._stop.is_set():
+            pubsub = self.listener.pubsub()
+            try:
+                pubsub.subscribe(self.channel)
+                while not self._stop.is_set():
+                    msg = pubsub.get_message(timeout=1.0)
+                    if msg is None:
+                        continue
+                    if msg["type"] == "subscribe":
+                        if self._warm is not None:
+                            warm, self._warm = self._warm, None
+                            try:
+                                self.warm(*warm)
+                            except redis.exceptions.ResponseError:
+                                pass
+                        self._listening = True
+                        backoff = 0.5
+                    elif msg["type"] == "message":
+                        data = msg["data"]
+                        if isinstance(data, bytes):
+                            data = data.decode()
+                        sender, _, user_id = data.partition(":")
+                        if sender != self.node_id:
+                            self.invalidate(user_id)
+            except (redis.exceptions.RedisError, OSError):
+                pass
+            finally:
+                # Invalidations may have been missed: forget everything until resubscribed
+                self._listening = False
+                self.clear()
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, 10.0)
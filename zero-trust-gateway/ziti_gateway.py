@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""Scoring, policy and response logic of the enhanced gateway.
+
+Shared by app_ziti.py (Flask) and app_async.py (ASGI).  Importing it opens
+no Redis connection and starts no thread: each serving module builds its own
+clients, stores and background workers and hands them to
+``EnhancedZeroTrustGateway``.
+"""
+import os
+import hashlib
+from datetime import datetime
+
+from prometheus_client import Counter, Histogram
+
+from degraded_mode import UNAVAILABLE, scored_locally
+from redis_layout import FIELD_TRUST_SCORE, state_key
+from stage_timing import StageTimer
+from step_up import DENY, REQUIRE_MFA
+
+
+KEYCLOAK_URL = os.getenv("KEYCLOAK_URL", "http://localhost:8080")
+REALM = os.getenv("REALM", "my-company")
+CLIENT_ID = os.getenv("CLIENT_ID", "my-app")
+CSV_PATH = os.getenv("CSV_PATH", "out/decisions_ziti.csv")
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+USE_ZITI = os.getenv("USE_ZITI", "false").lower() == "true"
+ZITI_CONTROLLER = os.getenv("ZITI_CONTROLLER", "localhost:1280")
+TRUST_SCRIPT = os.getenv("TRUST_SCRIPT", "true").lower() == "true"
+CSV_FIELDS = ["ts", "user_id", "trust_score", "network_score", "app_score", "resource", "action", "reason", "via_ziti"]
+
+
+DECISIONS = Counter("zt_decisions_total", "Zero Trust decisions", ["action", "reason", "layer"])
+LATENCY = Histogram("zt_decision_latency_seconds", "Decision latency seconds")
+TRUST_SCORE = Histogram("zt_trust_score", "Trust score distribution", ["layer"])
+ZITI_CONNECTIONS = Counter("ziti_connections_total", "OpenZiti connection attempts", ["status"])
+# 分阶段耗时直方图与每请求Redis往返次数（STAGE_TIMING=true）
+stage_timer = StageTimer("ziti")
+
+
+def ziti_available():
+    """USE_ZITI=true 且 OpenZiti 模块可用"""
+    if not USE_ZITI:
+        return False
+    try:
+        import openziti
+        print("OpenZiti模块已加载")
+        return True
+    except ImportError:
+        print("OpenZiti未安装，运行在标准模式")
+        return False
+
+def read_bearer_token(req, body_token=None):
+    h = req.headers.get("Authorization", "")
+    if h.startswith("Bearer "):
+        return h.replace("Bearer ", "", 1).strip()
+    return (body_token or "").strip()
+
+
+class EnhancedZeroTrustGateway:
+    """网络层 + 应用层信任分与策略判定；Redis客户端与各存储由服务模块注入"""
+
+    def __init__(self, redis_client, trust_store, access_log, policy_store, decision_sink, reputation_store=None,
+                 user_baseline=None, risk_tracker=None, step_up_store=None, use_ziti=USE_ZITI):
+        self.redis_client = redis_client
+        self.trust_store = trust_store
+        self.access_log = access_log
+        self.policy_store = policy_store
+        self.decision_sink = decision_sink
+        self.reputation_store = reputation_store
+        self.user_baseline = user_baseline
+        self.risk_tracker = risk_tracker
+        self.step_up_store = step_up_store
+        self.use_ziti = use_ziti
+
+    # ---------- 请求上下文与响应 ----------
+    def client_ip(self, headers, remote_addr):
+        # X-Forwarded-For 可被客户端伪造：只采信本方 TRUSTED_PROXIES 个反向代理追加的条目
+        hops = [h.strip() for h in headers.get("X-Forwarded-For", "").split(",") if h.strip()]
+        if TRUSTED_PROXIES and len(hops) >= TRUSTED_PROXIES:
+            return hops[-TRUSTED_PROXIES]
+        if self.use_ziti and headers.get("X-Openziti-Identity"):
+            return "ziti-network"
+        return remote_addr or "0.0.0.0"
+
+    def build_request_context(self, headers, remote_addr, data, claims=None):
+        """请求上下文；headers 需支持大小写无关的 get（单个请求与批量条目共用）"""
+        return {
+            "ip": self.client_ip(headers, remote_addr),
+            "user_agent": headers.get("User-Agent", ""),
+            "accept_language": headers.get("Accept-Language", ""),
+            "resource": data.get("resource", "/"),
+            "sensitive_operation": self.policy_store.is_sensitive(data.get("resource", "") or "/"),
+            "platform": data.get("platform", ""),
+            "timezone": data.get("timezone", ""),
+            # OpenZiti相关
+            "via_ziti": headers.get("X-Via-Ziti", "false") == "true" or self.use_ziti,
+            "ziti_identity": headers.get("X-Openziti-Identity", None),
+            # 令牌声明（提权授权校验 acr/amr/auth_time）
+            "claims": claims,
+        }
+
+    def decision_response(self, user_id, roles, resource, policy, combined_score, network_score, app_score, ip=None):
+        """记录指标与决策日志，返回 (响应体, 状态码)"""
+        layer = "ziti" if self.use_ziti else "standard"
+        DECISIONS.labels(policy["action"], policy.get("reason", "unknown"), layer).inc()
+        if self.risk_tracker is not None:
+            self.risk_tracker.observe(user_id, ip, combined_score)
+
+        # 决策日志（异步批量写入）
+        with stage_timer.stage("decision_log"):
+            self.decision_sink.submit({
+                "ts": datetime.now().isoformat(),
+                "user_id": user_id,
+                "trust_score": combined_score,
+                "network_score": network_score,
+                "app_score": app_score,
+                "resource": resource,
+                "action": policy["action"],
+                "reason": policy.get("reason", ""),
+                "via_ziti": self.use_ziti,
+            })
+
+        response = {
+            "user_id": user_id,
+            "roles": roles,
+            "trust_score": combined_score,
+            "network_trust_score": network_score,
+            "app_trust_score": app_score,
+            "access_decision": policy["action"],
+            "restrictions": policy.get("restrictions", []),
+            "monitoring_level": policy["monitoring_level"],
+            "reason": policy.get("reason", ""),
+            "via_ziti": self.use_ziti,
+            "timestamp": datetime.now().isoformat(),
+        }
+
+        # 返回码
+        action = policy["action"]
+        if action == "deny":
+            code = 403
+        elif action == "require_mfa":
+            code = 428
+        else:
+            code = 200
+
+        return response, code
+
+    # ---------- 信任分 ----------
+    def calculate_network_trust_score(self, user_id, request_context):
+        """网络层信任分（OpenZiti相关）"""
+        score = 50
+
+        if request_context.get("via_ziti"):
+            score += 30
+            ZITI_CONNECTIONS.labels(status="authenticated").inc()
+        else:
+            ZITI_CONNECTIONS.labels(status="direct").inc()
+
+        if request_context.get("ziti_identity"):
+            score += 20
+
+        return min(100, score)
+
+    def _app_state_request(self, user_id, request_context):
+        """应用层中不依赖Redis的部分，返回 trust_store.touch 的参数"""
+        score = 100
+
+        # 偏离用户常用时段/资源/网段/速率的扣分；基线建立前沿用固定的夜间规则
+        baseline = None
+        if self.user_baseline is not None:
+            with stage_timer.stage("signal_baseline"):
+                baseline = self.user_baseline.update(user_id, request_context.get("resource", "/"),
+                                                     request_context.get("ip"))
+        if baseline is not None and baseline.warm:
+            score -= baseline.penalty
+        else:
+            current_hour = datetime.now().hour
+            if current_hour < 6 or current_hour > 23:
+                score -= 15
+
+        if request_context.get("sensitive_operation"):
+            score -= 10
+
+        # 来源网段信誉（黑名单/白名单/风险网段）
+        if self.reputation_store is not None:
+            with stage_timer.stage("signal_ip_reputation"):
+                score -= self.reputation_store.penalty(request_context.get("ip"))
+
+        with stage_timer.stage("signal_fingerprint"):
+            fingerprint = self._get_device_fingerprint(request_context)
+        request_context["fingerprint"] = fingerprint
+
+        return {
+            "user_id": user_id,
+            "ip": request_context.get("ip"),
+            "fingerprint": fingerprint,
+            "base_score": score,
+            "ip_exempt": "ziti-network",
+            "store_score": False,
+            "resource": request_context.get("resource", "/"),
+        }
+
+    def calculate_app_trust_score(self, user_id, request_context):
+        # IP变化、访问速率（rate_limits.json）、设备指纹在Redis中原子完成（单次往返）
+        state_request = self._app_state_request(user_id, request_context)
+        with stage_timer.stage("signal_state"):
+            signals = self.trust_store.touch(**state_request)
+        request_context["degraded"] = scored_locally(signals)
+        return signals.score
+
+    def calculate_combined_trust_score(self, user_id, request_context):
+        with stage_timer.stage("signal_network"):
+            network_score = self.calculate_network_trust_score(user_id, request_context)
+        app_score = self.calculate_app_trust_score(user_id, request_context)
+        combined_score = self._combine_scores(network_score, app_score)
+        with stage_timer.stage("score_store"):
+            try:
+                self.redis_client.hset(state_key(user_id), FIELD_TRUST_SCORE, combined_score)
+            except UNAVAILABLE:
+                self.trust_store.keep(scores={user_id: combined_score})
+        return combined_score, network_score, app_score
+
+    def decide_batch(self, items):
+        """批量决策：items 为 [(user_id, request_context, resource)]。
+
+        与单个请求相同的评分与策略语义，但整批的Redis操作合并为两次往返：
+        一次执行全部评分脚本，一次写入 trust_score 与审计日志
+        （有 require_mfa/deny 决策时另加一次读取提权授权）。
+        写入失败时分数与日志留在本地，Redis恢复后补写。
+        """
+        with stage_timer.stage("signal_network"):
+            network_scores = [self.calculate_network_trust_score(u, ctx) for u, ctx, _ in items]
+        state_requests = [self._app_state_request(u, ctx) for u, ctx, _ in items]
+        with stage_timer.stage("signal_state"):
+            signals = self.trust_store.touch_many(state_requests)
+
+        scores = []
+        for (user_id, ctx, resource), network_score, sig in zip(items, network_scores, signals):
+            ctx["degraded"] = scored_locally(sig)
+            scores.append((self._combine_scores(network_score, sig.score), network_score, sig.score))
+
+        results = []
+        pipe = self.redis_client.pipeline(transaction=False)
+        grants = self.step_up_grants(items, scores, pipe)
+        for (user_id, ctx, resource), (combined_score, network_score, app_score), grant in zip(items, scores, grants):
+            pipe.hset(state_key(user_id), FIELD_TRUST_SCORE, combined_score)
+            policy = self.enforce_policy_with_layers(user_id, combined_score, network_score, app_score, resource,
+                                                     pipe=pipe, degraded=ctx["degraded"], grant=grant)
+            results.append((policy, combined_score, network_score, app_score))
+        try:
+            pipe.execute()
+        except UNAVAILABLE:
+            self.keep_batch(items, results)
+        return results
+
+    def keep_batch(self, items, results):
+        """批量写入失败：分数与审计日志交给 trust_store 待补写"""
+        scores, entries = {}, []
+        for (user_id, _, resource), (policy, combined_score, network_score, app_score) in zip(items, results):
+            scores[user_id] = combined_score
+            entries.append(self._decision_entry(user_id, combined_score, network_score, app_score, resource, policy))
+        self.trust_store.keep(scores=scores, log=entries)
+
+    def _combine_scores(self, network_score, app_score):
+        TRUST_SCORE.labels(layer="network").observe(network_score)
+        TRUST_SCORE.labels(layer="application").observe(app_score)
+
+        if self.use_ziti:
+            combined_score = (network_score * 0.3 + app_score * 0.7)
+        else:
+            combined_score = app_score
+
+        combined_score = int(combined_score)
+        TRUST_SCORE.labels(layer="combined").observe(combined_score)
+
+        return combined_score
+
+    def _get_device_fingerprint(self, context):
+        raw = "|".join([
+            context.get("user_agent", ""),
+            context.get("accept_language", ""),
+            context.get("platform", ""),
+            context.get("timezone", ""),
+        ])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    # ---------- 提权授权与策略 ----------
+    def step_up_action(self, combined_score, network_score, app_score, resource, request_context):
+        """需要查询提权授权时返回策略动作（require_mfa 可获授权，deny 可撤销授权），否则 None"""
+        if self.step_up_store is None or request_context.get("degraded") or request_context.get("claims") is None:
+            return None
+        action = self.policy_store.decide(resource, combined_score, network_score, app_score)["action"]
+        return action if action in (REQUIRE_MFA, DENY) else None
+
+    def step_up_grant(self, user_id, combined_score, network_score, app_score, resource, request_context):
+        """该设备有效的提权授权；无授权时返回 None（仍返回428）"""
+        action = self.step_up_action(combined_score, network_score, app_score, resource, request_context)
+        if action is None:
+            return None
+        with stage_timer.stage("step_up"):
+            return self.step_up_store.check(user_id, request_context["fingerprint"], combined_score,
+                                            request_context["claims"], action)
+
+    def _step_up_requests(self, items, scores):
+        """需要查询提权授权的批内位置及 check_many 的请求；scores 为 [(combined, network, app)]"""
+        at, requests = [], []
+        for i, ((user_id, ctx, resource), (combined_score, network_score, app_score)) in enumerate(zip(items, scores)):
+            action = self.step_up_action(combined_score, network_score, app_score, resource, ctx)
+            if action is not None:
+                at.append(i)
+                requests.append((user_id, ctx["fingerprint"], combined_score, ctx["claims"], action))
+        return at, requests
+
+    def step_up_grants(self, items, scores, pipe):
+        """整批的提权授权：一次往返读取，需要的写入排入批量的 pipeline"""
+        grants = [None] * len(items)
+        at, requests = self._step_up_requests(items, scores)
+        if requests:
+            with stage_timer.stage("step_up"):
+                for i, grant in zip(at, self.step_up_store.check_many(requests, pipe=pipe)):
+                    grants[i] = grant
+        return grants
+
+    def enforce_policy_with_layers(self, user_id, combined_score, network_score, app_score, resource, pipe=None,
+                                   degraded=False, grant=None):
+        # 网络层分数高但应用层分数低时给予限制访问（见策略文件中的 variants）
+        with stage_timer.stage("policy"):
+            policy = self.policy_store.decide(resource, combined_score, network_score, app_score)
+            # 未经Redis评分的决策按 FAILURE_MODE 收紧
+            if degraded:
+                policy = self.trust_store.restrict(policy)
+            # 已完成MFA的设备按授权分数重新判定（上报的信任分不变）
+            elif grant is not None and policy["action"] == REQUIRE_MFA:
+                policy = self.step_up_store.elevated(
+                    self.policy_store.decide(resource, grant.score, network_score, app_score))
+
+        with stage_timer.stage("access_log"):
+            self._log_enhanced_decision(user_id, combined_score, network_score, app_score, resource, policy, pipe=pipe)
+        return policy
+
+    def _log_enhanced_decision(self, user_id, combined_score, network_score, app_score, resource, decision, pipe=None):
+        entry = self._decision_entry(user_id, combined_score, network_score, app_score, resource, decision)
+        if pipe is not None:
+            self.access_log.append(entry, pipe=pipe)
+            return
+        try:
+            self.access_log.append(entry)
+        except UNAVAILABLE:
+            self.trust_store.keep(log=[entry])
+
+    def _decision_entry(self, user_id, combined_score, network_score, app_score, resource, decision):
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "user_id": user_id,
+            "trust_score": combined_score,
+            "network_score": network_score,
+            "app_score": app_score,
+            "resource": resource,
+            "decision": decision.get("action", ""),
+            "reason": decision.get("reason", ""),
+            "via_ziti": self.use_ziti,
+        }